@@ -1,7 +1,12 @@
+import logging
 import os
+import queue
 from flask import Flask, render_template, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.ai import generativelanguage as glm
 import anthropic
 from azure.devops.connection import Connection
 from azure.devops.v7_1.test_plan.models import (
@@ -11,21 +16,39 @@ from azure.devops.v7_1.test_plan.models import (
 )
 from msrest.authentication import BasicAuthentication
 import json
+import orjson
 import re
 from bs4 import BeautifulSoup
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit
 import ast
 import html
 import unicodedata
 import string
 import base64
+import binascii
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
 from PIL import Image
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Logging: INFO by default, set LOG_LEVEL=DEBUG for per-request traces
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+log = logging.getLogger(__name__)
+
 # --- Configure Gemini API ---
 # Create a .env file in your project root and add your Gemini API key:
 # GEMINI_API_KEY="YOUR_NEW_SECRET_API_KEY"
@@ -33,22 +56,22 @@ load_dotenv()
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 if gemini_api_key:
     genai.configure(api_key=gemini_api_key)
-    print("DEBUG: Gemini API configured from .env file")
+    log.debug("Gemini API configured from .env file")
 else:
-    print("WARNING: GEMINI_API_KEY not found in .env file. Users can provide it via UI.")
+    log.warning("GEMINI_API_KEY not found in .env file. Users can provide it via UI.")
 
 # --- Configure Claude API ---
 claude_api_key = os.getenv("CLAUDE_API_KEY")
 claude_client = None
 if not claude_api_key:
-    print("WARNING: CLAUDE_API_KEY not found in .env file. Claude features will be unavailable.")
+    log.warning("CLAUDE_API_KEY not found in .env file. Claude features will be unavailable.")
 else:
     try:
         claude_client = anthropic.Anthropic(api_key=claude_api_key)
-        print("DEBUG: Claude API client initialized successfully")
+        log.debug("Claude API client initialized successfully")
     except Exception as e:
-        print(f"ERROR: Failed to initialize Claude API client: {e}")
-        print("WARNING: Claude features will be unavailable.")
+        log.error("Failed to initialize Claude API client: %s", e)
+        log.warning("Claude features will be unavailable.")
         claude_client = None
 
 # --- Azure DevOps Configuration ---
@@ -56,7 +79,24 @@ else:
 # We will get them from the request body in each endpoint.
 
 # --- Flask App ---
+class _OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify() and request.json skip the stdlib encoder"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+app.json = _OrjsonProvider(app)
 
 
 def _collect_suite_test_configuration_ids(test_plan_client, project, plan_id, suite_id):
@@ -77,7 +117,7 @@ def _collect_suite_test_configuration_ids(test_plan_client, project, plan_id, su
             include_point_details=False,
         )
     except Exception as exc:
-        print(f"DEBUG: get_points_list failed ({exc}); trying suite default configurations.")
+        log.debug("get_points_list failed (%s); trying suite default configurations.", exc)
     for point in points or []:
         cfg = getattr(point, "configuration", None)
         cid = getattr(cfg, "id", None) if cfg is not None else None
@@ -96,7 +136,7 @@ def _collect_suite_test_configuration_ids(test_plan_client, project, plan_id, su
                 seen.add(cid)
                 ids_ordered.append(cid)
     except Exception as exc:
-        print(f"DEBUG: get_test_suite_by_id failed: {exc}")
+        log.debug("get_test_suite_by_id failed: %s", exc)
     return ids_ordered
 
 
@@ -148,8 +188,87 @@ def extract_table_from_html(table_element):
     result = re.sub(r' {2,}', ' ', result)
     return result
 
-def extract_images_from_html(html_content):
-    """Extract images and tables from HTML content and return list of PIL Image objects and text with placeholders"""
+# Header of an image data URI up to the payload, e.g. "data:image/png;base64,"
+_DATA_URI_RE = re.compile(r'data:image[^,]*,')
+# Longest side of an image sent to the AI providers
+_MAX_IMAGE_DIMENSION = 1568
+
+def _plain_text_as_parsed(text):
+    """Apply the input normalization an HTML parser does to text without markup (line endings, NULs)"""
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '\ufffd')
+
+def _clean_extracted_text(text_content):
+    """Final cleanup of extracted text: normalize multiple consecutive newlines and spaces
+    
+    This is critical for related stories that may have extra whitespace
+    """
+    text_content = re.sub(r'\n\s*\n+', '\n\n', text_content)  # Max 2 newlines
+    text_content = re.sub(r'[ \t]+', ' ', text_content)  # Multiple spaces/tabs to single space
+    text_content = re.sub(r' \n', '\n', text_content)  # Remove space before newline
+    text_content = re.sub(r'\n ', '\n', text_content)  # Remove space after newline
+    # Remove any remaining multiple spaces (shouldn't happen, but just in case)
+    text_content = re.sub(r' {2,}', ' ', text_content)
+    # Clean up spaces around table markers
+    text_content = re.sub(r' +\[TABLE', '\n[TABLE', text_content)
+    text_content = re.sub(r'\[TABLE +', '[TABLE ', text_content)
+    text_content = re.sub(r' +TABLE END\]', ' TABLE END]\n', text_content)
+    text_content = re.sub(r'TABLE END\] +', 'TABLE END]\n', text_content)
+    return text_content
+
+# Shared pool for parsing a story's HTML fields side by side; lxml releases the GIL while
+# parsing and PIL while decoding, so the fields overlap instead of running back to back
+_HTML_EXTRACT_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='html-extract')
+
+
+def _load_image(image_bytes, digest):
+    """Decode an embedded image payload into a PIL image ready to send to the AI providers"""
+    image = Image.open(BytesIO(image_bytes))
+    # Decode now so a broken image fails here; mode conversion is left to the
+    # provider that ends up receiving it (see _image_for_gemini / _encode_image_for_claude)
+    image.load()
+    
+    # Both AI providers downscale larger images server-side, so don't upload the extra pixels
+    if max(image.size) > _MAX_IMAGE_DIMENSION:
+        image.thumbnail((_MAX_IMAGE_DIMENSION, _MAX_IMAGE_DIMENSION), Image.Resampling.LANCZOS)
+    
+    # Content hash for _unique_images; Pillow doesn't write unknown info keys when saving
+    image.info['blake2b'] = digest
+    return image
+
+
+def _images_from_sources(image_sources, image_cache):
+    """PIL images for (digest, encoded bytes) pairs, decoding each payload once per image_cache"""
+    images = []
+    for digest, image_bytes in image_sources:
+        image = image_cache.get(digest)
+        if image is None:
+            try:
+                image = image_cache.setdefault(digest, _load_image(image_bytes, digest))
+            except Exception as e:
+                log.warning("Failed to process image: %s", e, exc_info=True)
+                continue
+        images.append(image)
+    return images
+
+
+def extract_images_from_html(html_content, image_cache=None):
+    """Extract images and tables from HTML content and return list of PIL Image objects and text with placeholders
+    
+    Pass the same image_cache dict when extracting several fields of one request so a screenshot
+    pasted into each field is decoded once; _unique_images then sends it only once.
+    """
+    if image_cache is None:
+        image_cache = {}
+    image_sources, text_content = _extract_html_content(html_content, image_cache)
+    return _images_from_sources(image_sources, image_cache), text_content
+
+
+def _extract_html_content(html_content, image_cache):
+    """extract_images_from_html's parsing step
+    
+    Returns the embedded images as (BLAKE2b digest, encoded bytes) pairs plus the text with
+    placeholders. Each image is decoded into image_cache to check it loads.
+    """
     if not html_content:
         return [], ""
     
@@ -169,43 +288,35 @@ def extract_images_from_html(html_content):
     # Normalize multiple newlines to single newline
     html_content = re.sub(r'\n\s*\n+', '\n', html_content)
     
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Plain text (no tags or entities) would parse to itself, so skip the parser entirely
+    if '<' not in html_content and '&' not in html_content:
+        return [], _clean_extracted_text(_plain_text_as_parsed(html_content).strip())
+    
+    soup = BeautifulSoup(html_content, 'lxml')
     images = soup.find_all('img')
     tables = soup.find_all('table')
     
-    image_objects = []
+    image_sources = []
     
     # Process images and replace with placeholders
     for img in images:
         src = img.get('src', '')
-        if src.startswith('data:image'):
+        data_uri_match = _DATA_URI_RE.match(src)
+        if data_uri_match:
             try:
-                # Parse data URL: data:image/png;base64,<data>
-                header, data = src.split(',', 1)
-                
-                # Decode base64
-                image_bytes = base64.b64decode(data)
-                image = Image.open(BytesIO(image_bytes))
+                # Decode the base64 payload straight from the str, after the header
+                image_bytes = binascii.a2b_base64(src[data_uri_match.end():])
+                digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+                if digest not in image_cache:
+                    image_cache.setdefault(digest, _load_image(image_bytes, digest))
                 
-                # Convert to RGB if necessary (Gemini requires RGB format)
-                if image.mode in ('RGBA', 'LA'):
-                    rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                    rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                    image = rgb_image
-                elif image.mode == 'P':
-                    image = image.convert('RGB')
-                elif image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                image_objects.append(image)
+                image_sources.append((digest, image_bytes))
                 
                 # Replace img tag with placeholder text
                 alt_text = img.get('alt', 'image')
-                img.replace_with(f"[Image {len(image_objects)}: {alt_text}]")
+                img.replace_with(f"[Image {len(image_sources)}: {alt_text}]")
             except Exception as e:
-                print(f"WARNING: Failed to process image: {e}")
-                import traceback
-                traceback.print_exc()
+                log.warning("Failed to process image: %s", e, exc_info=True)
                 alt_text = img.get('alt', 'image')
                 img.replace_with(f"[Image: {alt_text} - failed to load]")
         else:
@@ -226,26 +337,330 @@ def extract_images_from_html(html_content):
     # But we'll clean up extra whitespace afterwards
     text_content = soup.get_text(separator='\n', strip=True)
     
-    # Final cleanup: normalize multiple consecutive newlines and spaces
-    # This is critical for related stories that may have extra whitespace
-    text_content = re.sub(r'\n\s*\n+', '\n\n', text_content)  # Max 2 newlines
-    text_content = re.sub(r'[ \t]+', ' ', text_content)  # Multiple spaces/tabs to single space
-    text_content = re.sub(r' \n', '\n', text_content)  # Remove space before newline
-    text_content = re.sub(r'\n ', '\n', text_content)  # Remove space after newline
-    # Remove any remaining multiple spaces (shouldn't happen, but just in case)
-    text_content = re.sub(r' {2,}', ' ', text_content)
-    # Clean up spaces around table markers
-    text_content = re.sub(r' +\[TABLE', '\n[TABLE', text_content)
-    text_content = re.sub(r'\[TABLE +', '[TABLE ', text_content)
-    text_content = re.sub(r' +TABLE END\]', ' TABLE END]\n', text_content)
-    text_content = re.sub(r'TABLE END\] +', 'TABLE END]\n', text_content)
+    return image_sources, _clean_extracted_text(text_content)
+
+
+# LRU of parsed HTML fields keyed by a hash of the field's HTML, so resubmitting an unchanged
+# story skips the BeautifulSoup parse. Images are kept as their encoded bytes (a fraction of the
+# decoded pixels) and decoded again for each request, so requests never share PIL images.
+_HTML_EXTRACT_CACHE = OrderedDict()
+_HTML_EXTRACT_CACHE_MAX_ENTRIES = 128
+_HTML_EXTRACT_CACHE_LOCK = threading.Lock()
+
+
+def extract_images_from_html_cached(html_content, image_cache=None):
+    """Memoized extract_images_from_html"""
+    if not html_content:
+        return [], ""
+    if image_cache is None:
+        image_cache = {}
+    cache_key = hashlib.blake2b(html_content.encode('utf-8'), digest_size=16).digest()
+    with _HTML_EXTRACT_CACHE_LOCK:
+        cached = _HTML_EXTRACT_CACHE.get(cache_key)
+        if cached is not None:
+            _HTML_EXTRACT_CACHE.move_to_end(cache_key)
+    if cached is None:
+        image_sources, text_content = _extract_html_content(html_content, image_cache)
+        cached = (tuple(image_sources), text_content)
+        with _HTML_EXTRACT_CACHE_LOCK:
+            _HTML_EXTRACT_CACHE[cache_key] = cached
+            while len(_HTML_EXTRACT_CACHE) > _HTML_EXTRACT_CACHE_MAX_ENTRIES:
+                _HTML_EXTRACT_CACHE.popitem(last=False)
+    return _images_from_sources(cached[0], image_cache), cached[1]
+
+
+def _unique_images(images):
+    """Drop repeated images, keeping order
+    
+    Compared by the hash of their source bytes, so a screenshot decoded through different
+    image_caches still counts as one.
+    """
+    return list({image.info.get('blake2b', id(image)): image for image in images}.values())
+
+
+def _iter_claude_stream_text(stream_manager, message_stream):
+    """Yield text deltas from an open Claude message stream, closing it when done"""
+    try:
+        for text in message_stream.text_stream:
+            yield text
+    finally:
+        stream_manager.__exit__(None, None, None)
+
+
+def _iter_gemini_stream_text(response):
+    """Yield the text of each chunk of a streamed Gemini response"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunk carries no text parts (e.g. only finish/safety metadata)
+            continue
+        if text:
+            yield text
+
+
+# Claude models in order of preference
+# Using latest available models (as of 2024-2025)
+# Note: Older models may not be available, so we prioritize newer ones
+CLAUDE_MODELS = [
+    "claude-3-5-sonnet-20241022",  # Latest Sonnet 3.5 (most capable)
+    "claude-3-5-haiku-20241022",   # Latest Haiku 3.5 (faster, cheaper)
+    "claude-3-5-sonnet-20240620",  # Fallback to older Sonnet 3.5
+    "claude-3-opus-20240229",      # Opus 3.0 (if available)
+]
+# Removed claude-3-sonnet-20240229 as it's deprecated and causing 404 errors
+
+# LRU of the model that last answered for each API key (users can bring their own key), so later
+# calls go straight to it instead of walking past unavailable models again. Keyed by a hash of
+# the API key so the keys themselves aren't kept.
+_WORKING_CLAUDE_MODELS_MAX_ENTRIES = 256
+_WORKING_CLAUDE_MODELS = OrderedDict()
+_WORKING_CLAUDE_MODELS_LOCK = threading.Lock()
+
+
+# LRU of provider clients per API key (users can bring their own key), so connections and
+# client setup aren't rebuilt for each call. A client is only kept once a call with its key
+# has succeeded, so requests with made-up keys can't fill the cache.
+_AI_CLIENTS_MAX_ENTRIES = 16
+_CLAUDE_CLIENTS = OrderedDict()
+_GEMINI_MODELS = OrderedDict()
+_AI_CLIENTS_LOCK = threading.Lock()
+
+
+def _cached_ai_client(clients, api_key):
+    with _AI_CLIENTS_LOCK:
+        client = clients.get(api_key)
+        if client is not None:
+            clients.move_to_end(api_key)
+    return client
+
+
+def _remember_ai_client(clients, api_key, client):
+    """Keep client for api_key in clients after a successful call"""
+    with _AI_CLIENTS_LOCK:
+        clients[api_key] = client
+        clients.move_to_end(api_key)
+        while len(clients) > _AI_CLIENTS_MAX_ENTRIES:
+            clients.popitem(last=False)
+
+
+def _get_claude_client(api_key):
+    if claude_client is not None and api_key == claude_api_key:
+        return claude_client  # Already created from .env at startup
+    client = _cached_ai_client(_CLAUDE_CLIENTS, api_key)
+    if client is None:
+        client = anthropic.Anthropic(api_key=api_key)
+    return client
+
+
+class _GeminiModel(genai.GenerativeModel):
+    """GenerativeModel bound to its own API key instead of the process-wide genai.configure one
+    
+    google-generativeai has no public way to pass a client to a model, so the one created
+    here is set before the model's first call would create a default one.
+    """
+    
+    def __init__(self, model_name, api_key):
+        super().__init__(model_name)
+        self._client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+
+
+def _get_gemini_model(api_key):
+    model = _cached_ai_client(_GEMINI_MODELS, api_key)
+    if model is None:
+        model = _GeminiModel('gemini-flash-latest', api_key)
+    return model
+
+
+def _api_key_digest(api_key):
+    return hashlib.blake2b(api_key.encode('utf-8'), digest_size=16).digest()
+
+
+def _claude_models_to_try(api_key):
+    """CLAUDE_MODELS with the model that last worked for api_key moved to the front"""
+    key_digest = _api_key_digest(api_key)
+    with _WORKING_CLAUDE_MODELS_LOCK:
+        working_model = _WORKING_CLAUDE_MODELS.get(key_digest)
+        if working_model is not None:
+            _WORKING_CLAUDE_MODELS.move_to_end(key_digest)
+    if working_model is None:
+        return CLAUDE_MODELS
+    return [working_model] + [model for model in CLAUDE_MODELS if model != working_model]
+
+
+def _remember_working_claude_model(api_key, model_name):
+    key_digest = _api_key_digest(api_key)
+    with _WORKING_CLAUDE_MODELS_LOCK:
+        _WORKING_CLAUDE_MODELS[key_digest] = model_name
+        _WORKING_CLAUDE_MODELS.move_to_end(key_digest)
+        while len(_WORKING_CLAUDE_MODELS) > _WORKING_CLAUDE_MODELS_MAX_ENTRIES:
+            _WORKING_CLAUDE_MODELS.popitem(last=False)
+
+
+def _flatten_to_rgb(image):
+    """Return an RGB copy of image, compositing any transparency onto white"""
+    if image.mode in ('RGBA', 'LA'):
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        # The image itself is the mask: paste reads its alpha band in place, no band copies
+        rgb_image.paste(image, mask=image)
+        return rgb_image
+    return image.convert('RGB')
+
+
+def _image_for_gemini(image):
+    """Return image in a mode the Gemini SDK can upload
     
-    return image_objects, text_content
+    The SDK sends PNG files as PNG and re-encodes everything else as JPEG, which only
+    takes RGB/L images, so only those others get converted.
+    """
+    if image.format == 'PNG' or image.mode in ('RGB', 'L'):
+        return image
+    return _flatten_to_rgb(image)
+
+
+def _encode_image_for_claude(image):
+    """Return (media_type, base64 data) for an image, in a format Claude accepts"""
+    # Convert PIL Image to base64
+    buffered = BytesIO()
+    
+    # Detect format and save accordingly
+    # Claude supports: image/jpeg, image/png, image/gif, image/webp
+    if image.format:
+        format_name = image.format.upper()
+        if format_name == 'JPEG':
+            image.save(buffered, format="JPEG")
+            media_type = "image/jpeg"
+        elif format_name == 'PNG':
+            image.save(buffered, format="PNG")
+            media_type = "image/png"
+        elif format_name == 'GIF':
+            image.save(buffered, format="GIF")
+            media_type = "image/gif"
+        elif format_name == 'WEBP':
+            image.save(buffered, format="WEBP")
+            media_type = "image/webp"
+        elif image.mode in ('RGBA', 'LA'):
+            # Keep the transparency of unknown formats
+            image.save(buffered, format="PNG")
+            media_type = "image/png"
+        else:
+            # Default to JPEG if format is unknown; lossless buys the model nothing
+            image.convert('RGB').save(buffered, format="JPEG", quality=85, optimize=True)
+            media_type = "image/jpeg"
+    else:
+        # No format detected: JPEG is several times smaller than PNG for screenshots
+        _flatten_to_rgb(image).save(buffered, format="JPEG", quality=85, optimize=True)
+        media_type = "image/jpeg"
+    
+    # Encode to base64
+    with buffered.getbuffer() as image_view:
+        return media_type, base64.b64encode(image_view).decode('ascii')
+
+
+class _RPMLimiter:
+    """Sliding-window requests-per-minute limit shared by every thread calling a provider"""
+    
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self._calls = deque()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request can be sent without exceeding the limit"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= 60:
+                    self._calls.popleft()
+                if len(self._calls) < self.rpm:
+                    self._calls.append(now)
+                    return
+                wait = 60 - (now - self._calls[0])
+            time.sleep(wait)
+
+
+# Every Gunicorn worker process throttles on its own, so the configured limits are split
+# between them (gunicorn.conf.py exports the worker count)
+_AI_WORKER_COUNT = max(1, int(os.getenv('GUNICORN_WORKERS', 1)))
+
+
+def _per_worker_limit(env_var, default):
+    return max(1, int(os.getenv(env_var, default)) // _AI_WORKER_COUNT)
+
+
+# Per-provider (concurrent requests, requests per minute) so bursts of users don't trigger 429s
+_AI_PROVIDER_LIMITS = {
+    'claude': (
+        threading.BoundedSemaphore(_per_worker_limit('CLAUDE_MAX_CONCURRENT_REQUESTS', 5)),
+        _RPMLimiter(_per_worker_limit('CLAUDE_REQUESTS_PER_MINUTE', 50))
+    ),
+    'gemini': (
+        threading.BoundedSemaphore(_per_worker_limit('GEMINI_MAX_CONCURRENT_REQUESTS', 8)),
+        _RPMLimiter(_per_worker_limit('GEMINI_REQUESTS_PER_MINUTE', 60))
+    ),
+}
+# Rough input budget per provider, checked once before the case type calls go out: a story over
+# it would fail every call after a round-trip anyway. Neither SDK tokenizes offline, so the count
+# is estimated at ~4 characters per token plus a flat cost per image.
+_MAX_INPUT_TOKENS = {
+    'claude': int(os.getenv('CLAUDE_MAX_INPUT_TOKENS', 180000)),
+    'gemini': int(os.getenv('GEMINI_MAX_INPUT_TOKENS', 1000000)),
+}
+_CHARS_PER_TOKEN = 4
+# Claude charges about width * height / 750 tokens after scaling images to ~1.15 megapixels
+_TOKENS_PER_IMAGE = 1600
+
+
+def _estimate_input_tokens(texts, image_count):
+    """Rough token count of a prompt made of texts plus image_count images"""
+    return sum(len(text) for text in texts if text) // _CHARS_PER_TOKEN + image_count * _TOKENS_PER_IMAGE
+
+
+# Rate-limit and server errors are retried with exponential backoff (1s, 2s, 4s; capped at 60s),
+# or after the Retry-After Claude sends if that is longer
+_AI_RETRY_ATTEMPTS = 3
+_AI_RETRY_BASE_DELAY = 1
+_AI_RETRY_MAX_DELAY = 60
+_RETRYABLE_AI_ERRORS = (
+    anthropic.RateLimitError,
+    anthropic.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+
+def _retryable_ai_error(error):
+    """The SDK rate-limit or server error behind error, or None if it shouldn't be retried
+    
+    _call_ai_provider_once raises most SDK errors as a ValueError chained to the original.
+    """
+    while error is not None:
+        if isinstance(error, _RETRYABLE_AI_ERRORS):
+            return error
+        if isinstance(error, anthropic.APIStatusError) and error.status_code >= 500:
+            return error
+        error = error.__cause__
+    return None
+
+
+def _ai_retry_delay(error, attempt):
+    """Seconds to wait before retrying after the retryable SDK error on the given attempt"""
+    delay = _AI_RETRY_BASE_DELAY * 2 ** attempt
+    if isinstance(error, anthropic.APIStatusError):
+        try:
+            delay = max(delay, float(error.response.headers.get('retry-after')))
+        except (TypeError, ValueError):
+            pass
+    return min(_AI_RETRY_MAX_DELAY, delay)
 
-def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, claude_api_key=None):
+
+def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, claude_api_key=None, stream=False):
     """
     Call either Gemini or Claude API based on provider selection.
-    Returns the text response from the AI.
+    Returns the text response from the AI, or an iterator of text chunks when stream=True.
+    
+    Calls are throttled per provider and retried with backoff on rate-limit and server errors;
+    a stream counts against the concurrency limit only until its response starts.
     
     Args:
         ai_provider: 'gemini' or 'claude'
@@ -253,7 +668,27 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
         images: Optional list of PIL Image objects
         gemini_api_key: Optional Gemini API key (falls back to .env if not provided)
         claude_api_key: Optional Claude API key (falls back to .env if not provided)
+        stream: If True, return an iterator of text chunks as the provider produces them
     """
+    provider = 'claude' if ai_provider and ai_provider.lower() == 'claude' else 'gemini'
+    semaphore, rpm_limiter = _AI_PROVIDER_LIMITS[provider]
+    for attempt in range(_AI_RETRY_ATTEMPTS + 1):
+        with semaphore:
+            rpm_limiter.acquire()
+            try:
+                return _call_ai_provider_once(ai_provider, prompt, images, gemini_api_key, claude_api_key, stream)
+            except Exception as e:
+                retryable_error = _retryable_ai_error(e)
+                if attempt == _AI_RETRY_ATTEMPTS or retryable_error is None:
+                    raise
+                error = e
+        delay = _ai_retry_delay(retryable_error, attempt)
+        log.warning("%s call failed (%s); retrying in %ss", provider, error, delay)
+        time.sleep(delay)
+
+
+def _call_ai_provider_once(ai_provider, prompt, images=None, gemini_api_key=None, claude_api_key=None, stream=False):
+    """Single call_ai_provider request, without throttling or retries"""
     ai_provider = ai_provider.lower() if ai_provider else 'gemini'
     
     if ai_provider == 'claude':
@@ -262,11 +697,11 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
         if not api_key:
             raise ValueError("Claude API key is required. Please provide CLAUDE_API_KEY in .env file or via UI.")
         
-        # Create Claude client with the API key
+        # Get the (cached) Claude client for the API key
         try:
-            claude_client_instance = anthropic.Anthropic(api_key=api_key)
+            claude_client_instance = _get_claude_client(api_key)
         except Exception as e:
-            raise ValueError(f"Failed to initialize Claude API client: {e}")
+            raise ValueError(f"Failed to initialize Claude API client: {e}") from e
         
         # Claude API message format - build content array with text and images
         content = []
@@ -276,89 +711,73 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
         
         # Add images if provided
         if images and len(images) > 0:
-            print(f"DEBUG: Converting {len(images)} images to base64 for Claude API")
-            for idx, image in enumerate(images):
+            log.debug("Converting %s images to base64 for Claude API", len(images))
+            def encode_image(indexed_image):
+                idx, image = indexed_image
                 try:
-                    # Convert PIL Image to base64
-                    buffered = BytesIO()
-                    
-                    # Detect format and save accordingly
-                    # Claude supports: image/jpeg, image/png, image/gif, image/webp
-                    if image.format:
-                        format_name = image.format.upper()
-                        if format_name == 'JPEG':
-                            image.save(buffered, format="JPEG")
-                            media_type = "image/jpeg"
-                        elif format_name == 'PNG':
-                            image.save(buffered, format="PNG")
-                            media_type = "image/png"
-                        elif format_name == 'GIF':
-                            image.save(buffered, format="GIF")
-                            media_type = "image/gif"
-                        elif format_name == 'WEBP':
-                            image.save(buffered, format="WEBP")
-                            media_type = "image/webp"
-                        else:
-                            # Default to PNG if format is unknown
-                            image.save(buffered, format="PNG")
-                            media_type = "image/png"
-                    else:
-                        # No format detected, default to PNG
-                        image.save(buffered, format="PNG")
-                        media_type = "image/png"
-                    
-                    # Encode to base64
-                    img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    
-                    # Add image to content array
-                    content.append({
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": img_base64
-                        }
-                    })
-                    print(f"DEBUG: Added image {idx + 1} to Claude message (format: {media_type})")
+                    return _encode_image_for_claude(image)
                 except Exception as e:
-                    print(f"WARNING: Failed to convert image {idx + 1} to base64: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    log.warning("Failed to convert image %s to base64: %s", idx + 1, e, exc_info=True)
                     # Continue with other images even if one fails
+                    return None
+            
+            # Pillow releases the GIL while encoding, so several images encode in parallel
+            with ThreadPoolExecutor(max_workers=min(4, len(images))) as executor:
+                encoded_images = list(executor.map(encode_image, enumerate(images)))
+            
+            for idx, encoded_image in enumerate(encoded_images):
+                if encoded_image is None:
+                    continue
+                media_type, img_base64 = encoded_image
+                # Add image to content array
+                content.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": img_base64
+                    }
+                })
+                log.debug("Added image %s to Claude message (format: %s)", idx + 1, media_type)
         
         # Create message with content array
         messages = [{"role": "user", "content": content}]
         
-        # Try different Claude models in order of preference
-        # Using latest available models (as of 2024-2025)
-        # Note: Older models may not be available, so we prioritize newer ones
-        claude_models = [
-            "claude-3-5-sonnet-20241022",  # Latest Sonnet 3.5 (most capable)
-            "claude-3-5-haiku-20241022",   # Latest Haiku 3.5 (faster, cheaper)
-            "claude-3-5-sonnet-20240620",  # Fallback to older Sonnet 3.5
-            "claude-3-opus-20240229",      # Opus 3.0 (if available)
-        ]
-        # Removed claude-3-sonnet-20240229 as it's deprecated and causing 404 errors
+        # Use higher max_tokens for test case generation (can be large JSON arrays)
+        # Positive test cases now have no limits, so use highest limit
+        # Edge cases tend to generate more test cases, so use even higher limit
+        # (lowercase the prompt once, outside the model loop)
+        prompt_lower = prompt.lower()
+        is_test_case = 'test case' in prompt_lower or 'json array' in prompt_lower
+        is_positive = 'positive' in prompt_lower and is_test_case
+        is_edge_case = 'edge case' in prompt_lower
+        if is_positive:
+            max_tokens = 16384  # Highest limit for positive test cases (no limits on generation)
+        elif is_edge_case:
+            max_tokens = 16384  # Higher limit for edge cases which generate many test cases
+        elif is_test_case:
+            max_tokens = 8192  # Standard limit for other test case types
+        else:
+            max_tokens = 4096  # Lower limit for non-test-case operations
         
+        # Try Claude models in order of preference, starting with the one that last worked for this key
         last_error = None
-        for model_name in claude_models:
+        for model_name in _claude_models_to_try(api_key):
             try:
-                print(f"DEBUG: Trying Claude model: {model_name}")
-                # Use higher max_tokens for test case generation (can be large JSON arrays)
-                # Positive test cases now have no limits, so use highest limit
-                # Edge cases tend to generate more test cases, so use even higher limit
-                is_test_case = 'test case' in str(prompt).lower() or 'json array' in str(prompt).lower()
-                is_positive = 'positive' in str(prompt).lower() and is_test_case
-                is_edge_case = 'edge case' in str(prompt).lower()
-                if is_positive:
-                    max_tokens = 16384  # Highest limit for positive test cases (no limits on generation)
-                elif is_edge_case:
-                    max_tokens = 16384  # Higher limit for edge cases which generate many test cases
-                elif is_test_case:
-                    max_tokens = 8192  # Standard limit for other test case types
-                else:
-                    max_tokens = 4096  # Lower limit for non-test-case operations
-                print(f"DEBUG: Using max_tokens={max_tokens} for Claude API call")
+                log.debug("Trying Claude model: %s", model_name)
+                log.debug("Using max_tokens=%s for Claude API call", max_tokens)
+                if stream:
+                    stream_manager = claude_client_instance.messages.stream(
+                        model=model_name,
+                        max_tokens=max_tokens,
+                        messages=messages
+                    )
+                    # Entering the manager sends the request, so model/auth errors surface here
+                    message_stream = stream_manager.__enter__()
+                    _remember_working_claude_model(api_key, model_name)
+                    _remember_ai_client(_CLAUDE_CLIENTS, api_key, claude_client_instance)
+                    log.debug("Streaming response from Claude model: %s", model_name)
+                    return _iter_claude_stream_text(stream_manager, message_stream)
                 response = claude_client_instance.messages.create(
                     model=model_name,
                     max_tokens=max_tokens,
@@ -368,7 +787,7 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
                 # Check if response was truncated
                 stop_reason = getattr(response, 'stop_reason', None)
                 if stop_reason == 'max_tokens':
-                    print(f"WARNING: Claude response was truncated (hit max_tokens limit). Consider increasing max_tokens or simplifying the prompt.")
+                    log.warning("Claude response was truncated (hit max_tokens limit). Consider increasing max_tokens or simplifying the prompt.")
                 
                 # Extract text from Claude response
                 if not hasattr(response, 'content') or not response.content:
@@ -377,7 +796,7 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
                 text_parts = []
                 for content_block in response.content:
                     if not hasattr(content_block, 'text'):
-                        print(f"WARNING: Content block missing 'text' attribute: {type(content_block)}")
+                        log.warning("Content block missing 'text' attribute: %s", type(content_block))
                         continue
                     text_parts.append(content_block.text)
                 
@@ -385,34 +804,34 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
                 if not result:
                     raise ValueError("Claude API returned empty response. This may indicate an issue with the prompt or API configuration.")
                 
-                print(f"DEBUG: Successfully used Claude model: {model_name}, stop_reason: {stop_reason}, response length: {len(result)}")
+                log.debug("Successfully used Claude model: %s, stop_reason: %s, response length: %s", model_name, stop_reason, len(result))
+                _remember_working_claude_model(api_key, model_name)
+                _remember_ai_client(_CLAUDE_CLIENTS, api_key, claude_client_instance)
                 if stop_reason == 'max_tokens':
-                    print(f"WARNING: Response may be incomplete due to max_tokens limit. Response ends with: ...{result[-200:]}")
+                    log.warning("Response may be incomplete due to max_tokens limit. Response ends with: ...%s", result[-200:])
                 
                 return result
             except Exception as e:
                 last_error = e
                 error_str = str(e)
-                print(f"DEBUG: Claude API error for model {model_name}: {error_str}")
-                import traceback
-                traceback.print_exc()
+                log.debug("Claude API error for model %s: %s", model_name, error_str, exc_info=True)
                 
                 # If it's a model not found error, try next model
                 if 'not_found_error' in error_str or '404' in error_str or 'model' in error_str.lower() or 'not found' in error_str.lower():
-                    print(f"DEBUG: Model {model_name} not available, trying next model...")
+                    log.debug("Model %s not available, trying next model...", model_name)
                     continue
                 # If it's an authentication error, don't try other models
                 elif 'authentication' in error_str.lower() or '401' in error_str or '403' in error_str or 'api_key' in error_str.lower():
-                    raise ValueError(f"Claude API authentication error: {error_str}. Please check your CLAUDE_API_KEY.")
+                    raise ValueError(f"Claude API authentication error: {error_str}. Please check your CLAUDE_API_KEY.") from e
                 # If it's a rate limit error, don't try other models
                 elif 'rate_limit' in error_str.lower() or '429' in error_str or 'quota' in error_str.lower():
-                    raise ValueError(f"Claude API rate limit exceeded: {error_str}. Please try again later.")
+                    raise ValueError(f"Claude API rate limit exceeded: {error_str}. Please try again later.") from e
                 # If it's a content policy error, don't try other models
                 elif 'content_policy' in error_str.lower() or 'safety' in error_str.lower():
-                    raise ValueError(f"Claude API content policy violation: {error_str}. The prompt may contain content that violates Claude's usage policies.")
+                    raise ValueError(f"Claude API content policy violation: {error_str}. The prompt may contain content that violates Claude's usage policies.") from e
                 else:
                     # For other errors, try next model but log the error
-                    print(f"WARNING: Error with model {model_name}, trying next model...")
+                    log.warning("Error with model %s, trying next model...", model_name)
                     continue
         
         # If all models failed, raise a more descriptive error
@@ -420,16 +839,16 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
             error_str = str(last_error)
             # Check if all failures were due to model not found (404)
             if 'not_found_error' in error_str.lower() or '404' in error_str or ('model' in error_str.lower() and 'not found' in error_str.lower()):
-                raise ValueError(f"None of the Claude models are available. The models may have been deprecated or your API key doesn't have access to them. Last error: {error_str}. Please check Anthropic's documentation for available models or contact support.")
+                raise ValueError(f"None of the Claude models are available. The models may have been deprecated or your API key doesn't have access to them. Last error: {error_str}. Please check Anthropic's documentation for available models or contact support.") from last_error
             # Provide more specific error messages
             elif 'authentication' in error_str.lower() or '401' in error_str or '403' in error_str or 'api_key' in error_str.lower():
-                raise ValueError(f"Claude API authentication failed: {error_str}. Please verify your CLAUDE_API_KEY is correct and has proper permissions.")
+                raise ValueError(f"Claude API authentication failed: {error_str}. Please verify your CLAUDE_API_KEY is correct and has proper permissions.") from last_error
             elif 'rate_limit' in error_str.lower() or '429' in error_str or 'quota' in error_str.lower():
-                raise ValueError(f"Claude API rate limit exceeded: {error_str}. Please wait a moment and try again, or check your API quota.")
+                raise ValueError(f"Claude API rate limit exceeded: {error_str}. Please wait a moment and try again, or check your API quota.") from last_error
             elif 'content_policy' in error_str.lower() or 'safety' in error_str.lower():
-                raise ValueError(f"Claude API content policy violation: {error_str}. The prompt may contain content that violates Claude's usage policies.")
+                raise ValueError(f"Claude API content policy violation: {error_str}. The prompt may contain content that violates Claude's usage policies.") from last_error
             else:
-                raise ValueError(f"All Claude models failed. Last error: {error_str}. Please check your API key, network connection, and try again.")
+                raise ValueError(f"All Claude models failed. Last error: {error_str}. Please check your API key, network connection, and try again.") from last_error
         else:
             raise ValueError("Failed to get response from Claude API. No models responded successfully.")
     
@@ -440,57 +859,60 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
             if not api_key:
                 raise ValueError("Gemini API key is required. Please provide GEMINI_API_KEY in .env file or via UI.")
             
-            # Configure Gemini with the API key
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-flash-latest')
+            # Get the (cached) Gemini model for the API key
+            model = _get_gemini_model(api_key)
             
             # Build content array with text and images
             content_parts = [prompt]
             if images and len(images) > 0:
-                print(f"DEBUG: Adding {len(images)} images to Gemini request")
+                log.debug("Adding %s images to Gemini request", len(images))
                 for image in images:
-                    content_parts.append(image)
+                    content_parts.append(_image_for_gemini(image))
             
             # Send to Gemini
-            print(f"DEBUG: Sending request to Gemini with {len(content_parts)} content parts")
+            log.debug("Sending request to Gemini with %s content parts", len(content_parts))
             if images and len(images) > 0:
-                response = model.generate_content(content_parts)
+                response = model.generate_content(content_parts, stream=stream)
             else:
-                response = model.generate_content(prompt)
+                response = model.generate_content(prompt, stream=stream)
+            _remember_ai_client(_GEMINI_MODELS, api_key, model)
             
-            print(f"DEBUG: Gemini response received, type: {type(response)}")
+            if stream:
+                # The first chunk is fetched eagerly, so API errors are still handled below
+                log.debug("Streaming Gemini response")
+                return _iter_gemini_stream_text(response)
+            
+            log.debug("Gemini response received, type: %s", type(response))
             
             # Extract text from Gemini response
             if hasattr(response, 'text'):
                 result = response.text.strip()
-                print(f"DEBUG: Extracted text from Gemini response.text, length: {len(result)}")
+                log.debug("Extracted text from Gemini response.text, length: %s", len(result))
                 return result
             else:
                 # Try to get text from candidates
-                print(f"DEBUG: response.text not available, trying candidates...")
+                log.debug("response.text not available, trying candidates...")
                 if hasattr(response, 'candidates') and response.candidates:
                     if hasattr(response.candidates[0], 'content'):
                         if hasattr(response.candidates[0].content, 'parts'):
                             parts = response.candidates[0].content.parts
                             result = ''.join([part.text for part in parts if hasattr(part, 'text')]).strip()
-                            print(f"DEBUG: Extracted text from candidates[0].content.parts, length: {len(result)}")
+                            log.debug("Extracted text from candidates[0].content.parts, length: %s", len(result))
                             return result
                         else:
                             result = str(response.candidates[0].content).strip()
-                            print(f"DEBUG: Extracted text from candidates[0].content, length: {len(result)}")
+                            log.debug("Extracted text from candidates[0].content, length: %s", len(result))
                             return result
                     else:
                         result = str(response.candidates[0]).strip()
-                        print(f"DEBUG: Extracted text from candidates[0], length: {len(result)}")
+                        log.debug("Extracted text from candidates[0], length: %s", len(result))
                         return result
                 else:
                     result = str(response).strip()
-                    print(f"DEBUG: Fallback: extracted text from response string, length: {len(result)}")
+                    log.debug("Fallback: extracted text from response string, length: %s", len(result))
                     return result
         except Exception as gemini_error:
-            print(f"ERROR in Gemini API call: {gemini_error}")
-            import traceback
-            traceback.print_exc()
+            log.exception("ERROR in Gemini API call: %s", gemini_error)
             error_str = str(gemini_error)
             
             # Check for quota/rate limit errors
@@ -508,12 +930,12 @@ def call_ai_provider(ai_provider, prompt, images=None, gemini_api_key=None, clau
                     error_msg += f"\n\nPlease wait approximately {retry_delay} seconds before retrying, or switch to Claude API provider."
                 else:
                     error_msg += "\n\nPlease wait a few minutes before retrying, or switch to Claude API provider."
-                raise ValueError(error_msg)
+                raise ValueError(error_msg) from gemini_error
             # Check for authentication errors
             elif '401' in error_str or '403' in error_str or 'authentication' in error_str.lower() or 'api_key' in error_str.lower():
-                raise ValueError(f"Gemini API authentication error: {error_str}. Please check your GEMINI_API_KEY.")
+                raise ValueError(f"Gemini API authentication error: {error_str}. Please check your GEMINI_API_KEY.") from gemini_error
             else:
-                raise ValueError(f"Gemini API error: {error_str}")
+                raise ValueError(f"Gemini API error: {error_str}") from gemini_error
 
 @app.route('/')
 def index():
@@ -521,7 +943,7 @@ def index():
 
 @app.route('/fetch_story', methods=['POST'])
 def fetch_story():
-    print("fetch_story called")
+    log.info("fetch_story called")
     data = request.json or {}
     story_id = data.get('story_id')
     azure_devops_org_url = data.get('azure_devops_org_url')
@@ -532,7 +954,7 @@ def fetch_story():
         return jsonify({'error': 'Azure DevOps details and User Story ID are required.'}), 400
 
     try:
-        print("About to fetch work item")
+        log.info("About to fetch work item")
         credentials = BasicAuthentication('', azure_devops_pat or '')
         connection = Connection(base_url=azure_devops_org_url, creds=credentials)
         work_item_tracking_client = connection.get_client('azure.devops.v7_1.work_item_tracking.work_item_tracking_client.WorkItemTrackingClient')
@@ -591,11 +1013,9 @@ def fetch_story():
         }
         return jsonify(story_details)
     except Exception as e:
-        print("Exception occurred in fetch_story:", e)
+        log.exception("Exception occurred in fetch_story: %s", e)
         if hasattr(e, 'response') and hasattr(e.response, 'text'):
-            print("Azure DevOps response body:", e.response.text)
-        import traceback
-        traceback.print_exc()
+            log.info("Azure DevOps response body: %s", e.response.text)
         return jsonify({'error': str(e)}), 500
 
 def _ac_step_body(line):
@@ -771,130 +1191,154 @@ def _detect_steps_in_acceptance_criteria(acceptance_criteria):
             # Prefer block with most procedural verbs (user's actual test steps)
             best = max(blocks, key=lambda b: sum(1 for s in b if procedural_verbs.search(s)))
             normalized_steps = best
-            print(f"DEBUG: _detect_steps_in_acceptance_criteria: Multiple blocks found, using procedural block ({len(normalized_steps)} steps)")
+            log.debug("_detect_steps_in_acceptance_criteria: Multiple blocks found, using procedural block (%s steps)", len(normalized_steps))
         normalized_steps = _strip_leading_non_actionable_ac_steps(normalized_steps)
         if not normalized_steps:
-            print(f"DEBUG: _detect_steps_in_acceptance_criteria: No actionable steps after filtering")
+            log.debug("_detect_steps_in_acceptance_criteria: No actionable steps after filtering")
             return False, ""
         steps_text = '\n'.join(normalized_steps)
-        print(f"DEBUG: _detect_steps_in_acceptance_criteria: Found {len(normalized_steps)} steps")
+        log.debug("_detect_steps_in_acceptance_criteria: Found %s steps", len(normalized_steps))
         return True, steps_text
     
-    print(f"DEBUG: _detect_steps_in_acceptance_criteria: No steps found")
+    log.debug("_detect_steps_in_acceptance_criteria: No steps found")
     return False, ""
 
-def _generate_cases_for_type(ai_provider, story_title, story_description, acceptance_criteria, data_dictionary, case_type, related_stories=None, images=None, ambiguity_aware=True, gemini_api_key=None, claude_api_key=None):
-    """Generate test cases for a specific type, optionally including images
-    
-    Args:
-        ai_provider: AI provider to use ('gemini' or 'claude')
-        story_title: Title of the user story
-        story_description: Description of the user story
-        acceptance_criteria: Acceptance criteria text
-        data_dictionary: Data dictionary text
-        case_type: Type of test cases to generate ('Positive', 'Negative', 'Edge Case', 'Data Flow')
-        related_stories: List of related user stories
-        images: List of PIL Image objects
-        ambiguity_aware: If True, include ambiguity-aware test case generation (default: True)
-        gemini_api_key: Optional Gemini API key (falls back to .env if not provided)
-        claude_api_key: Optional Claude API key (falls back to .env if not provided)
+def _iter_json_array_items(chunks, text_parts=None):
+    """Yield each top-level object of the first JSON array in a stream of text chunks
+    as soon as its closing brace arrives.
+
+    Every chunk is also appended to ``text_parts`` (if given) so the caller can fall
+    back to parsing the full response.
     """
-    ai_provider = ai_provider.lower() if ai_provider else 'gemini'
-    print(f"DEBUG: _generate_cases_for_type called for {case_type} using {ai_provider}. related_stories:", related_stories)
-    print(f"DEBUG: Ambiguity-aware generation: {ambiguity_aware}")
-    if images:
-        print(f"DEBUG: Including {len(images)} images in test case generation")
-    
-    # Detect steps in acceptance criteria, or in story description if none in acceptance criteria
-    has_steps, steps_text = _detect_steps_in_acceptance_criteria(acceptance_criteria)
-    if not has_steps and story_description:
-        has_steps, steps_text = _detect_steps_in_acceptance_criteria(story_description)
-        if has_steps:
-            print(f"DEBUG: Detected steps in story description (none in acceptance criteria). Steps found: {len(steps_text.split('\n'))}")
-    steps_text_escaped = ""
-    if has_steps:
-        step_count = len(steps_text.split('\n'))
-        print(f"DEBUG: Detected steps in acceptance criteria/description. Steps found: {step_count}")
-        print(f"DEBUG: Steps content (first 500 chars): {steps_text[:500]}")
-        # Escape the steps text for use in f-string
-        steps_text_escaped = steps_text.replace('{', '{{').replace('}', '}}')
-    else:
-        print(f"DEBUG: No steps detected in acceptance criteria. Content preview: {acceptance_criteria[:200] if acceptance_criteria else 'None'}")
-    guideline_map = {
-        "Positive": """
-**Positive Test Case Guidelines:**
-- Verify the core functionality works as expected under normal conditions.
-- **CRITICAL: Generate comprehensive positive test cases with NO LIMIT based on the user story requirements.**
-- **Cover ALL acceptance criteria:** Create separate positive test cases for EACH acceptance criterion. If there are 10 acceptance criteria, generate at least 10 positive test cases (one per criterion, plus additional test cases for variations and workflows).
-- **Cover ALL valid scenarios:** Generate test cases for ALL valid input scenarios from the data dictionary - create separate test cases for each valid field, valid combination, and valid workflow.
-- **Cover ALL successful workflows:** Include test cases for ALL successful workflows and happy paths described in the user story title, description, and acceptance criteria.
-- **Pagination (for lists):** Generate positive test cases for ALL pagination scenarios (first page, last page, middle pages, navigation controls, page size variations) - create separate test cases for each scenario.
-- **Boundary Values (for numeric fields):** Generate positive test cases for ALL valid boundary values (minimum, maximum, zero if allowed, just within limits) - create separate test cases for each boundary value.
-- **NO ARTIFICIAL LIMITS:** Do NOT limit the number of positive test cases. Generate as many test cases as needed to comprehensively cover:
-  * Every acceptance criterion (at least one test case per criterion, often more)
-  * Every valid input scenario from the data dictionary
-  * Every successful workflow and happy path
-  * Every valid combination of inputs that is meaningful
-  * Every valid boundary value for numeric fields
-  * Every pagination scenario for lists
-  * Every field in table-like or read-only detail/summary screens (one test case per field—see guideline 8)
-  * Every user-editable/input field (one test case per field for valid input—see guideline 9)
-- **Table/Field-based read-only screens:** If the story or images show a screen with a table or list of labeled fields (e.g. Policy Details with Policy Number, Status, Insurance Company, etc.) where data is read-only and retrieved from a source, create a **separate positive test case for each field** verifying that field's value is displayed/returned correctly according to context.
-- **User-editable/input fields:** If the story or images show a form or screen with fields the user can write in (e.g. email, phone, name, dropdowns, date pickers), create a **separate positive test case for each such input field** verifying that valid data can be entered and accepted/saved correctly for that field.
-- **Comprehensive Coverage Principle:** The goal is to ensure that every aspect of the user story (title, description, acceptance criteria) is covered by positive test cases. Generate enough test cases to provide complete coverage without any artificial constraints.
-- **Title Examples:** "[Positive] User successfully creates account with valid information", "[Positive] System saves data when all required fields are completed", "[Positive] Pagination controls work correctly when navigating to page 2", "[Positive] System accepts minimum value (0) for quantity field".""",
-        "Negative": """
-**Negative Test Case Guidelines:**
-- **CRITICAL: You MUST ALWAYS generate negative test cases, even for simple stories. Every user story has potential failure scenarios that need to be tested.**
-- Test scenarios where inputs are invalid, missing, or unexpected.
-- Create separate test cases for key types of invalid input - prioritize critical validation rules and common error scenarios.
-- Generate test cases for important invalid scenarios (missing required fields, wrong format, wrong type, out of range) - focus on high-impact validation failures.
-- Verify that appropriate error messages are displayed when failures occur - create test cases for critical error scenarios with expected error message in expectedResult.
-- Cover key validation rules with negative test cases - prioritize the most important validations rather than exhaustive coverage.
-- **If no explicit validation rules are mentioned in the story, generate negative test cases for common scenarios:**
-  * Missing required fields/inputs
-  * Invalid data formats (if applicable)
-  * Empty/null values where data is expected
-  * Invalid user actions or workflows
-  * System errors or failure conditions
-- **Boundary Value Violations (for numeric fields):** Generate negative test cases for critical invalid boundary values (below minimum, above maximum, negative if rejected) with expected error messages - prioritize important fields.
-- **Pagination Errors (for lists):** Generate negative test cases for key pagination failures (invalid page number, navigation beyond last page) with expected error messages - focus on common error scenarios.
-- **Generate 3-12 negative test cases** for most stories, focusing on critical validation rules and common error scenarios. **Minimum: Generate at least 3 negative test cases even for simple stories.**
-- **User-editable/input fields:** For forms or screens with input fields the user can write in, create **separate negative test cases per field** for validation failures (e.g. empty required field, invalid format, out of range), each with the expected error in expectedResult—see guideline 9.
-- **Title Examples:** "[Negative] System shows error when email field is empty", "[Negative] Application prevents login with invalid password format", "[Negative] System rejects value below minimum (-1) for age field", "[Negative] System handles invalid page number correctly".""",
-        "Edge Case": """
-**Edge Case & Boundary Guidelines:**
-- Test critical boundary conditions from the data dictionary (min/max values, just below min, just above max, etc.) - prioritize the most important boundaries and consolidate similar ones.
-- **Numeric Field Boundaries:** For numeric fields, generate test cases for the most critical boundaries: minimum/maximum values, just below/above limits, zero (if applicable), and negative values (if rejected). Prioritize fields that are most critical to the story's functionality - avoid generating separate test cases for every minor variation.
-- **Pagination Boundaries:** For lists/data displays, generate test cases for key scenarios: first/last pages, empty lists, single-page scenarios, and critical boundary conditions. Prioritize the most important pagination scenarios rather than exhaustive coverage.
-- Include critical scenarios with unexpected user behavior or timing - focus on the most impactful edge cases rather than every possible variation.
-- Test performance under important special circumstances (e.g., large data sets, slow networks) - prioritize scenarios most likely to occur or cause issues.
-- Cover the most critical edge cases for key input fields, workflows, and system states - focus on high-impact scenarios.
-- Generate test cases for unusual but possible scenarios that could cause significant issues - avoid minor edge cases that are unlikely to occur.
-- **Generate 5-15 edge case test cases** for most stories, prioritizing critical boundaries and high-impact scenarios over exhaustive coverage.
-- **Title Examples:** "[Edge Case] System handles maximum character limit in description field", "[Edge Case] Application maintains functionality during network interruption", "[Edge Case] System validates minimum value (0) for quantity field", "[Edge Case] Pagination works correctly when list contains exactly one page of items".""",
-        "Data Flow": """
-**Data Flow Guidelines:**
-- Verify how data moves through the system from input to storage and output - create test cases for key data flow paths, prioritizing critical workflows.
-- Track data through important workflows to verify integrity - generate test cases for the most critical complete workflows.
-- Test data persistence (saving) and retrieval (loading) - create test cases for key persistence scenarios, focusing on critical data operations.
-- Cover important data transformations, validations, and transfers - prioritize high-impact data flows rather than exhaustive coverage.
-- Generate test cases for data flow through key system components and modules - focus on critical integration points.
-- **Generate 2-8 data flow test cases** for most stories, focusing on critical data paths and important workflows.
-- **Title Examples:** "[Data Flow] User data persists correctly through complete registration workflow", "[Data Flow] System maintains data integrity when transferring between modules"."""
-    }
+    buffer = ''
+    pos = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    item_start = None
+    array_closed = False
+    for chunk in chunks:
+        if text_parts is not None:
+            text_parts.append(chunk)
+        if array_closed:
+            continue
+        buffer += chunk
+        while pos < len(buffer):
+            ch = buffer[pos]
+            if depth == 0:
+                # Skip any preamble (prose, ```json fence) until the array opens
+                if ch == '[':
+                    depth = 1
+            elif in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in '[{':
+                if depth == 1 and ch == '{':
+                    item_start = pos
+                depth += 1
+            elif ch in ']}':
+                depth -= 1
+                if depth == 1 and item_start is not None:
+                    try:
+                        yield orjson.loads(buffer[item_start:pos + 1])
+                    except json.JSONDecodeError:
+                        pass
+                    item_start = None
+                elif depth == 0:
+                    array_closed = True
+                    break
+            pos += 1
+        # Drop the already-scanned text, keeping any object that is still open
+        keep_from = item_start if item_start is not None else pos
+        buffer = buffer[keep_from:]
+        pos -= keep_from
+        if item_start is not None:
+            item_start = 0
+
+
+# Brackets and string openers while scanning for the end of a JSON array; strings are
+# skipped whole so brackets inside them don't count
+_JSON_ARRAY_TOKEN_RE = re.compile(r'[\[\]"]')
+_JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_json_array(text):
+    """Return the first JSON array in text (e.g. after a prose preamble), or None if none is closed
     
-    specific_guidelines = guideline_map.get(case_type, "- Follow standard best practices for this test type.")
-    related_block = ""
-    if related_stories and len(related_stories) > 0:
-        related_instruction = "When generating test cases, take into account not only the main user story but also the context and requirements described in the related user stories below."
-        related_block = f"\n**Instruction:** {related_instruction}\n**Related User Stories:**\n" + "\n".join([
-            f"- Title: {r.get('title', '')}\n  Description: {r.get('description', '')}\n  Acceptance Criteria: {r.get('acceptance_criteria', '')}" for r in related_stories
-        ])
-    # Build ambiguity-aware section conditionally
-    ambiguity_section = ""
-    if ambiguity_aware:
-        ambiguity_section = """
+    Well-formed output is decoded in one C pass with raw_decode; otherwise the first '[' is
+    matched to its closing ']' with a linear scan, so trailing text containing ']' is left out.
+    """
+    start = text.find('[')
+    if start == -1:
+        return None
+    try:
+        return text[start:_JSON_DECODER.raw_decode(text, start)[1]]
+    except ValueError:
+        pass
+    depth = 0
+    pos = start
+    while True:
+        token = _JSON_ARRAY_TOKEN_RE.search(text, pos)
+        if token is None:
+            return None
+        if token.group() == '"':
+            string_match = _JSON_STRING_RE.match(text, token.start())
+            if string_match is None:
+                return None  # Unterminated string: the response was cut off
+            pos = string_match.end()
+            continue
+        depth += 1 if token.group() == '[' else -1
+        if depth == 0:
+            return text[start:token.end()]
+        pos = token.end()
+
+
+def _strip_code_fence(text):
+    """Drop the opening ```lang line and, if present, the closing ``` line from stripped text"""
+    if not text.startswith('```'):
+        return text
+    # Slice rather than split into lines: responses can be many KB
+    first_newline = text.find('\n')
+    if first_newline == -1:
+        return ''
+    last_newline = text.rfind('\n')
+    body_end = last_newline if text[last_newline + 1:].strip() == '```' else len(text)
+    return text[first_newline + 1:body_end].strip()
+
+
+# Prompt pieces for _generate_cases_for_type(), formatted per case type.
+# Used when steps were detected in the acceptance criteria or description
+_PROVIDED_STEPS_SECTION_TEMPLATE = """
+**CRITICAL: USER-PROVIDED STEPS ARE THE MANDATORY BEGINNING — THEN ADD STEPS TO REACH THE EXPECTED RESULT:**
+The user has provided initial/setup steps. Every test case `description` MUST start with these steps exactly, then you MUST add further steps so the test case actually reaches and demonstrates the scenario in the title and expected result.
+
+1. **ALWAYS START WITH THE PROVIDED STEPS:** The steps in the box below MUST appear first in every test case description, in the same order and wording. Do not skip, reword, or reorder them.
+
+2. **THEN ADD STEPS TO COMPLETE THE SCENARIO:** After the provided steps, you MUST add additional steps that:
+   - Complete the specific scenario described in the test case **title** (e.g. for "[Negative] System prevents saving when end value is smaller than start value" add steps like: Select 'Multiple Values', create/enter a range with start and end values where end < start, attempt to save, then verify error).
+   - Lead to the **expected result** so a tester can follow the full sequence and verify the outcome.
+   - Are concrete actions (e.g. "Select 'Multiple Values'", "Enter start value 1000 and end value 2000 for first range", "For second range enter start 3000 and end 500", "Click Save or confirm", "Verify the system displays an error and does not save"). Do not add vague or category-only steps.
+
+3. **FORBIDDEN:** Do NOT add a separate list of "topic" or "category" steps (e.g. "Range Creation", "Validation Rules", "Editing Behavior" as standalone items). Do NOT prepend filter names, column names, or template section titles (e.g. "Policy Expiry Range", "Renewal Status") as standalone steps—only full imperative sentences belong in `description`. Only add concrete procedural steps that continue from the user's steps and lead to the expected result.
+
+4. **Numbering:** Number all steps in one sequence (1., 2., 3., ...). The provided steps keep their numbers; your added steps continue the numbering (e.g. if user provided 4 steps, your first added step is 5., then 6., etc.).
+
+5. **Steps provided by user (MUST appear first, then add more steps to reach the expected result):**
+{steps_text}
+
+**SUMMARY:** description = [user's steps above, unchanged] + [your added steps that complete the scenario and lead to the expected result for this test case]. Each test case must be executable end-to-end; the added steps are required so the tester can reach and verify the expected result.
+"""
+
+
+# Added to every case type prompt when ambiguity-aware generation is on
+_AMBIGUITY_SECTION = """
 **AMBIGUITY-AWARE TEST CASE GENERATION:**
 When generating test cases, pay special attention to any ambiguities, contradictions, or unclear requirements in the acceptance criteria. These ambiguities should inform your test case generation with comprehensive coverage:
 
@@ -934,35 +1378,27 @@ When generating test cases, pay special attention to any ambiguities, contradict
    - Generate test cases for security-critical ambiguities AND non-critical permission scenarios
    - Cover scenarios that could lead to unauthorized access AND scenarios that verify proper access control
 """
-    else:
-        ambiguity_section = ""
-    
-    # Build steps section if steps are detected in acceptance criteria
-    steps_section = ""
-    if has_steps:
-        steps_section = f"""
-**CRITICAL: USER-PROVIDED STEPS ARE THE MANDATORY BEGINNING — THEN ADD STEPS TO REACH THE EXPECTED RESULT:**
-The user has provided initial/setup steps. Every test case `description` MUST start with these steps exactly, then you MUST add further steps so the test case actually reaches and demonstrates the scenario in the title and expected result.
 
-1. **ALWAYS START WITH THE PROVIDED STEPS:** The steps in the box below MUST appear first in every test case description, in the same order and wording. Do not skip, reword, or reorder them.
 
-2. **THEN ADD STEPS TO COMPLETE THE SCENARIO:** After the provided steps, you MUST add additional steps that:
-   - Complete the specific scenario described in the test case **title** (e.g. for "[Negative] System prevents saving when end value is smaller than start value" add steps like: Select 'Multiple Values', create/enter a range with start and end values where end < start, attempt to save, then verify error).
-   - Lead to the **expected result** so a tester can follow the full sequence and verify the outcome.
-   - Are concrete actions (e.g. "Select 'Multiple Values'", "Enter start value 1000 and end value 2000 for first range", "For second range enter start 3000 and end 500", "Click Save or confirm", "Verify the system displays an error and does not save"). Do not add vague or category-only steps.
+# Wording in acceptance criteria that suggests ambiguity, contradictions or vague requirements.
+# _AMBIGUITY_SECTION is a large part of every prompt, so it is only added when the story has
+# one of these signals (?force_ambiguity=1 on /generate_test_cases always adds it).
+_AMBIGUITY_SIGNAL_RE = re.compile(
+    r'\b(?:no need|not (?:needed|required)|however|although|though|unless|except|'
+    r'vague|unclear|tbd|tba|tbc|maybe|possibly|perhaps|optional(?:ly)?|and/or|etc|fixme|todo|'
+    r'contradict\w*|quickly|appropriate(?:ly)?|user[- ]friendly|reasonable|as needed|if possible)\b'
+    r'|\?',
+    re.IGNORECASE
+)
 
-3. **FORBIDDEN:** Do NOT add a separate list of "topic" or "category" steps (e.g. "Range Creation", "Validation Rules", "Editing Behavior" as standalone items). Do NOT prepend filter names, column names, or template section titles (e.g. "Policy Expiry Range", "Renewal Status") as standalone steps—only full imperative sentences belong in `description`. Only add concrete procedural steps that continue from the user's steps and lead to the expected result.
 
-4. **Numbering:** Number all steps in one sequence (1., 2., 3., ...). The provided steps keep their numbers; your added steps continue the numbering (e.g. if user provided 4 steps, your first added step is 5., then 6., etc.).
+def _has_ambiguity_signals(acceptance_criteria):
+    """Whether acceptance_criteria contains wording that _AMBIGUITY_SECTION should be applied to"""
+    return bool(acceptance_criteria) and _AMBIGUITY_SIGNAL_RE.search(acceptance_criteria) is not None
 
-5. **Steps provided by user (MUST appear first, then add more steps to reach the expected result):**
-{steps_text_escaped}
 
-**SUMMARY:** description = [user's steps above, unchanged] + [your added steps that complete the scenario and lead to the expected result for this test case]. Each test case must be executable end-to-end; the added steps are required so the tester can reach and verify the expected result.
-"""
-    else:
-        # No steps provided by user: generate steps according to each test case title and context
-        steps_section = f"""
+# Used when the story provides no steps of its own
+_GENERATED_STEPS_SECTION_TEMPLATE = """
 **GENERATE STEPS ACCORDING TO EACH TEST CASE TITLE AND CONTEXT:**
 The user has not provided explicit steps. You MUST generate appropriate steps for each test case. The steps in the `description` field must be **specific to that test case** and aligned with its **title** and **type** ({case_type}).
 
@@ -981,7 +1417,9 @@ The user has not provided explicit steps. You MUST generate appropriate steps fo
 5. **Consistency:** The `description` (steps) and `expectedResult` must align with the test case `title`. A reader should see the title and then the steps and understand exactly what is being tested.
 """
 
-    prompt = f"""
+
+# Full prompt for one case type
+_CASES_PROMPT_TEMPLATE = """
 You are an expert test case generator for Azure DevOps with a focus on comprehensive test coverage. Your task is to generate a JSON array of ONLY the **{case_type}** test cases for the user story below.
 
 **User Story Details:**
@@ -1099,64 +1537,10 @@ Now, generate ONLY the `{case_type}` test cases based on all these instructions.
 
 **CRITICAL: You MUST return ONLY a valid JSON array. Do not include any explanatory text, markdown formatting, or code blocks. Return ONLY the JSON array starting with [ and ending with ].**
 """
-    try:
-        # Use the helper function to call the appropriate AI provider
-        response_text = call_ai_provider(
-            ai_provider, 
-            prompt, 
-            images if images and len(images) > 0 else None,
-            gemini_api_key=gemini_api_key,
-            claude_api_key=claude_api_key
-        )
-        
-        provider_name = "Gemini" if ai_provider != 'claude' else "Claude"
-        print(f"DEBUG: Raw {provider_name} response for {case_type} (length: {len(response_text)}):\n{response_text[:500]}...\n--- End Response Preview ---\n")
-        
-        if not response_text or len(response_text.strip()) == 0:
-            print(f"ERROR: Empty response from {provider_name} for {case_type}")
-            return "[]"
-        
-        # Clean the response to get a clean JSON array string
-        # Remove markdown code blocks
-        clean_json_text = response_text.strip()
-        
-        # Remove markdown code block markers
-        if clean_json_text.startswith('```'):
-            # Find the first newline after ```
-            lines = clean_json_text.split('\n')
-            if lines[0].startswith('```'):
-                # Remove first line (```json or ```)
-                lines = lines[1:]
-            # Remove last line if it's just ```
-            if lines and lines[-1].strip() == '```':
-                lines = lines[:-1]
-            clean_json_text = '\n'.join(lines).strip()
-        
-        # Try to find JSON array in the response
-        # Look for array pattern: [ ... ]
-        json_match = re.search(r'\[.*\]', clean_json_text, re.DOTALL)
-        if json_match:
-            clean_json_text = json_match.group(0)
-            print(f"DEBUG: Extracted JSON array from {provider_name} response (length: {len(clean_json_text)})")
-        else:
-            print(f"WARNING: No JSON array found in {provider_name} response. Full response:\n{clean_json_text[:1000]}")
-            # Try to parse as-is anyway
-            pass
-        
-        # Validate JSON before returning
-        try:
-            test_parse = json.loads(clean_json_text)
-            if not isinstance(test_parse, list):
-                print(f"ERROR: {provider_name} response is not a JSON array. Type: {type(test_parse)}")
-                return "[]"
-            if len(test_parse) == 0:
-                print(f"WARNING: {provider_name} returned empty array for {case_type}")
-                print(f"DEBUG: Full response was: {clean_json_text[:1000]}")
-                # For negative test cases, try to generate fallback cases if empty
-                if case_type == "Negative":
-                    print(f"WARNING: Empty negative test cases detected. Attempting fallback generation...")
-                    # Create a more explicit prompt for negative cases
-                    fallback_prompt = f"""
+
+
+# Retry prompt when the Negative pass comes back empty
+_NEGATIVE_FALLBACK_PROMPT_TEMPLATE = """
 You are generating negative test cases for a user story. The previous attempt returned an empty array, which is not acceptable.
 
 **User Story:**
@@ -1184,82 +1568,321 @@ Return ONLY a JSON array with at least 3 negative test cases following this form
 
 Return ONLY the JSON array, no other text.
 """
-                    try:
-                        fallback_response = call_ai_provider(
-                            ai_provider,
-                            fallback_prompt,
-                            images if images and len(images) > 0 else None,
-                            gemini_api_key=gemini_api_key,
-                            claude_api_key=claude_api_key
-                        )
-                        # Clean and parse fallback response
-                        fallback_clean = fallback_response.strip()
-                        if fallback_clean.startswith('```'):
-                            lines = fallback_clean.split('\n')
-                            if lines[0].startswith('```'):
-                                lines = lines[1:]
-                            if lines and lines[-1].strip() == '```':
-                                lines = lines[:-1]
-                            fallback_clean = '\n'.join(lines).strip()
-                        
-                        json_match = re.search(r'\[.*\]', fallback_clean, re.DOTALL)
-                        if json_match:
-                            fallback_clean = json_match.group(0)
-                        
-                        fallback_parse = json.loads(fallback_clean)
-                        if isinstance(fallback_parse, list) and len(fallback_parse) > 0:
-                            print(f"SUCCESS: Fallback generated {len(fallback_parse)} negative test cases")
-                            return json.dumps(fallback_parse)
-                        else:
-                            print(f"WARNING: Fallback also returned empty array")
-                    except Exception as fallback_err:
-                        print(f"ERROR: Fallback generation failed: {fallback_err}")
-            else:
-                print(f"DEBUG: Successfully parsed {len(test_parse)} test cases from {provider_name} for {case_type}")
-        except json.JSONDecodeError as json_err:
-            print(f"ERROR: Invalid JSON from {provider_name} for {case_type}: {json_err}")
-            print(f"DEBUG: JSON error position: {getattr(json_err, 'pos', 'unknown')}")
-            print(f"DEBUG: Attempted to parse (first 500 chars): {clean_json_text[:500]}...")
-            print(f"DEBUG: Attempted to parse (last 500 chars): ...{clean_json_text[-500:]}")
-            
-            # Try to fix incomplete JSON array (might be truncated)
-            if clean_json_text.strip().startswith('[') and not clean_json_text.strip().endswith(']'):
-                print(f"WARNING: JSON array appears incomplete (starts with [ but doesn't end with ]). Response may have been truncated.")
-                # Try to extract valid JSON objects before the truncation
-                try:
-                    # Find the last complete JSON object
-                    last_comma = clean_json_text.rfind(',')
-                    if last_comma > 0:
-                        # Try to close the array
-                        potential_json = clean_json_text[:last_comma] + ']'
-                        test_parse = json.loads(potential_json)
-                        if isinstance(test_parse, list) and len(test_parse) > 0:
-                            print(f"WARNING: Recovered {len(test_parse)} test cases from truncated response")
-                            return json.dumps(test_parse)
-                except:
-                    pass
-            
-            return "[]"
-        
-        return clean_json_text
+
+
+# Type-specific guidance dropped into _CASES_PROMPT_TEMPLATE
+_GUIDELINE_MAP = {
+    "Positive": """
+**Positive Test Case Guidelines:**
+- Verify the core functionality works as expected under normal conditions.
+- **CRITICAL: Generate comprehensive positive test cases with NO LIMIT based on the user story requirements.**
+- **Cover ALL acceptance criteria:** Create separate positive test cases for EACH acceptance criterion. If there are 10 acceptance criteria, generate at least 10 positive test cases (one per criterion, plus additional test cases for variations and workflows).
+- **Cover ALL valid scenarios:** Generate test cases for ALL valid input scenarios from the data dictionary - create separate test cases for each valid field, valid combination, and valid workflow.
+- **Cover ALL successful workflows:** Include test cases for ALL successful workflows and happy paths described in the user story title, description, and acceptance criteria.
+- **Pagination (for lists):** Generate positive test cases for ALL pagination scenarios (first page, last page, middle pages, navigation controls, page size variations) - create separate test cases for each scenario.
+- **Boundary Values (for numeric fields):** Generate positive test cases for ALL valid boundary values (minimum, maximum, zero if allowed, just within limits) - create separate test cases for each boundary value.
+- **NO ARTIFICIAL LIMITS:** Do NOT limit the number of positive test cases. Generate as many test cases as needed to comprehensively cover:
+  * Every acceptance criterion (at least one test case per criterion, often more)
+  * Every valid input scenario from the data dictionary
+  * Every successful workflow and happy path
+  * Every valid combination of inputs that is meaningful
+  * Every valid boundary value for numeric fields
+  * Every pagination scenario for lists
+  * Every field in table-like or read-only detail/summary screens (one test case per field—see guideline 8)
+  * Every user-editable/input field (one test case per field for valid input—see guideline 9)
+- **Table/Field-based read-only screens:** If the story or images show a screen with a table or list of labeled fields (e.g. Policy Details with Policy Number, Status, Insurance Company, etc.) where data is read-only and retrieved from a source, create a **separate positive test case for each field** verifying that field's value is displayed/returned correctly according to context.
+- **User-editable/input fields:** If the story or images show a form or screen with fields the user can write in (e.g. email, phone, name, dropdowns, date pickers), create a **separate positive test case for each such input field** verifying that valid data can be entered and accepted/saved correctly for that field.
+- **Comprehensive Coverage Principle:** The goal is to ensure that every aspect of the user story (title, description, acceptance criteria) is covered by positive test cases. Generate enough test cases to provide complete coverage without any artificial constraints.
+- **Title Examples:** "[Positive] User successfully creates account with valid information", "[Positive] System saves data when all required fields are completed", "[Positive] Pagination controls work correctly when navigating to page 2", "[Positive] System accepts minimum value (0) for quantity field".""",
+    "Negative": """
+**Negative Test Case Guidelines:**
+- **CRITICAL: You MUST ALWAYS generate negative test cases, even for simple stories. Every user story has potential failure scenarios that need to be tested.**
+- Test scenarios where inputs are invalid, missing, or unexpected.
+- Create separate test cases for key types of invalid input - prioritize critical validation rules and common error scenarios.
+- Generate test cases for important invalid scenarios (missing required fields, wrong format, wrong type, out of range) - focus on high-impact validation failures.
+- Verify that appropriate error messages are displayed when failures occur - create test cases for critical error scenarios with expected error message in expectedResult.
+- Cover key validation rules with negative test cases - prioritize the most important validations rather than exhaustive coverage.
+- **If no explicit validation rules are mentioned in the story, generate negative test cases for common scenarios:**
+  * Missing required fields/inputs
+  * Invalid data formats (if applicable)
+  * Empty/null values where data is expected
+  * Invalid user actions or workflows
+  * System errors or failure conditions
+- **Boundary Value Violations (for numeric fields):** Generate negative test cases for critical invalid boundary values (below minimum, above maximum, negative if rejected) with expected error messages - prioritize important fields.
+- **Pagination Errors (for lists):** Generate negative test cases for key pagination failures (invalid page number, navigation beyond last page) with expected error messages - focus on common error scenarios.
+- **Generate 3-12 negative test cases** for most stories, focusing on critical validation rules and common error scenarios. **Minimum: Generate at least 3 negative test cases even for simple stories.**
+- **User-editable/input fields:** For forms or screens with input fields the user can write in, create **separate negative test cases per field** for validation failures (e.g. empty required field, invalid format, out of range), each with the expected error in expectedResult—see guideline 9.
+- **Title Examples:** "[Negative] System shows error when email field is empty", "[Negative] Application prevents login with invalid password format", "[Negative] System rejects value below minimum (-1) for age field", "[Negative] System handles invalid page number correctly".""",
+    "Edge Case": """
+**Edge Case & Boundary Guidelines:**
+- Test critical boundary conditions from the data dictionary (min/max values, just below min, just above max, etc.) - prioritize the most important boundaries and consolidate similar ones.
+- **Numeric Field Boundaries:** For numeric fields, generate test cases for the most critical boundaries: minimum/maximum values, just below/above limits, zero (if applicable), and negative values (if rejected). Prioritize fields that are most critical to the story's functionality - avoid generating separate test cases for every minor variation.
+- **Pagination Boundaries:** For lists/data displays, generate test cases for key scenarios: first/last pages, empty lists, single-page scenarios, and critical boundary conditions. Prioritize the most important pagination scenarios rather than exhaustive coverage.
+- Include critical scenarios with unexpected user behavior or timing - focus on the most impactful edge cases rather than every possible variation.
+- Test performance under important special circumstances (e.g., large data sets, slow networks) - prioritize scenarios most likely to occur or cause issues.
+- Cover the most critical edge cases for key input fields, workflows, and system states - focus on high-impact scenarios.
+- Generate test cases for unusual but possible scenarios that could cause significant issues - avoid minor edge cases that are unlikely to occur.
+- **Generate 5-15 edge case test cases** for most stories, prioritizing critical boundaries and high-impact scenarios over exhaustive coverage.
+- **Title Examples:** "[Edge Case] System handles maximum character limit in description field", "[Edge Case] Application maintains functionality during network interruption", "[Edge Case] System validates minimum value (0) for quantity field", "[Edge Case] Pagination works correctly when list contains exactly one page of items".""",
+    "Data Flow": """
+**Data Flow Guidelines:**
+- Verify how data moves through the system from input to storage and output - create test cases for key data flow paths, prioritizing critical workflows.
+- Track data through important workflows to verify integrity - generate test cases for the most critical complete workflows.
+- Test data persistence (saving) and retrieval (loading) - create test cases for key persistence scenarios, focusing on critical data operations.
+- Cover important data transformations, validations, and transfers - prioritize high-impact data flows rather than exhaustive coverage.
+- Generate test cases for data flow through key system components and modules - focus on critical integration points.
+- **Generate 2-8 data flow test cases** for most stories, focusing on critical data paths and important workflows.
+- **Title Examples:** "[Data Flow] User data persists correctly through complete registration workflow", "[Data Flow] System maintains data integrity when transferring between modules"."""
+}
+
+
+def _generate_cases_for_type(ai_provider, story_title, story_description, acceptance_criteria, data_dictionary, case_type, related_stories=None, images=None, ambiguity_aware=True, gemini_api_key=None, claude_api_key=None):
+    """Generate test cases for a specific type, optionally including images
+    
+    Yields each test case dict as soon as the AI provider has streamed it completely.
+    
+    Args:
+        ai_provider: AI provider to use ('gemini' or 'claude')
+        story_title: Title of the user story
+        story_description: Description of the user story
+        acceptance_criteria: Acceptance criteria text
+        data_dictionary: Data dictionary text
+        case_type: Type of test cases to generate ('Positive', 'Negative', 'Edge Case', 'Data Flow')
+        related_stories: List of related user stories
+        images: List of PIL Image objects
+        ambiguity_aware: If True, include ambiguity-aware test case generation (default: True)
+        gemini_api_key: Optional Gemini API key (falls back to .env if not provided)
+        claude_api_key: Optional Claude API key (falls back to .env if not provided)
+    """
+    ai_provider = ai_provider.lower() if ai_provider else 'gemini'
+    log.debug("_generate_cases_for_type called for %s using %s. related_stories: %s", case_type, ai_provider, related_stories)
+    log.debug("Ambiguity-aware generation: %s", ambiguity_aware)
+    if images:
+        log.debug("Including %s images in test case generation", len(images))
+    
+    # Detect steps in acceptance criteria, or in story description if none in acceptance criteria
+    has_steps, steps_text = _detect_steps_in_acceptance_criteria(acceptance_criteria)
+    if not has_steps and story_description:
+        has_steps, steps_text = _detect_steps_in_acceptance_criteria(story_description)
+        if has_steps:
+            description_step_count = steps_text.count('\n') + 1
+            log.debug("Detected steps in story description (none in acceptance criteria). Steps found: %s", description_step_count)
+    steps_text_escaped = ""
+    if has_steps:
+        step_count = steps_text.count('\n') + 1
+        log.debug("Detected steps in acceptance criteria/description. Steps found: %s", step_count)
+        log.debug("Steps content (first 500 chars): %.500s", steps_text)
+        # Escape the steps text for use in f-string
+        steps_text_escaped = steps_text.replace('{', '{{').replace('}', '}}')
+    else:
+        log.debug("No steps detected in acceptance criteria. Content preview: %.200s", acceptance_criteria or 'None')
+    
+    specific_guidelines = _GUIDELINE_MAP.get(case_type, "- Follow standard best practices for this test type.")
+    related_block = ""
+    if related_stories and len(related_stories) > 0:
+        related_instruction = "When generating test cases, take into account not only the main user story but also the context and requirements described in the related user stories below."
+        related_block = f"\n**Instruction:** {related_instruction}\n**Related User Stories:**\n" + "\n".join([
+            f"- Title: {r.get('title', '')}\n  Description: {r.get('description', '')}\n  Acceptance Criteria: {r.get('acceptance_criteria', '')}" for r in related_stories
+        ])
+    # Build ambiguity-aware section conditionally
+    ambiguity_section = ""
+    if ambiguity_aware:
+        ambiguity_section = _AMBIGUITY_SECTION
+    else:
+        ambiguity_section = ""
+    
+    # Build steps section if steps are detected in acceptance criteria
+    steps_section = ""
+    if has_steps:
+        steps_section = _PROVIDED_STEPS_SECTION_TEMPLATE.format(steps_text=steps_text_escaped)
+    else:
+        # No steps provided by user: generate steps according to each test case title and context
+        steps_section = _GENERATED_STEPS_SECTION_TEMPLATE.format(case_type=case_type)
+
+    prompt = _CASES_PROMPT_TEMPLATE.format(
+        case_type=case_type,
+        story_title=story_title,
+        story_description=story_description,
+        acceptance_criteria=acceptance_criteria,
+        data_dictionary=data_dictionary,
+        related_block=related_block,
+        steps_section=steps_section,
+        ambiguity_section=ambiguity_section,
+        specific_guidelines=specific_guidelines
+    )
+    try:
+        # Stream the response so each test case reaches the client as soon as it is complete
+        response_parts = []
+        response_chunks = call_ai_provider(
+            ai_provider,
+            prompt,
+            images if images and len(images) > 0 else None,
+            gemini_api_key=gemini_api_key,
+            claude_api_key=claude_api_key,
+            stream=True
+        )
+        streamed_count = 0
+        for test_case in _iter_json_array_items(response_chunks, response_parts):
+            streamed_count += 1
+            yield test_case
+        if streamed_count:
+            log.debug("Streamed %s %s test cases", streamed_count, case_type)
+            return
+
+        # Nothing usable was streamed (empty array, prose, truncated output):
+        # run the buffered clean-up and recovery path on the full response
+        response_text = ''.join(response_parts)
+        yield from _parse_cases_response(
+            response_text, ai_provider, case_type, story_title, story_description, acceptance_criteria,
+            images, gemini_api_key=gemini_api_key, claude_api_key=claude_api_key
+        )
     except ValueError as ve:
         # Re-raise ValueError (these are user-friendly error messages)
-        import traceback
-        print(f"ERROR generating {case_type} cases: {ve}")
-        traceback.print_exc()
+        log.exception("ERROR generating %s cases: %s", case_type, ve)
         raise  # Re-raise to be caught by the streaming endpoint
     except Exception as e:
-        import traceback
         error_msg = str(e)
-        print(f"ERROR generating {case_type} cases: {error_msg}")
-        traceback.print_exc()
-        # Return empty array but log the error for debugging
-        return "[]"
+        log.exception("ERROR generating %s cases: %s", case_type, error_msg)
+        # Yield nothing but log the error for debugging
+        return
+
+
+def _parse_cases_response(response_text, ai_provider, case_type, story_title, story_description, acceptance_criteria, images=None, gemini_api_key=None, claude_api_key=None):
+    """Clean a full AI response into a list of test cases
+
+    Strips markdown fences, recovers truncated arrays and retries an empty Negative
+    result with a fallback prompt. Returns [] when nothing usable was produced.
+    """
+    provider_name = "Gemini" if ai_provider != 'claude' else "Claude"
+    log.debug("Raw %s response for %s (length: %s):\n%.500s...\n--- End Response Preview ---\n", provider_name, case_type, len(response_text), response_text)
+    
+    if not response_text or len(response_text.strip()) == 0:
+        log.error("Empty response from %s for %s", provider_name, case_type)
+        return []
+    
+    # Clean the response to get a clean JSON array string
+    # Remove markdown code blocks
+    clean_json_text = response_text.strip()
+    
+    # Remove markdown code block markers
+    clean_json_text = _strip_code_fence(clean_json_text)
+    
+    # Well-behaved responses are only the array, so parse as-is before searching for one
+    try:
+        test_parse = orjson.loads(clean_json_text)
+    except json.JSONDecodeError:
+        test_parse = None
+    
+    # Validate JSON before returning
+    try:
+        if not isinstance(test_parse, list):
+            # Try to find JSON array in the response (after a preamble, inside an object, ...)
+            json_array = _extract_json_array(clean_json_text)
+            if json_array:
+                clean_json_text = json_array
+                log.debug("Extracted JSON array from %s response (length: %s)", provider_name, len(clean_json_text))
+            else:
+                log.warning("No JSON array found in %s response. Full response:\n%.1000s", provider_name, clean_json_text)
+                # Try to parse as-is anyway
+            test_parse = orjson.loads(clean_json_text)
+        if not isinstance(test_parse, list):
+            log.error("%s response is not a JSON array. Type: %s", provider_name, type(test_parse))
+            return []
+        if len(test_parse) == 0:
+            log.warning("%s returned empty array for %s", provider_name, case_type)
+            log.debug("Full response was: %.1000s", clean_json_text)
+            # For negative test cases, try to generate fallback cases if empty
+            if case_type == "Negative":
+                log.warning("Empty negative test cases detected. Attempting fallback generation...")
+                # Create a more explicit prompt for negative cases
+                fallback_prompt = _NEGATIVE_FALLBACK_PROMPT_TEMPLATE.format(
+                    story_title=story_title,
+                    story_description=story_description,
+                    acceptance_criteria=acceptance_criteria
+                )
+                try:
+                    fallback_response = call_ai_provider(
+                        ai_provider,
+                        fallback_prompt,
+                        images if images and len(images) > 0 else None,
+                        gemini_api_key=gemini_api_key,
+                        claude_api_key=claude_api_key
+                    )
+                    # Clean and parse fallback response
+                    fallback_clean = _strip_code_fence(fallback_response.strip())
+                    
+                    try:
+                        fallback_parse = orjson.loads(fallback_clean)
+                    except json.JSONDecodeError:
+                        fallback_parse = None
+                    if not isinstance(fallback_parse, list):
+                        json_array = _extract_json_array(fallback_clean)
+                        if json_array:
+                            fallback_clean = json_array
+                        fallback_parse = orjson.loads(fallback_clean)
+                    if isinstance(fallback_parse, list) and len(fallback_parse) > 0:
+                        log.info("SUCCESS: Fallback generated %s negative test cases", len(fallback_parse))
+                        return fallback_parse
+                    else:
+                        log.warning("Fallback also returned empty array")
+                except Exception as fallback_err:
+                    log.error("Fallback generation failed: %s", fallback_err)
+        else:
+            log.debug("Successfully parsed %s test cases from %s for %s", len(test_parse), provider_name, case_type)
+    except json.JSONDecodeError as json_err:
+        log.error("Invalid JSON from %s for %s: %s", provider_name, case_type, json_err)
+        log.debug("JSON error position: %s", getattr(json_err, 'pos', 'unknown'))
+        log.debug("Attempted to parse (first 500 chars): %.500s...", clean_json_text)
+        log.debug("Attempted to parse (last 500 chars): ...%s", clean_json_text[-500:])
+        
+        # Try to fix incomplete JSON array (might be truncated)
+        if clean_json_text.strip().startswith('[') and not clean_json_text.strip().endswith(']'):
+            log.warning("JSON array appears incomplete (starts with [ but doesn't end with ]). Response may have been truncated.")
+            # Try to extract valid JSON objects before the truncation
+            try:
+                # Find the last complete JSON object
+                last_comma = clean_json_text.rfind(',')
+                if last_comma > 0:
+                    # Try to close the array
+                    potential_json = clean_json_text[:last_comma] + ']'
+                    test_parse = orjson.loads(potential_json)
+                    if isinstance(test_parse, list) and len(test_parse) > 0:
+                        log.warning("Recovered %s test cases from truncated response", len(test_parse))
+                        return test_parse
+            except:
+                pass
+        
+        return []
+    
+    return test_parse
+
+# Substrings of a ValueError message that should stop the remaining case types
+_CRITICAL_ERROR_KEYWORDS = ('authentication', 'rate limit', 'quota')
+
+
+def _sse_frame(payload):
+    """Encode a payload as a UTF-8 Server-Sent Events ``data:`` frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# Closing frames of the test case stream, encoded once
+_SSE_DONE_OK = _sse_frame({"type": "done", "message": "All test cases generated."})
+_SSE_DONE_FAIL = _sse_frame({"type": "done", "message": "Generation failed."})
+_SSE_DONE_CRITICAL = _sse_frame({"type": "done", "message": "Generation stopped due to critical error."})
+
+
+
+def _gzip_event_stream(frames):
+    """Gzip a stream of SSE frames, flushing after each one so the client still gets it straight away"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for frame in frames:
+        yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
 
 @app.route('/generate_test_cases', methods=['POST', 'GET'])
 def generate_test_cases_stream():
     """Generate test cases with streaming support - supports both GET (legacy) and POST (for large payloads)"""
-    print("DEBUG: /generate_test_cases endpoint called.")
+    log.debug("/generate_test_cases endpoint called.")
     
     try:
         # Support both GET (legacy) and POST (for large payloads with images)
@@ -1285,7 +1908,7 @@ def generate_test_cases_stream():
         acceptance_criteria = data.get('acceptance_criteria')
         data_dictionary = data.get('data_dictionary', '')
         related_stories = data.get('related_stories', [])
-        ai_provider = data.get('ai_provider', 'gemini')  # Default to Gemini
+        ai_provider = data.get('ai_provider') or 'gemini'  # Default to Gemini (also when sent as null)
         ambiguity_aware = data.get('ambiguity_aware', True)  # Default to True for backward compatibility
         if isinstance(ambiguity_aware, str):
             ambiguity_aware = ambiguity_aware.lower() in ('true', '1', 'yes', 'on')
@@ -1294,50 +1917,53 @@ def generate_test_cases_stream():
         gemini_api_key = data.get('gemini_api_key', '').strip() or None
         claude_api_key = data.get('claude_api_key', '').strip() or None
 
-        print("DEBUG: related_stories received in endpoint:", related_stories)
-        print(f"DEBUG: AI Provider: {ai_provider}")
-        print(f"DEBUG: Ambiguity-aware generation: {ambiguity_aware}")
-        print(f"DEBUG: API keys provided via UI - Gemini: {'Yes' if gemini_api_key else 'No'}, Claude: {'Yes' if claude_api_key else 'No'}")
+        log.debug("related_stories received in endpoint: %s", related_stories)
+        log.debug("AI Provider: %s", ai_provider)
+        log.debug("Ambiguity-aware generation: %s", ambiguity_aware)
+        log.debug("API keys provided via UI - Gemini: %s, Claude: %s", 'Yes' if gemini_api_key else 'No', 'Yes' if claude_api_key else 'No')
 
         if not all([story_title, acceptance_criteria]):
             return Response("Story Title and Acceptance Criteria are required.", status=400)
 
         # Extract images and text from HTML fields
-        desc_images, desc_text = extract_images_from_html(story_description)
-        ac_images, ac_text = extract_images_from_html(acceptance_criteria)
-        dict_images, dict_text = extract_images_from_html(data_dictionary)
+        # One cache for the whole request so repeated screenshots are decoded and sent once
+        extract_images = partial(extract_images_from_html_cached, image_cache={})
+        (desc_images, desc_text), (ac_images, ac_text), (dict_images, dict_text) = _HTML_EXTRACT_EXECUTOR.map(
+            extract_images, (story_description, acceptance_criteria, data_dictionary)
+        )
         
         # Process related stories to extract images and tables
         related_stories_processed = []
         related_images = []
         if related_stories:
-            print(f"DEBUG: Processing {len(related_stories)} related stories")
+            log.debug("Processing %s related stories", len(related_stories))
             for idx, related_story in enumerate(related_stories):
                 related_desc = related_story.get('description', '')
                 related_ac = related_story.get('acceptance_criteria', '')
                 
-                print(f"DEBUG: Related story {idx+1} - Description length: {len(related_desc)}, AC length: {len(related_ac)}")
-                print(f"DEBUG: Related story {idx+1} - Description preview (first 200 chars): {related_desc[:200] if related_desc else 'EMPTY'}")
-                print(f"DEBUG: Related story {idx+1} - AC preview (first 200 chars): {related_ac[:200] if related_ac else 'EMPTY'}")
+                log.debug("Related story %s - Description length: %s, AC length: %s", idx + 1, len(related_desc), len(related_ac))
+                log.debug("Related story %s - Description preview (first 200 chars): %.200s", idx + 1, related_desc or 'EMPTY')
+                log.debug("Related story %s - AC preview (first 200 chars): %.200s", idx + 1, related_ac or 'EMPTY')
                 
                 # Extract images and text (including tables) from related story HTML
-                rel_desc_images, rel_desc_text = extract_images_from_html(related_desc)
-                rel_ac_images, rel_ac_text = extract_images_from_html(related_ac)
+                (rel_desc_images, rel_desc_text), (rel_ac_images, rel_ac_text) = _HTML_EXTRACT_EXECUTOR.map(
+                    extract_images, (related_desc, related_ac)
+                )
                 
-                print(f"DEBUG: Related story {idx+1} - After extraction - Desc text length: {len(rel_desc_text)}, AC text length: {len(rel_ac_text)}")
-                if '[TABLE' in rel_desc_text or '[TABLE' in rel_ac_text:
-                    print(f"DEBUG: Related story {idx+1} - TABLES DETECTED in extracted text!")
+                log.debug("Related story %s - After extraction - Desc text length: %s, AC text length: %s", idx + 1, len(rel_desc_text), len(rel_ac_text))
+                if log.isEnabledFor(logging.DEBUG) and ('[TABLE' in rel_desc_text or '[TABLE' in rel_ac_text):
+                    log.debug("Related story %s - TABLES DETECTED in extracted text!", idx + 1)
                     # Show table sections for debugging
                     if '[TABLE' in rel_desc_text:
                         table_start = rel_desc_text.find('[TABLE')
                         table_end = rel_desc_text.find('TABLE END]', table_start) + 10
                         if table_end > table_start:
-                            print(f"DEBUG: Related story {idx+1} - Table in description: {rel_desc_text[table_start:min(table_end+50, len(rel_desc_text))]}")
+                            log.debug("Related story %s - Table in description: %s", idx + 1, rel_desc_text[table_start:min(table_end + 50, len(rel_desc_text))])
                     if '[TABLE' in rel_ac_text:
                         table_start = rel_ac_text.find('[TABLE')
                         table_end = rel_ac_text.find('TABLE END]', table_start) + 10
                         if table_end > table_start:
-                            print(f"DEBUG: Related story {idx+1} - Table in AC: {rel_ac_text[table_start:min(table_end+50, len(rel_ac_text))]}")
+                            log.debug("Related story %s - Table in AC: %s", idx + 1, rel_ac_text[table_start:min(table_end + 50, len(rel_ac_text))])
                 
                 # Collect images from related stories
                 related_images.extend(rel_desc_images)
@@ -1351,130 +1977,157 @@ def generate_test_cases_stream():
                 })
         
         # Debug: Check if steps are detected in acceptance criteria (after HTML extraction)
-        has_steps_debug, steps_text_debug = _detect_steps_in_acceptance_criteria(ac_text)
-        print(f"DEBUG: Acceptance criteria text length: {len(ac_text) if ac_text else 0}")
-        print(f"DEBUG: Steps detected in acceptance criteria: {has_steps_debug}")
-        if has_steps_debug:
-            print(f"DEBUG: Detected steps preview: {steps_text_debug[:300]}")
-        else:
-            print(f"DEBUG: No steps detected. AC preview: {ac_text[:300] if ac_text else 'None'}")
+        if log.isEnabledFor(logging.DEBUG):
+            has_steps_debug, steps_text_debug = _detect_steps_in_acceptance_criteria(ac_text)
+            log.debug("Acceptance criteria text length: %s", len(ac_text) if ac_text else 0)
+            log.debug("Steps detected in acceptance criteria: %s", has_steps_debug)
+            if has_steps_debug:
+                log.debug("Detected steps preview: %.300s", steps_text_debug)
+            else:
+                log.debug("No steps detected. AC preview: %.300s", ac_text or 'None')
+        
+        # Only spend prompt tokens on ambiguity coverage when the acceptance criteria show signs of it
+        if ambiguity_aware and request.args.get('force_ambiguity') != '1' and not _has_ambiguity_signals(ac_text):
+            log.debug("No ambiguity signals in acceptance criteria; leaving out the ambiguity-aware section")
+            ambiguity_aware = False
         
-        # Collect all images (main story + related stories)
-        all_images = desc_images + ac_images + dict_images + related_images
-        print(f"DEBUG: Found {len(all_images)} images for test case generation ({len(desc_images + ac_images + dict_images)} from main story, {len(related_images)} from related stories)")
+        # Collect all images (main story + related stories), sending a screenshot pasted into several fields only once
+        main_images = _unique_images(desc_images + ac_images + dict_images)
+        all_images = _unique_images(main_images + related_images)
+        log.debug("Found %s images for test case generation (%s from main story, %s from related stories, %s duplicates dropped)", len(all_images), len(main_images), len(all_images) - len(main_images), len(desc_images + ac_images + dict_images + related_images) - len(all_images))
+        
+        # Reject stories too large for the provider before sending four requests that can't succeed
+        provider = 'claude' if ai_provider.lower() == 'claude' else 'gemini'
+        estimated_tokens = _estimate_input_tokens(
+            [_CASES_PROMPT_TEMPLATE, _AMBIGUITY_SECTION if ambiguity_aware else '', story_title, desc_text, ac_text, dict_text]
+            + [text for related in related_stories_processed for text in related.values()],
+            len(all_images)
+        )
+        if estimated_tokens > _MAX_INPUT_TOKENS[provider]:
+            log.warning("Rejecting story of about %s tokens (%s limit: %s)", estimated_tokens, provider, _MAX_INPUT_TOKENS[provider])
+            return jsonify({
+                'error': 'Story is too large to generate test cases from',
+                'message': f"The story, data dictionary, related stories and images come to about {estimated_tokens} tokens; "
+                           f"the {provider.capitalize()} limit is {_MAX_INPUT_TOKENS[provider]}. Remove some content or images and try again."
+            }), 413
         
         def generate():
             try:
                 case_types = ["Positive", "Negative", "Edge Case", "Data Flow"]
-                all_test_cases = []
-
-                for case_type in case_types:
+                
+                # The case types are independent, so request them concurrently. Each worker
+                # streams its test cases into a shared queue as (case type, kind, value) and
+                # they are forwarded to the client in arrival order.
+                events = queue.Queue()
+                stop_requested = threading.Event()
+                
+                def run_case_type(case_type):
                     try:
-                        print(f"DEBUG: Calling _generate_cases_for_type for {case_type} with related_stories:", related_stories_processed)
-                        # Generate cases for the current type, including images
-                        json_text_chunk = _generate_cases_for_type(
+                        log.debug("Calling _generate_cases_for_type for %s with related_stories: %s", case_type, related_stories_processed)
+                        # Generate cases for the current type, including images, forwarding each
+                        # test case as soon as it has been streamed in full
+                        for test_case in _generate_cases_for_type(
                             ai_provider, story_title, desc_text, ac_text, dict_text, case_type, 
                             related_stories_processed, all_images, ambiguity_aware,
                             gemini_api_key=gemini_api_key,
                             claude_api_key=claude_api_key
-                        )
+                        ):
+                            if stop_requested.is_set():
+                                # Client went away or another type hit a critical error
+                                return
+                            events.put((case_type, 'case', _normalize_generated_test_case(test_case)))
+                        events.put((case_type, 'end', None))
+                    except Exception as case_error:
+                        events.put((case_type, 'error', case_error))
+                
+                executor = ThreadPoolExecutor(max_workers=len(case_types), thread_name_prefix='case-type')
+                try:
+                    for case_type in case_types:
+                        executor.submit(run_case_type, case_type)
+                    
+                    case_counts = dict.fromkeys(case_types, 0)
+                    pending = len(case_types)
+                    while pending:
+                        case_type, kind, value = events.get()
+                        if kind == 'case':
+                            case_counts[case_type] += 1
+                            yield _sse_frame({
+                                "type": case_type,
+                                "cases": [value],
+                                "progress": f"Generated {case_counts[case_type]} {case_type} cases..."
+                            })
+                            continue
                         
-                        # The API might return an empty or invalid string, so we validate it
-                        try:
-                            # Validate if it's proper JSON
-                            parsed_chunk = json.loads(json_text_chunk)
-                            if isinstance(parsed_chunk, list):
-                                if parsed_chunk:
-                                    for _tc in parsed_chunk:
-                                        _normalize_generated_test_case(_tc)
-                                    all_test_cases.extend(parsed_chunk)
-                                    # Stream the current progress back to the client
-                                    progress_data = {
-                                        "type": case_type,
-                                        "cases": parsed_chunk,
-                                        "progress": f"Generated {len(parsed_chunk)} {case_type} cases."
-                                    }
-                                    yield f"data: {json.dumps(progress_data)}\n\n"
-                                else:
-                                    print(f"WARNING: {case_type} returned empty array. Response was: {json_text_chunk[:200]}")
-                                    # Still send progress even if empty
-                                    progress_data = {
-                                        "type": case_type,
-                                        "cases": [],
-                                        "progress": f"No {case_type} cases generated."
-                                    }
-                                    yield f"data: {json.dumps(progress_data)}\n\n"
+                        pending -= 1
+                        if kind == 'end':
+                            if case_counts[case_type]:
+                                progress_data = {
+                                    "type": case_type,
+                                    "cases": [],
+                                    "progress": f"Generated {case_counts[case_type]} {case_type} cases."
+                                }
                             else:
-                                print(f"ERROR: Response for {case_type} is not a list. Type: {type(parsed_chunk)}")
-                                error_data = {
-                                    "type": "error",
-                                    "case_type": case_type,
-                                    "error": f"Response for {case_type} is not a JSON array",
-                                    "message": f"Expected list, got {type(parsed_chunk).__name__}"
+                                log.warning("%s returned no test cases", case_type)
+                                # Still send progress even if empty
+                                progress_data = {
+                                    "type": case_type,
+                                    "cases": [],
+                                    "progress": f"No {case_type} cases generated."
                                 }
-                                yield f"data: {json.dumps(error_data)}\n\n"
-                        except json.JSONDecodeError as json_err:
-                            print(f"ERROR: Could not decode JSON for {case_type} cases.")
-                            print(f"DEBUG: JSON Error: {json_err}")
-                            print(f"DEBUG: Response text (first 500 chars): {json_text_chunk[:500]}")
-                            # Send error to client
+                            yield _sse_frame(progress_data)
+                        elif isinstance(value, ValueError):
+                            # ValueError from call_ai_provider - these are user-friendly messages
+                            log.error("ERROR generating %s cases: %s", case_type, value, exc_info=value)
+                            # Send detailed error to client
                             error_data = {
                                 "type": "error",
                                 "case_type": case_type,
-                                "error": f"Failed to parse JSON response for {case_type} cases",
-                                "message": str(json_err)
+                                "error": f"Failed to generate {case_type} cases",
+                                "message": str(value),
+                                "is_critical": True  # Mark as critical so frontend can show it prominently
                             }
-                            yield f"data: {json.dumps(error_data)}\n\n"
-                            continue
-                    except ValueError as ve:
-                        # ValueError from call_ai_provider - these are user-friendly messages
-                        import traceback
-                        print(f"ERROR generating {case_type} cases: {ve}")
-                        traceback.print_exc()
-                        # Send detailed error to client
-                        error_data = {
-                            "type": "error",
-                            "case_type": case_type,
-                            "error": f"Failed to generate {case_type} cases",
-                            "message": str(ve),
-                            "is_critical": True  # Mark as critical so frontend can show it prominently
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        # For critical errors (auth, rate limit), stop processing
-                        if 'authentication' in str(ve).lower() or 'rate limit' in str(ve).lower() or 'quota' in str(ve).lower():
-                            yield "data: {\"type\": \"done\", \"message\": \"Generation stopped due to critical error.\"}\n\n"
-                            return
-                        continue
-                    except Exception as case_error:
-                        import traceback
-                        print(f"ERROR generating {case_type} cases: {case_error}")
-                        traceback.print_exc()
-                        # Send error to client but continue with other case types
-                        error_data = {
-                            "type": "error",
-                            "case_type": case_type,
-                            "error": f"Failed to generate {case_type} cases",
-                            "message": str(case_error)
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        continue
+                            yield _sse_frame(error_data)
+                            # For critical errors (auth, rate limit), stop processing
+                            ve_lower = str(value).lower()
+                            if any(keyword in ve_lower for keyword in _CRITICAL_ERROR_KEYWORDS):
+                                yield _SSE_DONE_CRITICAL
+                                return
+                        else:
+                            log.error("ERROR generating %s cases: %s", case_type, value, exc_info=value)
+                            # Send error to client but continue with other case types
+                            error_data = {
+                                "type": "error",
+                                "case_type": case_type,
+                                "error": f"Failed to generate {case_type} cases",
+                                "message": str(value)
+                            }
+                            yield _sse_frame(error_data)
+                finally:
+                    # Don't hold the response open for calls nobody will read
+                    stop_requested.set()
+                    executor.shutdown(wait=False)
                 
-                print("--- Finished generating all test cases. ---")
-                yield "data: {\"type\": \"done\", \"message\": \"All test cases generated.\"}\n\n"
+                log.info("--- Finished generating all test cases. ---")
+                yield _SSE_DONE_OK
             except Exception as gen_error:
-                import traceback
-                print(f"CRITICAL ERROR in generate() function: {gen_error}")
-                traceback.print_exc()
+                log.critical("Error in generate() function: %s", gen_error, exc_info=True)
                 # Send final error message
                 error_data = {
                     "type": "error",
                     "error": "Critical error during test case generation",
                     "message": str(gen_error)
                 }
-                yield f"data: {json.dumps(error_data)}\n\n"
-                yield "data: {\"type\": \"done\", \"message\": \"Generation failed.\"}\n\n"
+                yield _sse_frame(error_data)
+                yield _SSE_DONE_FAIL
 
-        response = Response(generate(), mimetype='text/event-stream')
+        # Test case JSON repeats the same keys and phrasing, so it compresses several times over
+        if request.accept_encodings.quality('gzip') > 0:
+            response = Response(_gzip_event_stream(generate()), mimetype='text/event-stream')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(generate(), mimetype='text/event-stream')
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.direct_passthrough = True  # Frames are already UTF-8 bytes
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
@@ -1483,9 +2136,7 @@ def generate_test_cases_stream():
         return response
         
     except Exception as e:
-        import traceback
-        print(f"CRITICAL ERROR in generate_test_cases_stream endpoint: {e}")
-        traceback.print_exc()
+        log.critical("Error in generate_test_cases_stream endpoint: %s", e, exc_info=True)
         # Return a proper error response instead of letting the connection reset
         error_response = jsonify({
             'error': 'Failed to initialize test case generation',
@@ -1498,7 +2149,7 @@ def generate_test_cases_stream():
 @app.route('/upload_test_cases', methods=['POST'])
 def upload_test_cases():
     data = request.json or {}
-    print(f"DEBUG: Upload test cases request received. Data keys: {list(data.keys())}")
+    log.debug("Upload test cases request received. Data keys: %s", list(data.keys()))
     
     test_plan_id = data.get('test_plan_id')
     test_suite_id = data.get('test_suite_id')
@@ -1507,11 +2158,11 @@ def upload_test_cases():
     azure_devops_project_name = data.get('azure_devops_project_name')
     azure_devops_pat = data.get('azure_devops_pat')
     
-    print(f"DEBUG: test_plan_id: {test_plan_id}, test_suite_id: {test_suite_id}")
-    print(f"DEBUG: azure_devops_org_url: {azure_devops_org_url[:50] if azure_devops_org_url else None}...")
-    print(f"DEBUG: azure_devops_project_name: {azure_devops_project_name}")
-    print(f"DEBUG: azure_devops_pat: {'***' if azure_devops_pat else None}")
-    print(f"DEBUG: test_cases_str length: {len(test_cases_str) if test_cases_str else 0}")
+    log.debug("test_plan_id: %s, test_suite_id: %s", test_plan_id, test_suite_id)
+    log.debug("azure_devops_org_url: %.50s...", azure_devops_org_url)
+    log.debug("azure_devops_project_name: %s", azure_devops_project_name)
+    log.debug("azure_devops_pat: %s", '***' if azure_devops_pat else None)
+    log.debug("test_cases_str length: %s", len(test_cases_str) if test_cases_str else 0)
 
     # Validate required fields and provide specific error messages
     # Check for None, empty string, or whitespace-only strings
@@ -1543,8 +2194,8 @@ def upload_test_cases():
         _normalize_generated_test_case(_tc)
 
     # De-duplicate test cases by normalized final title (after all processing)
-    unique_test_cases = []
-    seen_titles = set()
+    # Keyed by normalized title; dict insertion order keeps the first occurrence of each title
+    seen = {}
     for tc in test_cases:
         title_from_ai = (tc.get('title') or '').strip()
         # Remove test type prefixes if present
@@ -1568,16 +2219,15 @@ def upload_test_cases():
                 title_without_prefix = "Untitled Test Case"
         # Truncate if needed
         final_title_base = (title_without_prefix[:120] + '...') if len(title_without_prefix) > 120 else title_without_prefix
-        if not final_title_base.lower().startswith('verify'):
+        if final_title_base[:6].lower() != 'verify':
             final_title = "Verify " + final_title_base
         else:
             final_title = final_title_base
-        print(f"Final constructed title: {final_title}")
+        log.info("Final constructed title: %s", final_title)
         norm_title = normalize_title(final_title)
-        if norm_title and norm_title not in seen_titles:
+        if norm_title and seen.setdefault(norm_title, tc) is tc:
             tc['title'] = final_title
-            unique_test_cases.append(tc)
-            seen_titles.add(norm_title)
+    unique_test_cases = list(seen.values())
 
     try:
         credentials = BasicAuthentication('', azure_devops_pat or '')
@@ -1585,8 +2235,10 @@ def upload_test_cases():
         work_item_tracking_client = connection.get_client('azure.devops.v7_1.work_item_tracking.work_item_tracking_client.WorkItemTrackingClient')
         test_plan_client = connection.get_client('azure.devops.v7_1.test_plan.test_plan_client.TestPlanClient')
 
-        created_test_case_ids = []
-        for tc in unique_test_cases:
+        # Every iteration either fills its slot or raises, so the list is pre-sized
+        created_test_case_ids = [None] * len(unique_test_cases)
+        _esc = html.escape  # Local alias: escaped once or more per step below
+        for tc_index, tc in enumerate(unique_test_cases):
             final_title = tc.get('title', '').strip()
             description_raw = tc.get('description', '')
             expected_result_raw = tc.get('expectedResult', '')
@@ -1599,30 +2251,32 @@ def upload_test_cases():
                     try:
                         steps_list = ast.literal_eval(description_raw.strip())
                     except:
-                        steps_list = [s.strip() for s in description_raw.split('\n') if s.strip()]
+                        steps_list = [line for line in (s.strip() for s in description_raw.splitlines()) if line]
                 else:
-                    steps_list = [s.strip() for s in description_raw.split('\n') if s.strip()]
+                    steps_list = [line for line in (s.strip() for s in description_raw.splitlines()) if line]
             steps_list = [str(s) for s in steps_list if s]
             steps_xml_parts = []
             # Case 1: No description, but there is an expected result
             if not steps_list and expected_result_raw:
                 action_text = "Execute test steps"
-                expected_text = html.escape(str(expected_result_raw))
-                steps_xml_parts.append(
+                expected_text = _esc(expected_result_raw if isinstance(expected_result_raw, str) else str(expected_result_raw))
+                steps_xml_parts = [
                     "<step id='1' type='ActionStep'>"
                     f"<parameterizedString isformatted='true'>{action_text}</parameterizedString>"
                     f"<parameterizedString isformatted='true'>{expected_text}</parameterizedString>"
                     "</step>"
-                )
+                ]
             elif steps_list:
                 step_count = len(steps_list)
+                steps_xml_parts = [None] * step_count
                 for i, step_action in enumerate(steps_list, 1):
-                    cleaned_action = re.sub(r'^\s*\d+\.\s*', '', str(step_action)).strip()
-                    action_text = html.escape(cleaned_action)
+                    # steps_list only holds strings at this point, so no str() cast is needed
+                    cleaned_action = re.sub(r'^\s*\d+\.\s*', '', step_action).strip()
+                    action_text = _esc(cleaned_action)
                     expected_text_for_step = ""
                     if i == step_count and expected_result_raw:
-                        expected_text_for_step = html.escape(str(expected_result_raw))
-                    steps_xml_parts.append(
+                        expected_text_for_step = _esc(expected_result_raw if isinstance(expected_result_raw, str) else str(expected_result_raw))
+                    steps_xml_parts[i - 1] = (
                         f"<step id='{i}' type='ActionStep'>"
                         f"<parameterizedString isformatted='true'>{action_text}</parameterizedString>"
                         f"<parameterizedString isformatted='true'>{expected_text_for_step}</parameterizedString>"
@@ -1648,7 +2302,7 @@ def upload_test_cases():
                     project=azure_devops_project_name,
                     type="Test Case"
                 )
-                created_test_case_ids.append(created_work_item.id)
+                created_test_case_ids[tc_index] = created_work_item.id
             except Exception as create_error:
                 # If creation fails due to State field, try creating without state first, then update
                 error_str = str(create_error)
@@ -1677,9 +2331,9 @@ def upload_test_cases():
                             )
                         except Exception as state_error:
                             # If state update fails, log but don't fail the whole operation
-                            print(f"WARNING: Failed to set state to Ready for test case {test_case_id}: {state_error}")
+                            log.warning("Failed to set state to Ready for test case %s: %s", test_case_id, state_error)
                         
-                        created_test_case_ids.append(test_case_id)
+                        created_test_case_ids[tc_index] = test_case_id
                     except Exception as retry_error:
                         # If retry also fails, raise the original error
                         raise create_error
@@ -1724,86 +2378,43 @@ def normalize_title(title):
     title = ''.join(ch for ch in title if not unicodedata.category(ch).startswith('C'))  # Remove control chars
     return title
 
-@app.route('/analyze_story', methods=['POST', 'GET'])
-def analyze_story():
-    """Analyze a user story and provide structured review"""
-    print("DEBUG: /analyze_story endpoint called")
-    try:
-        # Support both GET (legacy) and POST (for large payloads with images)
-        if request.method == 'POST':
-            try:
-                data = request.json or {}
-                if not data:
-                    error_response = jsonify({'error': 'Payload missing.'})
-                    error_response.headers['Access-Control-Allow-Origin'] = '*'
-                    error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-                    error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-                    return error_response, 400
-            except Exception as e:
-                error_response = jsonify({'error': f'Invalid JSON payload: {str(e)}'})
-                error_response.headers['Access-Control-Allow-Origin'] = '*'
-                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-                return error_response, 400
-        else:
-            # GET request (legacy support)
-            payload_str = request.args.get('payload')
-            if not payload_str:
-                error_response = jsonify({'error': 'Payload missing.'})
-                error_response.headers['Access-Control-Allow-Origin'] = '*'
-                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-                return error_response, 400
-            try:
-                data = json.loads(unquote(payload_str))
-            except json.JSONDecodeError as e:
-                error_response = jsonify({'error': f'Invalid payload: {str(e)}'})
-                error_response.headers['Access-Control-Allow-Origin'] = '*'
-                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-                return error_response, 400
-        
-        print(f"DEBUG: Request data keys: {data.keys() if data else 'None'}")
-        
-        story_title = data.get('story_title')
-        story_description = data.get('story_description', '')
-        acceptance_criteria = data.get('acceptance_criteria', '')
-        related_test_cases = data.get('related_test_cases', '')
-        ai_provider = data.get('ai_provider', 'gemini')  # Default to Gemini
-        
-        # Extract optional API keys from request
-        gemini_api_key = data.get('gemini_api_key', '').strip() or None
-        claude_api_key = data.get('claude_api_key', '').strip() or None
-        
-        print(f"DEBUG: Story title: {story_title}")
-        print(f"DEBUG: Story description length: {len(story_description)}")
-        print(f"DEBUG: Acceptance criteria length: {len(acceptance_criteria)}")
-        print(f"DEBUG: AI Provider: {ai_provider}")
-        print(f"DEBUG: API keys provided via UI - Gemini: {'Yes' if gemini_api_key else 'No'}, Claude: {'Yes' if claude_api_key else 'No'}")
-        
-        if not story_title:
-            print("ERROR: Story title is missing")
-            error_response = jsonify({'error': 'Story Title is required.'})
-            error_response.headers['Access-Control-Allow-Origin'] = '*'
-            error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-            error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-            return error_response, 400
-        
-        # Extract images and text from HTML fields
-        desc_images, desc_text = extract_images_from_html(story_description)
-        ac_images, ac_text = extract_images_from_html(acceptance_criteria)
-        
-        # Collect all images
-        all_images = desc_images + ac_images
-        provider_name = "Gemini" if ai_provider.lower() != 'claude' else "Claude"
-        print(f"DEBUG: Found {len(all_images)} images to send to {provider_name}")
-        
-        # Build the prompt for analysis
-        test_cases_section = ""
-        if related_test_cases:
-            test_cases_section = f"\n\n**RELATED TEST CASES (if available):**\n{related_test_cases}"
-        
-        prompt = f"""**Role:** You are a Senior Expert Quality Control (QC) Engineer mentoring a team of testers.
+# LRU of finished story analyses keyed by a hash of the provider and story fields, so
+# clicking "Analyze" again on an unchanged story skips the AI round-trip. Embedded
+# images are part of the field HTML, so they are covered by the hash. Entries expire
+# after an hour; ?refresh=1 bypasses the cache.
+_ANALYSIS_CACHE = OrderedDict()
+_ANALYSIS_CACHE_MAX_ENTRIES = 512
+_ANALYSIS_CACHE_TTL_SECONDS = 3600
+_ANALYSIS_CACHE_LOCK = threading.Lock()
+
+
+def _analysis_cache_key(*parts):
+    return hashlib.blake2b(orjson.dumps(parts), digest_size=16).hexdigest()
+
+
+def _analysis_cache_get(cache_key):
+    """Return the cached analysis for cache_key, or None if missing or expired"""
+    with _ANALYSIS_CACHE_LOCK:
+        cached = _ANALYSIS_CACHE.get(cache_key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[0] > _ANALYSIS_CACHE_TTL_SECONDS:
+            del _ANALYSIS_CACHE[cache_key]
+            return None
+        _ANALYSIS_CACHE.move_to_end(cache_key)
+        return cached[1]
+
+
+def _analysis_cache_put(cache_key, analysis_text):
+    with _ANALYSIS_CACHE_LOCK:
+        _ANALYSIS_CACHE[cache_key] = (time.monotonic(), analysis_text)
+        _ANALYSIS_CACHE.move_to_end(cache_key)
+        while len(_ANALYSIS_CACHE) > _ANALYSIS_CACHE_MAX_ENTRIES:
+            _ANALYSIS_CACHE.popitem(last=False)
+
+
+# Story review prompt for analyze_story(); kept at module level so only the story fields are formatted per request
+_ANALYZE_PROMPT_TEMPLATE = """**Role:** You are a Senior Expert Quality Control (QC) Engineer mentoring a team of testers.
 
 **Objective:** Take the provided User Story and break it down so thoroughly and clearly that a QC Engineer can trust your explanation 100%. Your output must be the "single source of truth." The tester should **not need to read the original Azure ticket** to understand exactly what needs to be tested, why it matters, and how it works.
 
@@ -1891,10 +2502,160 @@ If images are included with the user story (either embedded in HTML or provided
 5. Flag missing visual documentation (error states, edge cases, different screen sizes, etc.)
 6. Reference specific images when identifying risks or ambiguities (e.g., "In Image 1, there is a [element] that is not mentioned in acceptance criteria...")
 """
+
+def _clean_analysis_text(analysis_text):
+    """Strip whitespace and a surrounding markdown code block from an analysis response"""
+    return _strip_code_fence(analysis_text.strip())
+
+
+def _analysis_event_stream(frames):
+    """SSE response for analyze_story clients that asked for text/event-stream"""
+    response = Response(frames, mimetype='text/event-stream')
+    response.direct_passthrough = True  # Frames are already UTF-8 bytes
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable buffering for nginx
+    return response
+
+
+@app.route('/analyze_story', methods=['POST', 'GET'])
+def analyze_story():
+    """Analyze a user story and provide structured review"""
+    log.debug("/analyze_story endpoint called")
+    try:
+        # Support both GET (legacy) and POST (for large payloads with images)
+        if request.method == 'POST':
+            try:
+                data = request.json or {}
+                if not data:
+                    error_response = jsonify({'error': 'Payload missing.'})
+                    error_response.headers['Access-Control-Allow-Origin'] = '*'
+                    error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+                    error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+                    return error_response, 400
+            except Exception as e:
+                error_response = jsonify({'error': f'Invalid JSON payload: {str(e)}'})
+                error_response.headers['Access-Control-Allow-Origin'] = '*'
+                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+                return error_response, 400
+        else:
+            # GET request (legacy support)
+            payload_str = request.args.get('payload')
+            if not payload_str:
+                error_response = jsonify({'error': 'Payload missing.'})
+                error_response.headers['Access-Control-Allow-Origin'] = '*'
+                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+                return error_response, 400
+            try:
+                data = json.loads(unquote(payload_str))
+            except json.JSONDecodeError as e:
+                error_response = jsonify({'error': f'Invalid payload: {str(e)}'})
+                error_response.headers['Access-Control-Allow-Origin'] = '*'
+                error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+                error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+                return error_response, 400
+        
+        log.debug("Request data keys: %s", data.keys() if data else 'None')
+        
+        story_title = data.get('story_title')
+        story_description = data.get('story_description', '')
+        acceptance_criteria = data.get('acceptance_criteria', '')
+        related_test_cases = data.get('related_test_cases', '')
+        ai_provider = data.get('ai_provider') or 'gemini'  # Default to Gemini (also when sent as null)
+        
+        # Extract optional API keys from request
+        gemini_api_key = data.get('gemini_api_key', '').strip() or None
+        claude_api_key = data.get('claude_api_key', '').strip() or None
+        
+        log.debug("Story title: %s", story_title)
+        log.debug("Story description length: %s", len(story_description))
+        log.debug("Acceptance criteria length: %s", len(acceptance_criteria))
+        log.debug("AI Provider: %s", ai_provider)
+        log.debug("API keys provided via UI - Gemini: %s, Claude: %s", 'Yes' if gemini_api_key else 'No', 'Yes' if claude_api_key else 'No')
+        
+        if not story_title:
+            log.error("Story title is missing")
+            error_response = jsonify({'error': 'Story Title is required.'})
+            error_response.headers['Access-Control-Allow-Origin'] = '*'
+            error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+            error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            return error_response, 400
         
-        print(f"DEBUG: Calling {provider_name} API for analysis...")
-        print(f"DEBUG: Prompt length: {len(prompt)}")
-        print(f"DEBUG: Number of images: {len(all_images)}")
+        cache_key = _analysis_cache_key(
+            ai_provider.lower(), story_title, story_description, acceptance_criteria, related_test_cases
+        )
+        cached_analysis = None if request.args.get('refresh') == '1' else _analysis_cache_get(cache_key)
+        # Clients that accept text/event-stream get the analysis as it is generated:
+        # 'chunk' frames with the raw text, then a 'done' frame with the cleaned analysis
+        wants_stream = 'text/event-stream' in request.headers.get('Accept', '')
+        if cached_analysis is not None:
+            log.debug("Serving cached analysis")
+            if wants_stream:
+                return _analysis_event_stream(iter([_sse_frame({'type': 'done', 'analysis': cached_analysis})]))
+            response = jsonify({'analysis': cached_analysis})
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            return response
+        
+        # Extract images and text from HTML fields
+        (desc_images, desc_text), (ac_images, ac_text) = _HTML_EXTRACT_EXECUTOR.map(
+            partial(extract_images_from_html_cached, image_cache={}), (story_description, acceptance_criteria)
+        )
+        
+        # Collect all images, sending a screenshot pasted into both fields only once
+        all_images = _unique_images(desc_images + ac_images)
+        provider_name = "Gemini" if ai_provider.lower() != 'claude' else "Claude"
+        log.debug("Found %s images to send to %s", len(all_images), provider_name)
+        
+        # Build the prompt for analysis
+        test_cases_section = ""
+        if related_test_cases:
+            test_cases_section = f"\n\n**RELATED TEST CASES (if available):**\n{related_test_cases}"
+        
+        prompt = _ANALYZE_PROMPT_TEMPLATE.format(
+            story_title=story_title,
+            desc_text=desc_text,
+            ac_text=ac_text,
+            test_cases_section=test_cases_section
+        )
+        
+        log.debug("Calling %s API for analysis...", provider_name)
+        log.debug("Prompt length: %s", len(prompt))
+        log.debug("Number of images: %s", len(all_images))
+        
+        if wants_stream:
+            # Started before responding so provider and key errors still come back as a JSON 500
+            analysis_chunks = call_ai_provider(
+                ai_provider,
+                prompt,
+                all_images if len(all_images) > 0 else None,
+                gemini_api_key=gemini_api_key,
+                claude_api_key=claude_api_key,
+                stream=True
+            )
+            
+            def generate():
+                analysis_parts = []
+                try:
+                    for text in analysis_chunks:
+                        analysis_parts.append(text)
+                        yield _sse_frame({'type': 'chunk', 'text': text})
+                    analysis_text = _clean_analysis_text(''.join(analysis_parts))
+                    if not analysis_text:
+                        raise ValueError(f"Empty analysis response from {provider_name} API")
+                    log.debug("Streamed analysis text, length: %s", len(analysis_text))
+                    _analysis_cache_put(cache_key, analysis_text)
+                    yield _sse_frame({'type': 'done', 'analysis': analysis_text})
+                except Exception as stream_error:
+                    log.exception("Error streaming analysis: %s", stream_error)
+                    yield _sse_frame({'type': 'error', 'error': str(stream_error)})
+            
+            return _analysis_event_stream(generate())
         
         # Use the helper function to call the appropriate AI provider
         try:
@@ -1909,22 +2670,13 @@ If images are included with the user story (either embedded in HTML or provided
             if not analysis_text:
                 raise ValueError(f"Empty analysis response from {provider_name} API")
             
-            # Clean up the response - remove markdown code blocks if present
-            analysis_text = analysis_text.strip()
-            if analysis_text.startswith('```'):
-                lines = analysis_text.split('\n')
-                if lines[0].startswith('```'):
-                    lines = lines[1:]
-                if lines and lines[-1].strip() == '```':
-                    lines = lines[:-1]
-                analysis_text = '\n'.join(lines).strip()
+            analysis_text = _clean_analysis_text(analysis_text)
             
-            print(f"DEBUG: Successfully extracted analysis text, length: {len(analysis_text)}")
+            log.debug("Successfully extracted analysis text, length: %s", len(analysis_text))
+            _analysis_cache_put(cache_key, analysis_text)
             
         except Exception as extract_error:
-            print(f"ERROR extracting text from response: {extract_error}")
-            import traceback
-            traceback.print_exc()
+            log.exception("ERROR extracting text from response: %s", extract_error)
             raise ValueError(f"Failed to extract text from {provider_name} response: {str(extract_error)}")
         
         response = jsonify({'analysis': analysis_text})
@@ -1933,90 +2685,195 @@ If images are included with the user story (either embedded in HTML or provided
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         return response
     except Exception as e:
-        import traceback
-        print(f"Error generating analysis: {e}")
-        traceback.print_exc()
+        log.exception("Error generating analysis: %s", e)
         error_response = jsonify({'error': str(e)})
         error_response.headers['Access-Control-Allow-Origin'] = '*'
         error_response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         error_response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         return error_response, 500
 
+# Shared pool for attachment downloads: threads are reused across requests and the
+# total number of concurrent downloads against Azure DevOps stays bounded
+_IMAGE_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='azdo-image')
+
+# vstfs:///Attachments/Attachments/[attachment-id]/filename (inner "Attachments/" is optional)
+_VSTFS_ATTACHMENT_RE = re.compile(r'vstfs:///Attachments/(?:Attachments/)?([^/?#]+)')
+
+# Hosts (and their subdomains) that serve Azure DevOps images; other hosts are external
+# unless the path is a REST API ('/_apis/') path, e.g. on an on-premises server
+_AZDO_HOST_SUFFIXES = ('dev.azure.com', 'visualstudio.com')
+
+# Shared session so image downloads reuse keep-alive TCP/TLS connections to Azure DevOps
+_AZDO_SESSION = requests.Session()
+_AZDO_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+# Only images are downloaded through this session
+_AZDO_SESSION.headers['Accept'] = 'image/*'
+
+
+def _fetch_azure_devops_image(image_url, headers, cached=None):
+    """Fetch a single Azure DevOps image and return (data URL, ETag); the data URL is None on failure
+    
+    If ``cached`` is a previous (data URL, ETag) pair, the request is made conditional and a
+    304 Not Modified response returns the cached data URL without downloading the body.
+    """
+    try:
+        if cached and cached[1]:
+            headers = {**headers, 'If-None-Match': cached[1]}
+        with _AZDO_SESSION.get(image_url, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304 and cached:
+                return cached
+            if response.status_code == 200:
+                # Determine content type
+                content_type = response.headers.get('Content-Type', 'image/png')
+                if not content_type.startswith('image/'):
+                    content_type = 'image/png'
+                
+                # Read the body into one growing buffer instead of joining a separate bytes copy
+                image_bytes = bytearray()
+                for chunk in response.iter_content(65536):
+                    image_bytes.extend(chunk)
+                
+                # Convert to base64
+                image_base64 = binascii.b2a_base64(image_bytes, newline=False).decode('ascii')
+                log.info("Successfully converted Azure DevOps image to base64")
+                return f"data:{content_type};base64,{image_base64}", response.headers.get('ETag')
+            log.warning("Failed to fetch Azure DevOps image: %s (Status: %s)", image_url, response.status_code)
+    except Exception as e:
+        log.error("Failed to convert Azure DevOps image to base64: %s", e)
+    return None, None
+
+
+# LRU cache of converted images keyed by (image URL, hash of the auth header) -> (data URL, ETag);
+# failed fetches are not cached. Screenshots can be several MB each, so the cache is bounded by
+# the total length of its data URLs rather than by entry count.
+_IMAGE_DATA_URL_CACHE = OrderedDict()
+_IMAGE_DATA_URL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_IMAGE_DATA_URL_CACHE_BYTES = 0
+_IMAGE_DATA_URL_CACHE_LOCK = threading.Lock()
+
+
+def _get_azure_devops_image(image_url, headers):
+    """Return the data URL for an Azure DevOps image, serving repeated URLs from the cache
+    
+    Work item attachments are immutable, so cached attachments are returned directly; other
+    cached images are revalidated with their ETag.
+    """
+    global _IMAGE_DATA_URL_CACHE_BYTES
+    cache_key = (image_url, _api_key_digest(headers['Authorization']))
+    with _IMAGE_DATA_URL_CACHE_LOCK:
+        cached = _IMAGE_DATA_URL_CACHE.get(cache_key)
+        if cached is not None:
+            _IMAGE_DATA_URL_CACHE.move_to_end(cache_key)
+    if cached is not None and (not cached[1] or '/_apis/wit/attachments/' in image_url):
+        return cached[0]
+    
+    result = _fetch_azure_devops_image(image_url, headers, cached)
+    if result[0] and len(result[0]) <= _IMAGE_DATA_URL_CACHE_MAX_BYTES:
+        with _IMAGE_DATA_URL_CACHE_LOCK:
+            replaced = _IMAGE_DATA_URL_CACHE.pop(cache_key, None)
+            if replaced is not None:
+                _IMAGE_DATA_URL_CACHE_BYTES -= len(replaced[0])
+            _IMAGE_DATA_URL_CACHE[cache_key] = result
+            _IMAGE_DATA_URL_CACHE_BYTES += len(result[0])
+            while _IMAGE_DATA_URL_CACHE_BYTES > _IMAGE_DATA_URL_CACHE_MAX_BYTES:
+                _, evicted = _IMAGE_DATA_URL_CACHE.popitem(last=False)
+                _IMAGE_DATA_URL_CACHE_BYTES -= len(evicted[0])
+    return result[0]
+
+
+# src attribute of an <img> tag: group 1 is everything up to the opening quote, group 3 the raw value
+_IMG_SRC_ATTR_RE = re.compile(r'(<img\b[^>]*?(?<![\w-])src\s*=\s*)(["\'])(.*?)\2', re.IGNORECASE | re.DOTALL)
+# alt attribute within a single tag
+_IMG_ALT_ATTR_RE = re.compile(r'(?<![\w-])alt\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+
+
 def convert_azure_devops_images_to_base64(html_content, org_url, pat_token):
     """Convert Azure DevOps image URLs to base64 data URLs for display in rich text editor"""
     if not html_content:
         return html_content
     
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Nothing to convert: skip parsing entirely (Azure DevOps emits lowercase tags)
+    if '<img' not in html_content:
+        return html_content
     
     # Debug: Check if HTML contains tables
-    tables = soup.find_all('table')
-    if tables:
-        print(f"DEBUG: Found {len(tables)} table(s) in HTML content")
+    table_count = html_content.count('<table')
+    if table_count:
+        log.debug("Found %s table(s) in HTML content", table_count)
     else:
-        print("DEBUG: No <table> tags found in HTML content")
+        log.debug("No <table> tags found in HTML content")
         # Check if there are table-like structures that might need conversion
         # Azure DevOps sometimes uses div-based tables or other structures
     
-    images = soup.find_all('img')
-    
-    for img in images:
-        src = img.get('src', '')
-        if not src:
+    # First pass: scan the <img> src attributes directly; no HTML tree is built at all
+    # Resolve every convertible image to its fetch URL first so the downloads can overlap
+    pending = []
+    seen_srcs = set()
+    org_host = urlsplit(org_url or '').hostname or ''
+    for img_match in _IMG_SRC_ATTR_RE.finditer(html_content):
+        src = html.unescape(img_match.group(3))
+        # Repeated images are fetched once; the rewrite pass patches every occurrence
+        if not src or src in seen_srcs:
             continue
+        seen_srcs.add(src)
         
-        # Skip if already a data URL
-        if src.startswith('data:image'):
+        # Classify and normalize the URL from a single parse
+        src_parts = urlsplit(src)
+        scheme = src_parts.scheme.lower()
+        if scheme == 'data':
+            # Already a data URL
+            continue
+        if scheme == 'vstfs':
+            # Convert vstfs:// URLs to REST API URLs, extracting the attachment ID
+            vstfs_match = _VSTFS_ATTACHMENT_RE.match(src)
+            if not vstfs_match:
+                log.warning("Could not parse vstfs URL: %s", src)
+                continue
+            tag_end = html_content.find('>', img_match.end())
+            alt_match = _IMG_ALT_ATTR_RE.search(html_content, img_match.start(), tag_end if tag_end != -1 else len(html_content))
+            filename = html.unescape(alt_match.group(2)) if alt_match else 'image.png'
+            pending.append((src, f"{org_url}/_apis/wit/attachments/{vstfs_match.group(1)}?fileName={filename}"))
             continue
         
-        try:
+        if not scheme and src.startswith('/'):
+            # Relative URL on the organization's server
+            image_url = f"{org_url}{src}"
+            host = org_host
+        else:
             image_url = src
-            
-            # Convert vstfs:// URLs to REST API URLs
-            if src.startswith('vstfs:///'):
-                # Extract attachment ID from vstfs URL
-                # vstfs:///Attachments/Attachments/[attachment-id]/filename
-                match = re.match(r'/Attachments/([^/]+)', src)
-                if match and match.group(1):
-                    attachment_id = match.group(1)
-                    filename = img.get('alt', 'image.png')
-                    image_url = f"{org_url}/_apis/wit/attachments/{attachment_id}?fileName={filename}"
-                else:
-                    print(f"WARNING: Could not parse vstfs URL: {src}")
-                    continue
-            
-            # Make relative URLs absolute
-            if image_url.startswith('/'):
-                image_url = f"{org_url}{image_url}"
-            
-            # Only process Azure DevOps URLs (skip external URLs)
-            if not ('/_apis/' in image_url or 'visualstudio.com' in image_url or 'dev.azure.com' in image_url):
-                continue
-            
-            # Fetch image and convert to base64
-            headers = {
-                'Authorization': f'Basic {base64.b64encode(f":{pat_token}".encode()).decode()}'
-            }
-            response = requests.get(image_url, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                # Determine content type
-                content_type = response.headers.get('Content-Type', 'image/png')
-                if not content_type.startswith('image/'):
-                    content_type = 'image/png'
-                
-                # Convert to base64
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
-                data_url = f"data:{content_type};base64,{image_base64}"
-                img['src'] = data_url
-                print(f"Successfully converted Azure DevOps image to base64")
-            else:
-                print(f"WARNING: Failed to fetch Azure DevOps image: {image_url} (Status: {response.status_code})")
-        except Exception as e:
-            print(f"ERROR: Failed to convert Azure DevOps image to base64: {e}")
-            # Keep original URL as fallback
+            host = src_parts.hostname or ''
+        
+        # Only process Azure DevOps URLs (skip external URLs)
+        if '/_apis/' not in src_parts.path and not host.endswith(_AZDO_HOST_SUFFIXES):
+            continue
+        
+        pending.append((src, image_url))
+    
+    if not pending:
+        return html_content
+    
+    # The PAT header is the same for every image, so encode it once
+    headers = {
+        'Authorization': f'Basic {base64.b64encode(f":{pat_token}".encode()).decode()}'
+    }
+    # Fetch concurrently; failed downloads keep the original URL as fallback
+    data_urls = list(_IMAGE_FETCH_EXECUTOR.map(lambda item: _get_azure_devops_image(item[1], headers), pending))
+    data_url_by_src = {src: data_url for (src, _), data_url in zip(pending, data_urls) if data_url}
+    if not data_url_by_src:
+        return html_content
+    
+    # Second pass: patch the src attributes in the original string (keys are entity-decoded)
+    def _replace_src(match):
+        data_url = data_url_by_src.get(html.unescape(match.group(3)))
+        if data_url is None:
+            return match.group(0)
+        return f"{match.group(1)}{match.group(2)}{data_url}{match.group(2)}"
     
-    return str(soup)
+    return _IMG_SRC_ATTR_RE.sub(_replace_src, html_content)
 
 @app.route('/test_error')
 def test_error():
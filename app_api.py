@@ -2,64 +2,104 @@
 Flask API Backend for Azure DevOps Extension
 This version accepts Azure DevOps OAuth tokens and handles CORS for extension requests
 """
+import logging
 import os
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import anthropic
 from azure.devops.connection import Connection
 from msrest.authentication import BasicAuthentication
 import json
+import orjson
 import re
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+import lxml.html
+from lxml.etree import ParserError
 from urllib.parse import unquote
 import ast
 import html
 import unicodedata
 import string
 import base64
+import binascii
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
 from PIL import Image
 
 # Load environment variables
 load_dotenv()
 
+# Logging: INFO by default, set LOG_LEVEL=DEBUG for per-request traces
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+log = logging.getLogger(__name__)
+
 # Configure Gemini API
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 if not gemini_api_key:
     raise ValueError("GEMINI_API_KEY not found in .env file")
 genai.configure(api_key=gemini_api_key)
+# Shared Gemini model handle; it holds no per-request state, so every call reuses it
+gemini_model = genai.GenerativeModel('gemini-flash-latest')
 
 # Configure Claude API
 claude_api_key = os.getenv("CLAUDE_API_KEY")
 if not claude_api_key:
-    print("WARNING: CLAUDE_API_KEY not found in .env file. Claude features will be unavailable.")
+    log.warning("CLAUDE_API_KEY not found in .env file. Claude features will be unavailable.")
 claude_client = None
 if claude_api_key:
     claude_client = anthropic.Anthropic(api_key=claude_api_key)
 
 # Flask App with CORS support
+class _OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify() and request.json skip the stdlib encoder"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = _OrjsonProvider(app)
 
-# Enable CORS for Azure DevOps extension origins
-CORS(app, origins=[
+# Enable CORS for Azure DevOps extension origins. Flask-CORS answers OPTIONS preflights itself;
+# the test case stream stays open to any origin, as it always has been.
+_AZURE_DEVOPS_ORIGINS = [
     "https://dev.azure.com",
     "https://*.visualstudio.com",
     "https://app.vssps.visualstudio.com"
-], allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "OPTIONS"])
-
-@app.before_request
-def handle_preflight():
-    if request.method == "OPTIONS":
-        response = Response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type, Authorization")
-        response.headers.add("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        return response
-
-def extract_table_from_html(table_element):
-    """Extract and format a table element into readable text format"""
+]
+CORS(app, resources={
+    r"/generate_test_cases": {"origins": "*"},
+    r"/*": {"origins": _AZURE_DEVOPS_ORIGINS},
+}, allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "OPTIONS"],
+    supports_credentials=False, automatic_options=True)
+
+def extract_table_from_html(table_element, cell_text_func=None):
+    """Extract and format a table element into readable text format
+    
+    cell_text_func optionally overrides how a cell's text is read (default: get_text joined by spaces).
+    """
     if not table_element:
         return ""
     
@@ -67,21 +107,24 @@ def extract_table_from_html(table_element):
     if not rows:
         return ""
     
+    # Get all text nodes of each cell and join them properly
+    # Use get_text with separator to handle nested elements
+    if cell_text_func is None:
+        cell_text_func = lambda cell: cell.get_text(separator=' ', strip=True)
+    return _format_table_text(
+        (cell_text_func(cell) for cell in row.find_all(['td', 'th']))
+        for row in rows
+    )
+
+def _format_table_text(rows):
+    """Format rows of raw cell texts as a [TABLE START] ... [TABLE END] block"""
     table_text = []
     table_text.append("\n[TABLE START]")
     
-    for row in rows:
-        cells = row.find_all(['td', 'th'])
-        if not cells:
-            continue
-        
+    for cells in rows:
         # Extract text from each cell, preserving structure
         cell_texts = []
-        for cell in cells:
-            # Get all text nodes and join them properly
-            # Use get_text with separator to handle nested elements
-            cell_text = cell.get_text(separator=' ', strip=True)
-            
+        for cell_text in cells:
             # Aggressively normalize all whitespace - this is critical for related stories
             # Replace all types of whitespace (spaces, tabs, newlines, etc.) with single space
             cell_text = re.sub(r'\s+', ' ', cell_text)
@@ -106,8 +149,83 @@ def extract_table_from_html(table_element):
     result = re.sub(r' {2,}', ' ', result)
     return result
 
-def extract_images_from_html(html_content):
-    """Extract images and tables from HTML content and return list of PIL Image objects and text with placeholders"""
+# Image types both Gemini and Claude accept as-is; these skip the PIL decode/re-encode. Checked
+# against the format PIL detects, since a data URI's declared type can be wrong and Claude
+# rejects mislabelled images.
+_PASSTHROUGH_IMAGE_MIME_TYPES = frozenset({'image/png', 'image/jpeg', 'image/webp'})
+# Longest side sent to the AI providers; both downscale larger images server-side anyway
+_MAX_IMAGE_DIMENSION = 1568
+
+def _downscale_image(image):
+    """Shrink a PIL image in place to fit within _MAX_IMAGE_DIMENSION, keeping its aspect ratio"""
+    if max(image.size) > _MAX_IMAGE_DIMENSION:
+        image.thumbnail((_MAX_IMAGE_DIMENSION, _MAX_IMAGE_DIMENSION), Image.Resampling.LANCZOS)
+    return image
+
+# Header of an image data URI, e.g. "data:image/png;base64,"; group 1 is the MIME type
+_DATA_URI_RE = re.compile(r'data:(image/[^;,]*)[^,]*,')
+
+def _collect_html_text_parts(node, image_placeholder, parts):
+    """Append the stripped text under node to parts in document order, as get_text(strip=True) would
+    
+    <img> tags contribute image_placeholder(img) and tables their formatted text, so the tree
+    never has to be mutated before the text is read.
+    """
+    for child in node.children:
+        child_type = type(child)
+        if child_type is Tag:
+            if child.name == 'img':
+                parts.append(image_placeholder(child).strip())
+                continue
+            if child.name == 'table':
+                table_text = extract_table_from_html(
+                    child,
+                    cell_text_func=lambda cell: ' '.join(_collect_html_text_parts(cell, image_placeholder, []))
+                )
+                if table_text:
+                    parts.append(table_text.strip())
+                    continue
+            _collect_html_text_parts(child, image_placeholder, parts)
+        elif child_type is NavigableString or child_type is CData:
+            text = child.strip()
+            if text:
+                parts.append(text)
+    return parts
+
+# Shared pool for parsing the story's HTML fields side by side; kept separate from the
+# per-request pool in generate() so a busy stream never waits on its own workers
+_HTML_EXTRACT_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+def _plain_text_as_parsed(text):
+    """Apply the input normalization an HTML parser does to text without markup (line endings, NULs)"""
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '\ufffd')
+
+def _clean_extracted_text(text_content):
+    """Final cleanup of extracted text: normalize multiple consecutive newlines and spaces
+    
+    This is critical for related stories that may have extra whitespace
+    """
+    text_content = re.sub(r'\n\s*\n+', '\n\n', text_content)  # Max 2 newlines
+    text_content = re.sub(r'[ \t]+', ' ', text_content)  # Multiple spaces/tabs to single space
+    text_content = re.sub(r' \n', '\n', text_content)  # Remove space before newline
+    text_content = re.sub(r'\n ', '\n', text_content)  # Remove space after newline
+    # Remove any remaining multiple spaces (shouldn't happen, but just in case)
+    text_content = re.sub(r' {2,}', ' ', text_content)
+    # Clean up spaces around table markers
+    text_content = re.sub(r' +\[TABLE', '\n[TABLE', text_content)
+    text_content = re.sub(r'\[TABLE +', '[TABLE ', text_content)
+    text_content = re.sub(r' +TABLE END\]', ' TABLE END]\n', text_content)
+    text_content = re.sub(r'TABLE END\] +', 'TABLE END]\n', text_content)
+    return text_content
+
+def extract_images_from_html(html_content, image_cache=None):
+    """Extract images and tables from HTML content and return list of images and text with placeholders
+    
+    Images are {'mime_type', 'data'} dicts: the raw bytes for PNG/JPEG/WebP, other formats re-encoded once as JPEG.
+    Identical images are only returned once. Pass the same image_cache dict when extracting several
+    fields of one request so a screenshot pasted into each field is decoded once and comes back as
+    the same object (see _unique_images).
+    """
     if not html_content:
         return [], ""
     
@@ -127,98 +245,186 @@ def extract_images_from_html(html_content):
     # Normalize multiple newlines to single newline
     html_content = re.sub(r'\n\s*\n+', '\n', html_content)
     
-    soup = BeautifulSoup(html_content, 'html.parser')
-    images = soup.find_all('img')
-    tables = soup.find_all('table')
+    # Plain text (no tags or entities) would parse to itself, so skip the parser entirely
+    if '<' not in html_content and '&' not in html_content:
+        return [], _clean_extracted_text(_plain_text_as_parsed(html_content).strip())
+    
+    soup = BeautifulSoup(html_content, 'lxml')
     
     image_objects = []
+    if image_cache is None:
+        image_cache = {}
+    # Content hash -> placeholder number within this field
+    image_numbers = {}
     
-    # Process images and replace with placeholders
-    for img in images:
+    # Decode an image and return the placeholder text that replaces it
+    def process_image(img):
         src = img.get('src', '')
-        if src.startswith('data:image'):
+        data_uri_match = _DATA_URI_RE.match(src)
+        if data_uri_match:
             try:
-                # Parse data URL: data:image/png;base64,<data>
-                header, data = src.split(',', 1)
-                
-                # Decode base64
-                image_bytes = base64.b64decode(data)
-                image = Image.open(BytesIO(image_bytes))
-                
-                # Convert to RGB if necessary (Gemini requires RGB format)
-                if image.mode in ('RGBA', 'LA'):
-                    rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                    rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                    image = rgb_image
-                elif image.mode == 'P':
-                    image = image.convert('RGB')
-                elif image.mode != 'RGB':
-                    image = image.convert('RGB')
+                # Decode base64 from the data URL: data:image/png;base64,<data>
+                image_bytes = binascii.a2b_base64(src[data_uri_match.end():])
+                alt_text = img.get('alt', 'image')
                 
-                image_objects.append(image)
+                digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+                if digest in image_numbers:
+                    return f"[Image {image_numbers[digest]}: {alt_text}]"
+                cached_image = image_cache.get(digest)
+                if cached_image is None:
+                    # Opening only reads the header; the pixels are decoded just for images
+                    # that are re-encoded or oversized
+                    image = Image.open(BytesIO(image_bytes))
+                    mime_type = Image.MIME.get(image.format)
+                if cached_image is not None:
+                    image_objects.append(cached_image)
+                elif mime_type in _PASSTHROUGH_IMAGE_MIME_TYPES:
+                    if max(image.size) > _MAX_IMAGE_DIMENSION:
+                        image_format = image.format
+                        buffered = BytesIO()
+                        _downscale_image(image).save(buffered, format=image_format)
+                        image_bytes = buffered.getvalue()
+                    # Otherwise send the original encoded bytes, labelled with their detected type
+                    image_objects.append(image_cache.setdefault(digest, {'mime_type': mime_type, 'data': image_bytes}))
+                else:
+                    # Convert to RGB if necessary (Gemini requires RGB format)
+                    if image.mode in ('RGBA', 'LA'):
+                        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+                        # The image itself is the mask: paste reads its alpha band in place, no band copies
+                        rgb_image.paste(image, mask=image)
+                        image = rgb_image
+                    elif image.mode == 'P':
+                        image = image.convert('RGB')
+                    elif image.mode != 'RGB':
+                        image = image.convert('RGB')
+                    
+                    _downscale_image(image)
+                    
+                    # Re-encode once here so the pixel buffer is dropped straight away and
+                    # each provider call sends the same bytes instead of re-encoding the image
+                    buffered = BytesIO()
+                    image.save(buffered, format='JPEG', quality=85, optimize=True)
+                    image_objects.append(image_cache.setdefault(digest, {'mime_type': 'image/jpeg', 'data': buffered.getvalue()}))
                 
                 # Replace img tag with placeholder text
-                alt_text = img.get('alt', 'image')
-                img.replace_with(f"[Image {len(image_objects)}: {alt_text}]")
+                image_numbers[digest] = len(image_objects)
+                return f"[Image {len(image_objects)}: {alt_text}]"
             except Exception as e:
-                print(f"WARNING: Failed to process image: {e}")
-                import traceback
-                traceback.print_exc()
+                log.warning("Failed to process image: %s", e, exc_info=True)
                 alt_text = img.get('alt', 'image')
-                img.replace_with(f"[Image: {alt_text} - failed to load]")
+                return f"[Image: {alt_text} - failed to load]"
         else:
             # External image URL - keep as placeholder
             alt_text = img.get('alt', 'image')
-            img.replace_with(f"[Image: {alt_text} - external URL]")
-    
-    # Process tables and replace with formatted text
-    # Replace tables with their extracted text directly, but normalize surrounding whitespace
-    for table in tables:
-        table_text = extract_table_from_html(table)
-        if table_text:
-            # Replace table with the formatted text
-            # The table text already has proper newlines, so we just replace directly
-            table.replace_with(table_text)
-    
-    # Get text content - use newline separator to preserve structure for step detection
+            return f"[Image: {alt_text} - external URL]"
+    
+    # Placeholder per <img> element, so an image inside a nested table is only decoded once
+    image_placeholders = {}
+    
+    def image_placeholder(img):
+        placeholder = image_placeholders.get(id(img))
+        if placeholder is None:
+            placeholder = image_placeholders[id(img)] = process_image(img)
+        return placeholder
+    
+    # Get text content in one walk: images become placeholders and tables formatted text.
+    # Use newline separator to preserve structure for step detection
     # But we'll clean up extra whitespace afterwards
-    text_content = soup.get_text(separator='\n', strip=True)
+    text_content = '\n'.join(_collect_html_text_parts(soup, image_placeholder, []))
     
-    # Final cleanup: normalize multiple consecutive newlines and spaces
-    # This is critical for related stories that may have extra whitespace
-    text_content = re.sub(r'\n\s*\n+', '\n\n', text_content)  # Max 2 newlines
-    text_content = re.sub(r'[ \t]+', ' ', text_content)  # Multiple spaces/tabs to single space
-    text_content = re.sub(r' \n', '\n', text_content)  # Remove space before newline
-    text_content = re.sub(r'\n ', '\n', text_content)  # Remove space after newline
-    # Remove any remaining multiple spaces (shouldn't happen, but just in case)
-    text_content = re.sub(r' {2,}', ' ', text_content)
-    # Clean up spaces around table markers
-    text_content = re.sub(r' +\[TABLE', '\n[TABLE', text_content)
-    text_content = re.sub(r'\[TABLE +', '[TABLE ', text_content)
-    text_content = re.sub(r' +TABLE END\]', ' TABLE END]\n', text_content)
-    text_content = re.sub(r'TABLE END\] +', 'TABLE END]\n', text_content)
+    return image_objects, _clean_extracted_text(text_content)
+
+# LRU of extract_images_from_html results keyed by a hash of the field's HTML, so resubmitting
+# an unchanged story (e.g. the extension retrying) skips the parse and image decoding.
+# The cached image dicts are shared between requests and must not be modified.
+_HTML_EXTRACT_CACHE = OrderedDict()
+_HTML_EXTRACT_CACHE_MAX_ENTRIES = 128
+_HTML_EXTRACT_CACHE_LOCK = threading.Lock()
+
+def extract_images_from_html_cached(html_content, image_cache=None):
+    """Memoized extract_images_from_html; returns a fresh images list on every call"""
+    if not html_content:
+        return [], ""
+    cache_key = hashlib.blake2b(html_content.encode('utf-8'), digest_size=16).digest()
+    with _HTML_EXTRACT_CACHE_LOCK:
+        cached = _HTML_EXTRACT_CACHE.get(cache_key)
+        if cached is not None:
+            _HTML_EXTRACT_CACHE.move_to_end(cache_key)
+    if cached is None:
+        images, text_content = extract_images_from_html(html_content, image_cache)
+        cached = (tuple(images), text_content)
+        with _HTML_EXTRACT_CACHE_LOCK:
+            _HTML_EXTRACT_CACHE[cache_key] = cached
+            while len(_HTML_EXTRACT_CACHE) > _HTML_EXTRACT_CACHE_MAX_ENTRIES:
+                _HTML_EXTRACT_CACHE.popitem(last=False)
+    return list(cached[0]), cached[1]
+
+def _unique_images(images):
+    """Drop repeated images, keeping order
+    
+    Compared by their bytes: fields served from the extraction cache may come from different
+    requests' image_caches, so the same screenshot is not always the same object.
+    """
+    return list({image['data']: image for image in images}.values())
+
+# Elements whose text get_text() leaves out
+_NON_TEXT_HTML_TAGS = frozenset({'script', 'style', 'template'})
+
+def _collect_lxml_text_parts(element, parts, format_tables=True):
+    """Append the stripped text of an lxml element to parts, like _collect_html_text_parts
     
-    return image_objects, text_content
+    <img> tags become "[Image: alt]" placeholders and, when format_tables is set, tables become
+    their formatted text (cells read with format_tables off, as nested tables were never formatted).
+    The element's tail is left to the caller.
+    """
+    tag = element.tag
+    if not isinstance(tag, str) or tag in _NON_TEXT_HTML_TAGS:
+        return parts  # Comments, processing instructions, scripts and styles
+    if tag == 'img':
+        parts.append(f"[Image: {element.get('alt', 'image')}]".strip())
+        return parts
+    if tag == 'table' and format_tables and next(element.iter('tr'), None) is not None:
+        parts.append(_format_table_text(
+            (' '.join(_collect_lxml_text_parts(cell, [], format_tables=False)) for cell in row.iter('td', 'th'))
+            for row in element.iter('tr')
+        ).strip())
+        return parts
+    
+    text = element.text.strip() if element.text else ''
+    if text:
+        parts.append(text)
+    for child in element:
+        _collect_lxml_text_parts(child, parts, format_tables)
+        tail = child.tail.strip() if child.tail else ''
+        if tail:
+            parts.append(tail)
+    return parts
+
+# lxml parsers are locked while parsing, so share one per thread rather than lxml.html's global
+# parser (which would serialize the extraction pool) or a fresh parser per call
+_HTML_PARSERS = threading.local()
+
+def _get_html_parser():
+    parser = getattr(_HTML_PARSERS, 'parser', None)
+    if parser is None:
+        parser = _HTML_PARSERS.parser = lxml.html.HTMLParser(recover=True, remove_blank_text=False)
+    return parser
 
 def extract_text_only_from_html(html_content):
     """Extract only text from HTML, replacing images with placeholders and formatting tables"""
     if not html_content:
         return ""
     
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if '<' not in html_content and '&' not in html_content:
+        return _plain_text_as_parsed(html_content).strip()  # Plain text, nothing to parse
     
-    # Replace img tags with text placeholders
-    for img in soup.find_all('img'):
-        alt_text = img.get('alt', 'image')
-        img.replace_with(f"[Image: {alt_text}]")
-    
-    # Process tables and replace with formatted text
-    for table in soup.find_all('table'):
-        table_text = extract_table_from_html(table)
-        if table_text:
-            table.replace_with(table_text)
+    # Straight lxml tree: this only reads text, so there is no need for BeautifulSoup's wrapper
+    try:
+        root = lxml.html.fromstring(html_content, parser=_get_html_parser())
+    except ParserError:
+        return ""  # Only whitespace or comments
     
-    return soup.get_text(separator='\n', strip=True)
+    return '\n'.join(_collect_lxml_text_parts(root, []))
 
 def get_azure_devops_connection(auth_token: str, org_url: str):
     """Create Azure DevOps connection using OAuth token"""
@@ -240,11 +446,202 @@ def index():
         'status': 'running'
     }), 200
 
-def call_ai_provider(ai_provider, prompt, images=None):
+def _iter_claude_stream_text(stream_manager, message_stream):
+    """Yield text deltas from an open Claude message stream, closing it when done"""
+    try:
+        for text in message_stream.text_stream:
+            yield text
+    finally:
+        stream_manager.__exit__(None, None, None)
+
+def _iter_gemini_stream_text(response):
+    """Yield the text of each chunk of a streamed Gemini response"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunk carries no text parts (e.g. only finish/safety metadata)
+            continue
+        if text:
+            yield text
+
+# Claude models in order of preference
+CLAUDE_MODELS = [
+    "claude-3-5-sonnet-20240620",
+    "claude-3-5-haiku-20241022",
+    "claude-3-opus-20240229",
+    "claude-3-sonnet-20240229"
+]
+# Model that last answered (there is only the one API key from the environment), so later
+# calls go straight to it instead of walking past unavailable models again
+_working_claude_model = None
+
+def _claude_models_to_try():
+    """CLAUDE_MODELS with the model that last worked moved to the front"""
+    working_model = _working_claude_model
+    if working_model is None:
+        return CLAUDE_MODELS
+    return [working_model] + [model for model in CLAUDE_MODELS if model != working_model]
+
+def _encode_image_for_claude(image):
+    """Return (media_type, base64 data) for an image, in a format Claude accepts"""
+    if isinstance(image, dict):
+        # Raw bytes from the data URI, already in a format Claude accepts
+        return image['mime_type'], base64.b64encode(image['data']).decode('ascii')
+    
+    # Convert PIL Image to base64
+    buffered = BytesIO()
+    
+    # Detect format and save accordingly
+    # Claude supports: image/jpeg, image/png, image/gif, image/webp
+    if image.format:
+        format_name = image.format.upper()
+        if format_name == 'JPEG':
+            image.save(buffered, format="JPEG")
+            media_type = "image/jpeg"
+        elif format_name == 'PNG':
+            image.save(buffered, format="PNG")
+            media_type = "image/png"
+        elif format_name == 'GIF':
+            image.save(buffered, format="GIF")
+            media_type = "image/gif"
+        elif format_name == 'WEBP':
+            image.save(buffered, format="WEBP")
+            media_type = "image/webp"
+        elif image.mode in ('RGBA', 'LA'):
+            # Keep the transparency of unknown formats
+            image.save(buffered, format="PNG")
+            media_type = "image/png"
+        else:
+            # Default to JPEG if format is unknown; lossless buys the model nothing
+            image.convert('RGB').save(buffered, format="JPEG", quality=85, optimize=True)
+            media_type = "image/jpeg"
+    else:
+        # No format detected (e.g. after the RGB conversion in extract_images_from_html):
+        # JPEG is several times smaller than PNG for screenshots
+        image.convert('RGB').save(buffered, format="JPEG", quality=85, optimize=True)
+        media_type = "image/jpeg"
+    
+    # Encode to base64
+    with buffered.getbuffer() as image_view:
+        return media_type, base64.b64encode(image_view).decode('ascii')
+
+class _RPMLimiter:
+    """Sliding-window requests-per-minute limit shared by every thread calling a provider"""
+    
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self._calls = deque()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request can be sent without exceeding the limit"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= 60:
+                    self._calls.popleft()
+                if len(self._calls) < self.rpm:
+                    self._calls.append(now)
+                    return
+                wait = 60 - (now - self._calls[0])
+            time.sleep(wait)
+
+# Every Gunicorn worker process throttles on its own, so the configured limits are split
+# between them (gunicorn.conf.py exports the worker count)
+_AI_WORKER_COUNT = max(1, int(os.getenv('GUNICORN_WORKERS', 1)))
+
+def _per_worker_limit(env_var, default):
+    return max(1, int(os.getenv(env_var, default)) // _AI_WORKER_COUNT)
+
+# Per-provider (concurrent requests, requests per minute) so bursts of users don't trigger 429s
+_AI_PROVIDER_LIMITS = {
+    'claude': (
+        threading.BoundedSemaphore(_per_worker_limit('CLAUDE_MAX_CONCURRENT_REQUESTS', 5)),
+        _RPMLimiter(_per_worker_limit('CLAUDE_REQUESTS_PER_MINUTE', 50))
+    ),
+    'gemini': (
+        threading.BoundedSemaphore(_per_worker_limit('GEMINI_MAX_CONCURRENT_REQUESTS', 8)),
+        _RPMLimiter(_per_worker_limit('GEMINI_REQUESTS_PER_MINUTE', 60))
+    ),
+}
+# Rough input budget per provider, checked once before the case type calls go out: a story over
+# it would fail every call after a round-trip anyway. Neither SDK tokenizes offline, so the count
+# is estimated at ~4 characters per token plus a flat cost per image.
+_MAX_INPUT_TOKENS = {
+    'claude': int(os.getenv('CLAUDE_MAX_INPUT_TOKENS', 180000)),
+    'gemini': int(os.getenv('GEMINI_MAX_INPUT_TOKENS', 1000000)),
+}
+_CHARS_PER_TOKEN = 4
+# Claude charges about width * height / 750 tokens after scaling images to ~1.15 megapixels
+_TOKENS_PER_IMAGE = 1600
+
+def _estimate_input_tokens(texts, image_count):
+    """Rough token count of a prompt made of texts plus image_count images"""
+    return sum(len(text) for text in texts if text) // _CHARS_PER_TOKEN + image_count * _TOKENS_PER_IMAGE
+
+# Rate-limit and server errors are retried with exponential backoff (1s, 2s, 4s; capped at 60s),
+# or after the Retry-After Claude sends if that is longer
+_AI_RETRY_ATTEMPTS = 3
+_AI_RETRY_BASE_DELAY = 1
+_AI_RETRY_MAX_DELAY = 60
+_RETRYABLE_AI_ERRORS = (
+    anthropic.RateLimitError,
+    anthropic.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+def _retryable_ai_error(error):
+    """The SDK rate-limit or server error behind error, or None if it shouldn't be retried
+    
+    _call_ai_provider_once raises most SDK errors as a ValueError chained to the original.
+    """
+    while error is not None:
+        if isinstance(error, _RETRYABLE_AI_ERRORS):
+            return error
+        if isinstance(error, anthropic.APIStatusError) and error.status_code >= 500:
+            return error
+        error = error.__cause__
+    return None
+
+def _ai_retry_delay(error, attempt):
+    """Seconds to wait before retrying after the retryable SDK error on the given attempt"""
+    delay = _AI_RETRY_BASE_DELAY * 2 ** attempt
+    if isinstance(error, anthropic.APIStatusError):
+        try:
+            delay = max(delay, float(error.response.headers.get('retry-after')))
+        except (TypeError, ValueError):
+            pass
+    return min(_AI_RETRY_MAX_DELAY, delay)
+
+def call_ai_provider(ai_provider, prompt, images=None, stream=False):
     """
     Call either Gemini or Claude API based on provider selection.
-    Returns the text response from the AI.
+    Returns the text response from the AI, or an iterator of text chunks when stream=True.
+    
+    Calls are throttled per provider and retried with backoff on rate-limit and server errors;
+    a stream counts against the concurrency limit only until its response starts.
     """
+    provider = 'claude' if ai_provider and ai_provider.lower() == 'claude' else 'gemini'
+    semaphore, rpm_limiter = _AI_PROVIDER_LIMITS[provider]
+    for attempt in range(_AI_RETRY_ATTEMPTS + 1):
+        with semaphore:
+            rpm_limiter.acquire()
+            try:
+                return _call_ai_provider_once(ai_provider, prompt, images, stream)
+            except Exception as e:
+                retryable_error = _retryable_ai_error(e)
+                if attempt == _AI_RETRY_ATTEMPTS or retryable_error is None:
+                    raise
+                error = e
+        delay = _ai_retry_delay(retryable_error, attempt)
+        log.warning("%s call failed (%s); retrying in %ss", provider, error, delay)
+        time.sleep(delay)
+
+def _call_ai_provider_once(ai_provider, prompt, images=None, stream=False):
+    """Single call_ai_provider request, without throttling or retries"""
+    global _working_claude_model
     ai_provider = ai_provider.lower() if ai_provider else 'gemini'
     
     if ai_provider == 'claude':
@@ -259,74 +656,59 @@ def call_ai_provider(ai_provider, prompt, images=None):
         
         # Add images if provided
         if images and len(images) > 0:
-            print(f"DEBUG: Converting {len(images)} images to base64 for Claude API")
-            for idx, image in enumerate(images):
+            log.debug("Converting %s images to base64 for Claude API", len(images))
+            def encode_image(indexed_image):
+                idx, image = indexed_image
                 try:
-                    # Convert PIL Image to base64
-                    buffered = BytesIO()
-                    
-                    # Detect format and save accordingly
-                    # Claude supports: image/jpeg, image/png, image/gif, image/webp
-                    if image.format:
-                        format_name = image.format.upper()
-                        if format_name == 'JPEG':
-                            image.save(buffered, format="JPEG")
-                            media_type = "image/jpeg"
-                        elif format_name == 'PNG':
-                            image.save(buffered, format="PNG")
-                            media_type = "image/png"
-                        elif format_name == 'GIF':
-                            image.save(buffered, format="GIF")
-                            media_type = "image/gif"
-                        elif format_name == 'WEBP':
-                            image.save(buffered, format="WEBP")
-                            media_type = "image/webp"
-                        else:
-                            # Default to PNG if format is unknown
-                            image.save(buffered, format="PNG")
-                            media_type = "image/png"
-                    else:
-                        # No format detected, default to PNG
-                        image.save(buffered, format="PNG")
-                        media_type = "image/png"
-                    
-                    # Encode to base64
-                    img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    
-                    # Add image to content array
-                    content.append({
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": img_base64
-                        }
-                    })
-                    print(f"DEBUG: Added image {idx + 1} to Claude message (format: {media_type})")
+                    return _encode_image_for_claude(image)
                 except Exception as e:
-                    print(f"WARNING: Failed to convert image {idx + 1} to base64: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    log.warning("Failed to convert image %s to base64: %s", idx + 1, e, exc_info=True)
                     # Continue with other images even if one fails
+                    return None
+            
+            # Pillow releases the GIL while encoding, so several images encode in parallel
+            with ThreadPoolExecutor(max_workers=min(4, len(images))) as executor:
+                encoded_images = list(executor.map(encode_image, enumerate(images)))
+            
+            for idx, encoded_image in enumerate(encoded_images):
+                if encoded_image is None:
+                    continue
+                media_type, img_base64 = encoded_image
+                # Add image to content array
+                content.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": img_base64
+                    }
+                })
+                log.debug("Added image %s to Claude message (format: %s)", idx + 1, media_type)
         
         # Create message with content array
         messages = [{"role": "user", "content": content}]
         
-        # Try different Claude models in order of preference
-        claude_models = [
-            "claude-3-5-sonnet-20240620",
-            "claude-3-5-haiku-20241022",
-            "claude-3-opus-20240229",
-            "claude-3-sonnet-20240229"
-        ]
+        # Use higher max_tokens for test case generation (can be large JSON arrays)
+        prompt_lower = prompt.lower()
+        max_tokens = 8192 if 'test case' in prompt_lower or 'json array' in prompt_lower else 4096
         
+        # Try Claude models in order of preference, starting with the one that last worked
         last_error = None
-        for model_name in claude_models:
+        for model_name in _claude_models_to_try():
             try:
-                print(f"DEBUG: Trying Claude model: {model_name}")
-                # Use higher max_tokens for test case generation (can be large JSON arrays)
-                max_tokens = 8192 if 'test case' in str(prompt).lower() or 'json array' in str(prompt).lower() else 4096
-                print(f"DEBUG: Using max_tokens={max_tokens} for Claude API call")
+                log.debug("Trying Claude model: %s", model_name)
+                log.debug("Using max_tokens=%s for Claude API call", max_tokens)
+                if stream:
+                    stream_manager = claude_client.messages.stream(
+                        model=model_name,
+                        max_tokens=max_tokens,
+                        messages=messages
+                    )
+                    # Entering the manager sends the request, so model/auth errors surface here
+                    message_stream = stream_manager.__enter__()
+                    _working_claude_model = model_name
+                    log.debug("Streaming response from Claude model: %s", model_name)
+                    return _iter_claude_stream_text(stream_manager, message_stream)
                 response = claude_client.messages.create(
                     model=model_name,
                     max_tokens=max_tokens,
@@ -341,7 +723,8 @@ def call_ai_provider(ai_provider, prompt, images=None):
                             text_parts.append(content_block.text)
                     result = ''.join(text_parts).strip()
                     if result:
-                        print(f"DEBUG: Successfully used Claude model: {model_name}")
+                        log.debug("Successfully used Claude model: %s", model_name)
+                        _working_claude_model = model_name
                         return result
                 
                 raise ValueError("Empty response from Claude API")
@@ -350,7 +733,7 @@ def call_ai_provider(ai_provider, prompt, images=None):
                 error_str = str(e)
                 # If it's a model not found error, try next model
                 if 'not_found_error' in error_str or '404' in error_str or 'model' in error_str.lower():
-                    print(f"DEBUG: Model {model_name} not available, trying next model...")
+                    log.debug("Model %s not available, trying next model...", model_name)
                     continue
                 else:
                     # For other errors, re-raise immediately
@@ -358,35 +741,38 @@ def call_ai_provider(ai_provider, prompt, images=None):
         
         # If all models failed, raise the last error
         if last_error:
-            raise ValueError(f"All Claude models failed. Last error: {str(last_error)}")
+            raise ValueError(f"All Claude models failed. Last error: {str(last_error)}") from last_error
         else:
             raise ValueError("Failed to get response from Claude API")
     
     else:  # Default to Gemini
         try:
-            model = genai.GenerativeModel('gemini-flash-latest')
+            model = gemini_model
             
             # Build content array with text and images
             content_parts = [prompt]
             if images and len(images) > 0:
-                print(f"DEBUG: Adding {len(images)} images to Gemini request")
+                log.debug("Adding %s images to Gemini request", len(images))
                 for image in images:
                     content_parts.append(image)
             
             # Send to Gemini with error handling
-            print(f"DEBUG: Sending request to Gemini with {len(content_parts)} content parts")
+            log.debug("Sending request to Gemini with %s content parts", len(content_parts))
             try:
                 if images and len(images) > 0:
-                    response = model.generate_content(content_parts)
+                    response = model.generate_content(content_parts, stream=stream)
                 else:
-                    response = model.generate_content(prompt)
+                    response = model.generate_content(prompt, stream=stream)
             except Exception as api_error:
-                print(f"ERROR: Gemini API call failed: {api_error}")
-                import traceback
-                traceback.print_exc()
-                raise ValueError(f"Gemini API call failed: {str(api_error)}")
+                log.exception("Gemini API call failed: %s", api_error)
+                raise ValueError(f"Gemini API call failed: {str(api_error)}") from api_error
             
-            print(f"DEBUG: Gemini response received, type: {type(response)}")
+            if stream:
+                # The first chunk is fetched eagerly, so API errors are still handled below
+                log.debug("Streaming Gemini response")
+                return _iter_gemini_stream_text(response)
+            
+            log.debug("Gemini response received, type: %s", type(response))
             
             # Check for blocking reasons
             if hasattr(response, 'prompt_feedback'):
@@ -399,34 +785,32 @@ def call_ai_provider(ai_provider, prompt, images=None):
                 result = response.text.strip()
                 if not result:
                     raise ValueError("Gemini returned empty response")
-                print(f"DEBUG: Extracted text from Gemini response.text, length: {len(result)}")
+                log.debug("Extracted text from Gemini response.text, length: %s", len(result))
                 return result
             else:
                 # Try to get text from candidates
-                print(f"DEBUG: response.text not available, trying candidates...")
+                log.debug("response.text not available, trying candidates...")
                 if hasattr(response, 'candidates') and response.candidates:
                     if hasattr(response.candidates[0], 'content'):
                         if hasattr(response.candidates[0].content, 'parts'):
                             parts = response.candidates[0].content.parts
                             result = ''.join([part.text for part in parts if hasattr(part, 'text')]).strip()
-                            print(f"DEBUG: Extracted text from candidates[0].content.parts, length: {len(result)}")
+                            log.debug("Extracted text from candidates[0].content.parts, length: %s", len(result))
                             return result
                         else:
                             result = str(response.candidates[0].content).strip()
-                            print(f"DEBUG: Extracted text from candidates[0].content, length: {len(result)}")
+                            log.debug("Extracted text from candidates[0].content, length: %s", len(result))
                             return result
                     else:
                         result = str(response.candidates[0]).strip()
-                        print(f"DEBUG: Extracted text from candidates[0], length: {len(result)}")
+                        log.debug("Extracted text from candidates[0], length: %s", len(result))
                         return result
                 else:
                     result = str(response).strip()
-                    print(f"DEBUG: Fallback: extracted text from response string, length: {len(result)}")
+                    log.debug("Fallback: extracted text from response string, length: %s", len(result))
                     return result
         except Exception as gemini_error:
-            print(f"ERROR in Gemini API call: {gemini_error}")
-            import traceback
-            traceback.print_exc()
+            log.exception("ERROR in Gemini API call: %s", gemini_error)
             error_str = str(gemini_error)
             
             # Check for quota/rate limit errors
@@ -444,63 +828,67 @@ def call_ai_provider(ai_provider, prompt, images=None):
                     error_msg += f"\n\nPlease wait approximately {retry_delay} seconds before retrying, or switch to Claude API provider."
                 else:
                     error_msg += "\n\nPlease wait a few minutes before retrying, or switch to Claude API provider."
-                raise ValueError(error_msg)
+                raise ValueError(error_msg) from gemini_error
             # Check for authentication errors
             elif '401' in error_str or '403' in error_str or 'authentication' in error_str.lower() or 'api_key' in error_str.lower():
-                raise ValueError(f"Gemini API authentication error: {error_str}. Please check your GEMINI_API_KEY.")
+                raise ValueError(f"Gemini API authentication error: {error_str}. Please check your GEMINI_API_KEY.") from gemini_error
             else:
-                raise ValueError(f"Gemini API error: {error_str}")
+                raise ValueError(f"Gemini API error: {error_str}") from gemini_error
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({'status': 'healthy'}), 200
 
-@app.route('/analyze_story', methods=['POST'])
-def analyze_story():
-    """Analyze a user story and provide structured review"""
-    print("DEBUG: /analyze_story endpoint called")
+# LRU of finished AI results keyed by a hash of everything that feeds the prompt, so asking
+# again for an unchanged story skips the provider round-trip. Entries expire after an hour;
+# ?refresh=1 on either endpoint bypasses the cache.
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_MAX_ENTRIES = 512
+_RESULT_CACHE_TTL_SECONDS = 3600
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def _result_cache_key(kind, parts, images):
+    """Content hash of an endpoint's inputs; images are hashed by their bytes"""
+    key = hashlib.blake2b(orjson.dumps([kind, parts]), digest_size=16)
+    for image in images:
+        key.update(hashlib.blake2b(image['data'], digest_size=16).digest())
+    return key.hexdigest()
+
+def _result_cache_get(cache_key):
+    """Return the cached result for cache_key, or None if missing or expired"""
+    if request.args.get('refresh') == '1':
+        return None
+    with _RESULT_CACHE_LOCK:
+        cached = _RESULT_CACHE.get(cache_key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[0] > _RESULT_CACHE_TTL_SECONDS:
+            del _RESULT_CACHE[cache_key]
+            return None
+        _RESULT_CACHE.move_to_end(cache_key)
+        return cached[1]
+
+def _result_cache_put(cache_key, result):
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[cache_key] = (time.monotonic(), result)
+        _RESULT_CACHE.move_to_end(cache_key)
+        while len(_RESULT_CACHE) > _RESULT_CACHE_MAX_ENTRIES:
+            _RESULT_CACHE.popitem(last=False)
+
+def _read_json_body():
+    """Parse the JSON request body with orjson straight from bytes.
     
-    # Get Authorization header for Azure DevOps token (if provided)
-    auth_header = request.headers.get('Authorization', '')
-    azure_devops_token = None
-    if auth_header.startswith('Bearer '):
-        azure_devops_token = auth_header[7:]
-    
-    try:
-        data = request.json or {}
-        print(f"DEBUG: Request data keys: {data.keys() if data else 'None'}")
-        
-        story_title = data.get('story_title')
-        story_description = data.get('story_description', '')
-        acceptance_criteria = data.get('acceptance_criteria', '')
-        related_test_cases = data.get('related_test_cases', '')
-        ai_provider = data.get('ai_provider', 'gemini')  # Default to Gemini
-        
-        print(f"DEBUG: Story title: {story_title}")
-        print(f"DEBUG: Story description length: {len(story_description)}")
-        print(f"DEBUG: Acceptance criteria length: {len(acceptance_criteria)}")
-        print(f"DEBUG: AI Provider: {ai_provider}")
-        
-        if not story_title:
-            print("ERROR: Story title is missing")
-            return jsonify({'error': 'Story Title is required.'}), 400
-        
-        # Extract images and text from HTML fields
-        desc_images, desc_text = extract_images_from_html(story_description)
-        ac_images, ac_text = extract_images_from_html(acceptance_criteria)
-        
-        # Collect all images
-        all_images = desc_images + ac_images
-        provider_name = "Gemini" if ai_provider.lower() != 'claude' else "Claude"
-        print(f"DEBUG: Found {len(all_images)} images to send to {provider_name}")
-        
-        # Build the prompt for analysis
-        test_cases_section = ""
-        if related_test_cases:
-            test_cases_section = f"\n\n**RELATED TEST CASES (if available):**\n{related_test_cases}"
-        
-        prompt = f"""**Role:** You are a Senior Expert Quality Control (QC) Engineer mentoring a team of testers.
+    cache=False keeps Flask from holding its own copy of payloads that can carry megabytes
+    of base64 screenshots; non-JSON requests still go through Flask's own checks.
+    """
+    if not request.is_json:
+        return request.json
+    raw = request.get_data(cache=False)
+    return orjson.loads(raw) if raw else {}
+
+# Story review prompt for analyze_story(); kept at module level so only the story fields are formatted per request
+_ANALYZE_PROMPT_TEMPLATE = """**Role:** You are a Senior Expert Quality Control (QC) Engineer mentoring a team of testers.
 
 **Objective:** Take the provided User Story and break it down so thoroughly and clearly that a QC Engineer can trust your explanation 100%. Your output must be the "single source of truth." The tester should **not need to read the original Azure ticket** to understand exactly what needs to be tested, why it matters, and how it works.
 
@@ -580,7 +968,7 @@ Here is the preferred HTML structure template (use this exact formatting; includ
 - Make sure all HTML is properly formatted and ready to be inserted directly into a webpage.
 
 **IMAGES PROVIDED:**
-{len(all_images)} image(s) have been included with this user story. You MUST:
+{image_count} image(s) have been included with this user story. You MUST:
 1. Examine each image carefully for visual requirements, UI elements, workflows, and states
 2. Compare what you see in images against the acceptance criteria rules
 3. Identify any visual elements, UI states, or design specifications shown in images that are NOT documented in the acceptance criteria
@@ -588,10 +976,71 @@ Here is the preferred HTML structure template (use this exact formatting; includ
 5. Flag missing visual documentation (error states, edge cases, different screen sizes, etc.)
 6. Reference specific images when identifying risks or ambiguities (e.g., "In Image 1, there is a [element] that is not mentioned in acceptance criteria...")
 """
+
+@app.route('/analyze_story', methods=['POST'])
+def analyze_story():
+    """Analyze a user story and provide structured review"""
+    log.debug("/analyze_story endpoint called")
+    
+    # Get Authorization header for Azure DevOps token (if provided)
+    auth_header = request.headers.get('Authorization', '')
+    azure_devops_token = None
+    if auth_header.startswith('Bearer '):
+        azure_devops_token = auth_header[7:]
+    
+    try:
+        data = _read_json_body() or {}
+        log.debug("Request data keys: %s", data.keys() if data else 'None')
+        
+        story_title = data.get('story_title')
+        story_description = data.get('story_description', '')
+        acceptance_criteria = data.get('acceptance_criteria', '')
+        related_test_cases = data.get('related_test_cases', '')
+        ai_provider = data.get('ai_provider') or 'gemini'  # Default to Gemini (also when sent as null)
+        
+        log.debug("Story title: %s", story_title)
+        log.debug("Story description length: %s", len(story_description))
+        log.debug("Acceptance criteria length: %s", len(acceptance_criteria))
+        log.debug("AI Provider: %s", ai_provider)
+        
+        if not story_title:
+            log.error("Story title is missing")
+            return jsonify({'error': 'Story Title is required.'}), 400
+        
+        # Extract images and text from HTML fields
+        (desc_images, desc_text), (ac_images, ac_text) = _HTML_EXTRACT_EXECUTOR.map(
+            partial(extract_images_from_html_cached, image_cache={}), (story_description, acceptance_criteria)
+        )
+        
+        # Collect all images, sending a screenshot pasted into both fields only once
+        all_images = _unique_images(desc_images + ac_images)
+        provider_name = "Gemini" if ai_provider.lower() != 'claude' else "Claude"
+        log.debug("Found %s images to send to %s", len(all_images), provider_name)
+        
+        # Build the prompt for analysis
+        test_cases_section = ""
+        if related_test_cases:
+            test_cases_section = f"\n\n**RELATED TEST CASES (if available):**\n{related_test_cases}"
         
-        print(f"DEBUG: Calling {provider_name} API for analysis...")
-        print(f"DEBUG: Prompt length: {len(prompt)}")
-        print(f"DEBUG: Number of images: {len(all_images)}")
+        prompt = _ANALYZE_PROMPT_TEMPLATE.format(
+            story_title=story_title,
+            desc_text=desc_text,
+            ac_text=ac_text,
+            test_cases_section=test_cases_section,
+            image_count=len(all_images)
+        )
+        
+        cache_key = _result_cache_key(
+            'analysis', [ai_provider.lower(), story_title, desc_text, ac_text, related_test_cases], all_images
+        )
+        cached_analysis = _result_cache_get(cache_key)
+        if cached_analysis is not None:
+            log.debug("Returning cached analysis for unchanged story")
+            return jsonify({'analysis': cached_analysis})
+        
+        log.debug("Calling %s API for analysis...", provider_name)
+        log.debug("Prompt length: %s", len(prompt))
+        log.debug("Number of images: %s", len(all_images))
         
         # Use the helper function to call the appropriate AI provider
         try:
@@ -601,28 +1050,18 @@ Here is the preferred HTML structure template (use this exact formatting; includ
                 raise ValueError(f"Empty analysis response from {provider_name} API")
             
             # Clean up the response - remove markdown code blocks if present
-            analysis_text = analysis_text.strip()
-            if analysis_text.startswith('```'):
-                lines = analysis_text.split('\n')
-                if lines[0].startswith('```'):
-                    lines = lines[1:]
-                if lines and lines[-1].strip() == '```':
-                    lines = lines[:-1]
-                analysis_text = '\n'.join(lines).strip()
+            analysis_text = _strip_code_fence(analysis_text.strip())
             
-            print(f"DEBUG: Successfully extracted analysis text, length: {len(analysis_text)}")
+            log.debug("Successfully extracted analysis text, length: %s", len(analysis_text))
+            _result_cache_put(cache_key, analysis_text)
             
         except Exception as extract_error:
-            print(f"ERROR extracting text from response: {extract_error}")
-            import traceback
-            traceback.print_exc()
+            log.exception("ERROR extracting text from response: %s", extract_error)
             raise ValueError(f"Failed to extract text from {provider_name} response: {str(extract_error)}")
         
         return jsonify({'analysis': analysis_text})
     except Exception as e:
-        import traceback
-        print(f"Error generating analysis: {e}")
-        traceback.print_exc()
+        log.exception("Error generating analysis: %s", e)
         return jsonify({'error': str(e)}), 500
 
 def _ac_step_body(line):
@@ -798,113 +1237,161 @@ def _detect_steps_in_acceptance_criteria(acceptance_criteria):
             # Prefer block with most procedural verbs (user's actual test steps)
             best = max(blocks, key=lambda b: sum(1 for s in b if procedural_verbs.search(s)))
             normalized_steps = best
-            print(f"DEBUG: _detect_steps_in_acceptance_criteria: Multiple blocks found, using procedural block ({len(normalized_steps)} steps)")
+            log.debug("_detect_steps_in_acceptance_criteria: Multiple blocks found, using procedural block (%s steps)", len(normalized_steps))
         normalized_steps = _strip_leading_non_actionable_ac_steps(normalized_steps)
         if not normalized_steps:
-            print(f"DEBUG: _detect_steps_in_acceptance_criteria: No actionable steps after filtering")
+            log.debug("_detect_steps_in_acceptance_criteria: No actionable steps after filtering")
             return False, ""
         steps_text = '\n'.join(normalized_steps)
-        print(f"DEBUG: _detect_steps_in_acceptance_criteria: Found {len(normalized_steps)} steps")
+        log.debug("_detect_steps_in_acceptance_criteria: Found %s steps", len(normalized_steps))
         return True, steps_text
     
-    print(f"DEBUG: _detect_steps_in_acceptance_criteria: No steps found")
+    log.debug("_detect_steps_in_acceptance_criteria: No steps found")
     return False, ""
 
-def _generate_cases_for_type(ai_provider, story_title, story_description, acceptance_criteria, data_dictionary, case_type, related_stories=None, images=None, ambiguity_aware=True):
-    """Generate test cases for a specific type, optionally including images
-    
-    Args:
-        ai_provider: AI provider to use ('gemini' or 'claude')
-        story_title: Title of the user story
-        story_description: Description of the user story
-        acceptance_criteria: Acceptance criteria text
-        data_dictionary: Data dictionary text
-        case_type: Type of test cases to generate ('Positive', 'Negative', 'Edge Case', 'Data Flow')
-        related_stories: List of related user stories
-        images: List of PIL Image objects
-        ambiguity_aware: If True, include ambiguity-aware test case generation (default: True)
-    """
-    ai_provider = ai_provider.lower() if ai_provider else 'gemini'
-    print(f"DEBUG: _generate_cases_for_type called for {case_type} using {ai_provider}. related_stories:", related_stories)
-    print(f"DEBUG: Ambiguity-aware generation: {ambiguity_aware}")
-    if images:
-        print(f"DEBUG: Including {len(images)} images in test case generation")
-    
-    # Detect steps in acceptance criteria, or in story description if none in acceptance criteria
-    has_steps, steps_text = _detect_steps_in_acceptance_criteria(acceptance_criteria)
-    if not has_steps and story_description:
-        has_steps, steps_text = _detect_steps_in_acceptance_criteria(story_description)
-        if has_steps:
-            print(f"DEBUG: Detected steps in story description (none in acceptance criteria). Steps found: {len(steps_text.splitlines())}")
-    steps_text_escaped = ""
-    if has_steps:
-        step_count = len(steps_text.split('\n'))
-        print(f"DEBUG: Detected steps in acceptance criteria/description. Steps found: {step_count}")
-        print(f"DEBUG: Steps content (first 500 chars): {steps_text[:500]}")
-        # Escape the steps text for use in f-string
-        steps_text_escaped = steps_text.replace('{', '{{').replace('}', '}}')
-    else:
-        print(f"DEBUG: No steps detected in acceptance criteria. Content preview: {acceptance_criteria[:200] if acceptance_criteria else 'None'}")
-    
-    guideline_map = {
-        "Positive": """
-**Positive Test Case Guidelines:**
-- Verify the core functionality works as expected under normal conditions.
-- **CRITICAL: Generate comprehensive positive test cases with NO LIMIT based on the user story requirements.**
-- **Cover ALL acceptance criteria:** Create separate positive test cases for EACH acceptance criterion. If there are 10 acceptance criteria, generate at least 10 positive test cases (one per criterion, plus additional test cases for variations and workflows).
-- **Cover ALL valid scenarios:** Generate test cases for ALL valid input scenarios from the data dictionary - create separate test cases for each valid field, valid combination, and valid workflow.
-- **Cover ALL successful workflows:** Include test cases for ALL successful workflows and happy paths described in the user story title, description, and acceptance criteria.
-- **Pagination (for lists):** Generate positive test cases for ALL pagination scenarios (first page, last page, middle pages, navigation controls, page size variations) - create separate test cases for each scenario.
-- **Boundary Values (for numeric fields):** Generate positive test cases for ALL valid boundary values (minimum, maximum, zero if allowed, just within limits) - create separate test cases for each boundary value.
-- **NO ARTIFICIAL LIMITS:** Do NOT limit the number of positive test cases. Generate as many test cases as needed to comprehensively cover:
-  * Every acceptance criterion (at least one test case per criterion, often more)
-  * Every valid input scenario from the data dictionary
-  * Every successful workflow and happy path
-  * Every valid combination of inputs that is meaningful
-  * Every valid boundary value for numeric fields
-  * Every pagination scenario for lists
-- **Comprehensive Coverage Principle:** The goal is to ensure that every aspect of the user story (title, description, acceptance criteria) is covered by positive test cases. Generate enough test cases to provide complete coverage without any artificial constraints.
-- **Title Examples:** "[Positive] User successfully creates account with valid information", "[Positive] System saves data when all required fields are completed", "[Positive] Pagination controls work correctly when navigating to page 2", "[Positive] System accepts minimum value (0) for quantity field".""",
-        "Negative": """
-**Negative Test Case Guidelines:**
-- **CRITICAL: You MUST ALWAYS generate negative test cases, even for simple stories. Every user story has potential failure scenarios that need to be tested.**
-- Test scenarios where inputs are invalid, missing, or unexpected.
-- Create SEPARATE test cases for each type of invalid input.
-- Verify that appropriate error messages are displayed when failures occur.
-- **If no explicit validation rules are mentioned in the story, generate negative test cases for common scenarios:**
-  * Missing required fields/inputs
-  * Invalid data formats (if applicable)
-  * Empty/null values where data is expected
-  * Invalid user actions or workflows
-  * System errors or failure conditions
-- **Generate 3-12 negative test cases** for most stories, focusing on critical validation rules and common error scenarios. **Minimum: Generate at least 3 negative test cases even for simple stories.**
-- **Title Examples:** "[Negative] System shows error when email field is empty", "[Negative] Application prevents login with invalid password format".""",
-        "Edge Case": """
-**Edge Case & Boundary Guidelines:**
-- Test boundary conditions from the data dictionary (min/max values, etc.).
-- Include scenarios with unexpected user behavior or timing.
-- Test performance under special circumstances (e.g., large data sets, slow networks).
-- **Title Examples:** "[Edge Case] System handles maximum character limit in description field", "[Edge Case] Application maintains functionality during network interruption".""",
-        "Data Flow": """
-**Data Flow Guidelines:**
-- Verify how data moves through the system from input to storage and output.
-- Track data through an entire workflow to verify integrity.
-- Test data persistence (saving) and retrieval (loading).
-- **Title Examples:** "[Data Flow] User data persists correctly through complete registration workflow", "[Data Flow] System maintains data integrity when transferring between modules"."""
-    }
-    
-    specific_guidelines = guideline_map.get(case_type, "- Follow standard best practices for this test type.")
+def _build_story_context(story_title, story_description, acceptance_criteria, data_dictionary, related_stories=None):
+    """Render the User Story Details block (including related stories) shared by every case type's prompt"""
     related_block = ""
     if related_stories and len(related_stories) > 0:
         related_instruction = "When generating test cases, take into account not only the main user story but also the context and requirements described in the related user stories below."
         related_block = f"\n**Instruction:** {related_instruction}\n**Related User Stories:**\n" + "\n".join([
             f"- Title: {r.get('title', '')}\n  Description: {r.get('description', '')}\n  Acceptance Criteria: {r.get('acceptance_criteria', '')}" for r in related_stories
         ])
+    return f"""**User Story Details:**
+- **Title:** {story_title}
+- **Description:** {story_description}
+- **Acceptance Criteria:** {acceptance_criteria}
+- **Data Dictionary:** {data_dictionary}
+{related_block}"""
+
+def _iter_json_array_items(chunks, text_parts=None):
+    """Yield each top-level object of the first JSON array in a stream of text chunks
+    as soon as its closing brace arrives.
+
+    Every chunk is also appended to ``text_parts`` (if given) so the caller can fall
+    back to parsing the full response.
+    """
+    buffer = ''
+    pos = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    item_start = None
+    array_closed = False
+    for chunk in chunks:
+        if text_parts is not None:
+            text_parts.append(chunk)
+        if array_closed:
+            continue
+        buffer += chunk
+        while pos < len(buffer):
+            ch = buffer[pos]
+            if depth == 0:
+                # Skip any preamble (prose, ```json fence) until the array opens
+                if ch == '[':
+                    depth = 1
+            elif in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in '[{':
+                if depth == 1 and ch == '{':
+                    item_start = pos
+                depth += 1
+            elif ch in ']}':
+                depth -= 1
+                if depth == 1 and item_start is not None:
+                    try:
+                        yield orjson.loads(buffer[item_start:pos + 1])
+                    except json.JSONDecodeError:
+                        pass
+                    item_start = None
+                elif depth == 0:
+                    array_closed = True
+                    break
+            pos += 1
+        # Drop the already-scanned text, keeping any object that is still open
+        keep_from = item_start if item_start is not None else pos
+        buffer = buffer[keep_from:]
+        pos -= keep_from
+        if item_start is not None:
+            item_start = 0
+
+# Brackets and string openers while scanning for the end of a JSON array; strings are
+# skipped whole so brackets inside them don't count
+_JSON_ARRAY_TOKEN_RE = re.compile(r'[\[\]"]')
+_JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json_array(text):
+    """Return the first JSON array in text (e.g. after a prose preamble), or None if none is closed
     
-    # Build ambiguity-aware section conditionally
-    ambiguity_section = ""
-    if ambiguity_aware:
-        ambiguity_section = """
+    Well-formed output is decoded in one C pass with raw_decode; otherwise the first '[' is
+    matched to its closing ']' with a linear scan, so trailing text containing ']' is left out.
+    """
+    start = text.find('[')
+    if start == -1:
+        return None
+    try:
+        return text[start:_JSON_DECODER.raw_decode(text, start)[1]]
+    except ValueError:
+        pass
+    depth = 0
+    pos = start
+    while True:
+        token = _JSON_ARRAY_TOKEN_RE.search(text, pos)
+        if token is None:
+            return None
+        if token.group() == '"':
+            string_match = _JSON_STRING_RE.match(text, token.start())
+            if string_match is None:
+                return None  # Unterminated string: the response was cut off
+            pos = string_match.end()
+            continue
+        depth += 1 if token.group() == '[' else -1
+        if depth == 0:
+            return text[start:token.end()]
+        pos = token.end()
+
+def _strip_code_fence(text):
+    """Drop the opening ```lang line and, if present, the closing ``` line from stripped text"""
+    if not text.startswith('```'):
+        return text
+    # Slice rather than split into lines: responses can be many KB
+    first_newline = text.find('\n')
+    if first_newline == -1:
+        return ''
+    last_newline = text.rfind('\n')
+    body_end = last_newline if text[last_newline + 1:].strip() == '```' else len(text)
+    return text[first_newline + 1:body_end].strip()
+
+# Prompt pieces for _generate_cases_for_type(), formatted per case type.
+# Used when steps were detected in the acceptance criteria or description
+_PROVIDED_STEPS_SECTION_TEMPLATE = """
+**CRITICAL: USER-PROVIDED UI STEPS — MANDATORY BEGINNING OF `description`:**
+The steps below were detected as concrete user-provided steps. Every test case `description` MUST start with these steps exactly (same order and wording), then continue with more numbered steps until the scenario in the **title** and **expectedResult** is fully covered.
+
+1. **ALWAYS START WITH THE PROVIDED STEPS** in `description` (not in `preConditions`).
+
+2. **THEN ADD STEPS** that complete the specific test case (filters, search, assertions on screen). Do NOT add standalone filter names or section headings as steps.
+
+3. **FORBIDDEN:** Do NOT prepend lines like "Policy Expiry Range" or "Renewal Status" as standalone steps unless they are part of a full imperative sentence.
+
+4. **Numbering:** One continuous sequence (1., 2., …). Provided steps keep their numbers; your added steps continue.
+
+5. **Steps provided by user (MUST appear first in `description`, then add more):**
+{steps_text}
+
+**VALIDATION CHECK:** Each test case's `description` must begin with the provided steps above, then additional actionable UI steps. Put data setup in `preConditions` when you use that field (see JSON format).
+"""
+
+# Added to every case type prompt when ambiguity-aware generation is on
+_AMBIGUITY_SECTION = """
 **AMBIGUITY-AWARE TEST CASE GENERATION:**
 When generating test cases, pay special attention to any ambiguities, contradictions, or unclear requirements in the acceptance criteria. These ambiguities should inform your test case generation, BUT with limits and prioritization:
 
@@ -942,31 +1429,25 @@ When generating test cases, pay special attention to any ambiguities, contradict
    - If permissions or roles are unclear, create **maximum 2 test cases** for the most critical permission scenarios
    - Focus on security-critical ambiguities first
    - Prioritize scenarios that could lead to unauthorized access
-"""
-    
-    # Build steps section if steps are detected in acceptance criteria
-    steps_section = ""
-    if has_steps:
-        steps_section = f"""
-**CRITICAL: USER-PROVIDED UI STEPS — MANDATORY BEGINNING OF `description`:**
-The steps below were detected as concrete user-provided steps. Every test case `description` MUST start with these steps exactly (same order and wording), then continue with more numbered steps until the scenario in the **title** and **expectedResult** is fully covered.
-
-1. **ALWAYS START WITH THE PROVIDED STEPS** in `description` (not in `preConditions`).
-
-2. **THEN ADD STEPS** that complete the specific test case (filters, search, assertions on screen). Do NOT add standalone filter names or section headings as steps.
-
-3. **FORBIDDEN:** Do NOT prepend lines like "Policy Expiry Range" or "Renewal Status" as standalone steps unless they are part of a full imperative sentence.
-
-4. **Numbering:** One continuous sequence (1., 2., …). Provided steps keep their numbers; your added steps continue.
-
-5. **Steps provided by user (MUST appear first in `description`, then add more):**
-{steps_text_escaped}
-
-**VALIDATION CHECK:** Each test case's `description` must begin with the provided steps above, then additional actionable UI steps. Put data setup in `preConditions` when you use that field (see JSON format).
 """
 
-    else:
-        steps_section = f"""
+# Wording in acceptance criteria that suggests ambiguity, contradictions or vague requirements.
+# _AMBIGUITY_SECTION is a large part of every prompt, so it is only added when the story has
+# one of these signals (?force_ambiguity=1 on /generate_test_cases always adds it).
+_AMBIGUITY_SIGNAL_RE = re.compile(
+    r'\b(?:no need|not (?:needed|required)|however|although|though|unless|except|'
+    r'vague|unclear|tbd|tba|tbc|maybe|possibly|perhaps|optional(?:ly)?|and/or|etc|fixme|todo|'
+    r'contradict\w*|quickly|appropriate(?:ly)?|user[- ]friendly|reasonable|as needed|if possible)\b'
+    r'|\?',
+    re.IGNORECASE
+)
+
+def _has_ambiguity_signals(acceptance_criteria):
+    """Whether acceptance_criteria contains wording that _AMBIGUITY_SECTION should be applied to"""
+    return bool(acceptance_criteria) and _AMBIGUITY_SIGNAL_RE.search(acceptance_criteria) is not None
+
+# Used when the story provides no steps of its own
+_GENERATED_STEPS_SECTION_TEMPLATE = """
 **GENERATE STEPS ACCORDING TO EACH TEST CASE TITLE AND CONTEXT:**
 The user has not provided explicit mandatory steps. Generate appropriate steps for each test case. The `description` field must be **specific to that test case** and aligned with its **title** and **type** ({case_type}).
 
@@ -979,15 +1460,11 @@ The user has not provided explicit mandatory steps. Generate appropriate steps f
 4. **Consistency:** `description`, `preConditions` (if any), and `expectedResult` must align with the `title`.
 """
 
-    prompt = f"""
+# Full prompt for one case type
+_CASES_PROMPT_TEMPLATE = """
 You are an expert test case generator for Azure DevOps with a focus on comprehensive test coverage. Your task is to generate a JSON array of ONLY the **{case_type}** test cases for the user story below.
 
-**User Story Details:**
-- **Title:** {story_title}
-- **Description:** {story_description}
-- **Acceptance Criteria:** {acceptance_criteria}
-- **Data Dictionary:** {data_dictionary}
-{related_block}
+{story_context}
 
 **IMAGES PROVIDED:**
 If images are included with the user story, please analyze them carefully and reference their content when generating test cases. The images may show UI mockups, workflows, or visual requirements that should be covered in the test cases.
@@ -1069,58 +1546,9 @@ Now, generate ONLY the `{case_type}` test cases based on all these instructions.
 
 **CRITICAL: You MUST return ONLY a valid JSON array. Do not include any explanatory text, markdown formatting, or code blocks. Return ONLY the JSON array starting with [ and ending with ].**
 """
-    try:
-        # Use the helper function to call the appropriate AI provider
-        response_text = call_ai_provider(ai_provider, prompt, images if images and len(images) > 0 else None)
-        
-        provider_name = "Gemini" if ai_provider != 'claude' else "Claude"
-        print(f"DEBUG: Raw {provider_name} response for {case_type} (length: {len(response_text)}):\n{response_text[:500]}...\n--- End Response Preview ---\n")
-        
-        if not response_text or len(response_text.strip()) == 0:
-            print(f"ERROR: Empty response from {provider_name} for {case_type}")
-            return "[]"
-        
-        # Clean the response to get a clean JSON array string
-        # Remove markdown code blocks
-        clean_json_text = response_text.strip()
-        
-        # Remove markdown code block markers
-        if clean_json_text.startswith('```'):
-            # Find the first newline after ```
-            lines = clean_json_text.split('\n')
-            if lines[0].startswith('```'):
-                # Remove first line (```json or ```)
-                lines = lines[1:]
-            # Remove last line if it's just ```
-            if lines and lines[-1].strip() == '```':
-                lines = lines[:-1]
-            clean_json_text = '\n'.join(lines).strip()
-        
-        # Try to find JSON array in the response
-        # Look for array pattern: [ ... ]
-        json_match = re.search(r'\[.*\]', clean_json_text, re.DOTALL)
-        if json_match:
-            clean_json_text = json_match.group(0)
-            print(f"DEBUG: Extracted JSON array from {provider_name} response (length: {len(clean_json_text)})")
-        else:
-            print(f"WARNING: No JSON array found in {provider_name} response. Full response:\n{clean_json_text[:1000]}")
-            # Try to parse as-is anyway
-            pass
-        
-        # Validate JSON before returning
-        try:
-            test_parse = json.loads(clean_json_text)
-            if not isinstance(test_parse, list):
-                print(f"ERROR: {provider_name} response is not a JSON array. Type: {type(test_parse)}")
-                return "[]"
-            if len(test_parse) == 0:
-                print(f"WARNING: {provider_name} returned empty array for {case_type}")
-                print(f"DEBUG: Full response was: {clean_json_text[:1000]}")
-                # For negative test cases, try to generate fallback cases if empty
-                if case_type == "Negative":
-                    print(f"WARNING: Empty negative test cases detected. Attempting fallback generation...")
-                    # Create a more explicit prompt for negative cases
-                    fallback_prompt = f"""
+
+# Retry prompt when the Negative pass comes back empty
+_NEGATIVE_FALLBACK_PROMPT_TEMPLATE = """
 You are generating negative test cases for a user story. The previous attempt returned an empty array, which is not acceptable.
 
 **User Story:**
@@ -1148,52 +1576,246 @@ Return ONLY a JSON array with at least 3 negative test cases following this form
 
 Return ONLY the JSON array, no other text.
 """
-                    try:
-                        fallback_response = call_ai_provider(
-                            ai_provider,
-                            fallback_prompt,
-                            images if images and len(images) > 0 else None
-                        )
-                        # Clean and parse fallback response
-                        fallback_clean = fallback_response.strip()
-                        if fallback_clean.startswith('```'):
-                            lines = fallback_clean.split('\n')
-                            if lines[0].startswith('```'):
-                                lines = lines[1:]
-                            if lines and lines[-1].strip() == '```':
-                                lines = lines[:-1]
-                            fallback_clean = '\n'.join(lines).strip()
-                        
-                        json_match = re.search(r'\[.*\]', fallback_clean, re.DOTALL)
-                        if json_match:
-                            fallback_clean = json_match.group(0)
-                        
-                        fallback_parse = json.loads(fallback_clean)
-                        if isinstance(fallback_parse, list) and len(fallback_parse) > 0:
-                            print(f"SUCCESS: Fallback generated {len(fallback_parse)} negative test cases")
-                            return json.dumps(fallback_parse)
-                        else:
-                            print(f"WARNING: Fallback also returned empty array")
-                    except Exception as fallback_err:
-                        print(f"ERROR: Fallback generation failed: {fallback_err}")
+
+# Type-specific guidance dropped into _CASES_PROMPT_TEMPLATE
+_GUIDELINE_MAP = {
+    "Positive": """
+**Positive Test Case Guidelines:**
+- Verify the core functionality works as expected under normal conditions.
+- **CRITICAL: Generate comprehensive positive test cases with NO LIMIT based on the user story requirements.**
+- **Cover ALL acceptance criteria:** Create separate positive test cases for EACH acceptance criterion. If there are 10 acceptance criteria, generate at least 10 positive test cases (one per criterion, plus additional test cases for variations and workflows).
+- **Cover ALL valid scenarios:** Generate test cases for ALL valid input scenarios from the data dictionary - create separate test cases for each valid field, valid combination, and valid workflow.
+- **Cover ALL successful workflows:** Include test cases for ALL successful workflows and happy paths described in the user story title, description, and acceptance criteria.
+- **Pagination (for lists):** Generate positive test cases for ALL pagination scenarios (first page, last page, middle pages, navigation controls, page size variations) - create separate test cases for each scenario.
+- **Boundary Values (for numeric fields):** Generate positive test cases for ALL valid boundary values (minimum, maximum, zero if allowed, just within limits) - create separate test cases for each boundary value.
+- **NO ARTIFICIAL LIMITS:** Do NOT limit the number of positive test cases. Generate as many test cases as needed to comprehensively cover:
+  * Every acceptance criterion (at least one test case per criterion, often more)
+  * Every valid input scenario from the data dictionary
+  * Every successful workflow and happy path
+  * Every valid combination of inputs that is meaningful
+  * Every valid boundary value for numeric fields
+  * Every pagination scenario for lists
+- **Comprehensive Coverage Principle:** The goal is to ensure that every aspect of the user story (title, description, acceptance criteria) is covered by positive test cases. Generate enough test cases to provide complete coverage without any artificial constraints.
+- **Title Examples:** "[Positive] User successfully creates account with valid information", "[Positive] System saves data when all required fields are completed", "[Positive] Pagination controls work correctly when navigating to page 2", "[Positive] System accepts minimum value (0) for quantity field".""",
+    "Negative": """
+**Negative Test Case Guidelines:**
+- **CRITICAL: You MUST ALWAYS generate negative test cases, even for simple stories. Every user story has potential failure scenarios that need to be tested.**
+- Test scenarios where inputs are invalid, missing, or unexpected.
+- Create SEPARATE test cases for each type of invalid input.
+- Verify that appropriate error messages are displayed when failures occur.
+- **If no explicit validation rules are mentioned in the story, generate negative test cases for common scenarios:**
+  * Missing required fields/inputs
+  * Invalid data formats (if applicable)
+  * Empty/null values where data is expected
+  * Invalid user actions or workflows
+  * System errors or failure conditions
+- **Generate 3-12 negative test cases** for most stories, focusing on critical validation rules and common error scenarios. **Minimum: Generate at least 3 negative test cases even for simple stories.**
+- **Title Examples:** "[Negative] System shows error when email field is empty", "[Negative] Application prevents login with invalid password format".""",
+    "Edge Case": """
+**Edge Case & Boundary Guidelines:**
+- Test boundary conditions from the data dictionary (min/max values, etc.).
+- Include scenarios with unexpected user behavior or timing.
+- Test performance under special circumstances (e.g., large data sets, slow networks).
+- **Title Examples:** "[Edge Case] System handles maximum character limit in description field", "[Edge Case] Application maintains functionality during network interruption".""",
+    "Data Flow": """
+**Data Flow Guidelines:**
+- Verify how data moves through the system from input to storage and output.
+- Track data through an entire workflow to verify integrity.
+- Test data persistence (saving) and retrieval (loading).
+- **Title Examples:** "[Data Flow] User data persists correctly through complete registration workflow", "[Data Flow] System maintains data integrity when transferring between modules"."""
+}
+
+def _generate_cases_for_type(ai_provider, story_title, story_description, acceptance_criteria, data_dictionary, case_type, related_stories=None, images=None, ambiguity_aware=True, story_context=None):
+    """Generate test cases for a specific type, optionally including images
+    
+    Yields each test case dict as soon as the AI provider has streamed it completely.
+    Provider errors are raised, so generate() reports the case type as failed and
+    leaves the run out of the result cache.
+    
+    Args:
+        ai_provider: AI provider to use ('gemini' or 'claude')
+        story_title: Title of the user story
+        story_description: Description of the user story
+        acceptance_criteria: Acceptance criteria text
+        data_dictionary: Data dictionary text
+        case_type: Type of test cases to generate ('Positive', 'Negative', 'Edge Case', 'Data Flow')
+        related_stories: List of related user stories
+        images: List of images from extract_images_from_html (mime_type/data dicts)
+        ambiguity_aware: If True, include ambiguity-aware test case generation (default: True)
+        story_context: Optional pre-rendered User Story Details block from _build_story_context,
+            so callers generating several case types render it only once
+    """
+    ai_provider = ai_provider.lower() if ai_provider else 'gemini'
+    log.debug("_generate_cases_for_type called for %s using %s. related_stories: %s", case_type, ai_provider, related_stories)
+    log.debug("Ambiguity-aware generation: %s", ambiguity_aware)
+    if images:
+        log.debug("Including %s images in test case generation", len(images))
+    
+    # Detect steps in acceptance criteria, or in story description if none in acceptance criteria
+    has_steps, steps_text = _detect_steps_in_acceptance_criteria(acceptance_criteria)
+    if not has_steps and story_description:
+        has_steps, steps_text = _detect_steps_in_acceptance_criteria(story_description)
+        if has_steps:
+            log.debug("Detected steps in story description (none in acceptance criteria). Steps found: %s", len(steps_text.splitlines()))
+    steps_text_escaped = ""
+    if has_steps:
+        step_count = len(steps_text.split('\n'))
+        log.debug("Detected steps in acceptance criteria/description. Steps found: %s", step_count)
+        log.debug("Steps content (first 500 chars): %.500s", steps_text)
+        # Escape the steps text for use in f-string
+        steps_text_escaped = steps_text.replace('{', '{{').replace('}', '}}')
+    else:
+        log.debug("No steps detected in acceptance criteria. Content preview: %.200s", acceptance_criteria or 'None')
+    
+    specific_guidelines = _GUIDELINE_MAP.get(case_type, "- Follow standard best practices for this test type.")
+    if story_context is None:
+        story_context = _build_story_context(story_title, story_description, acceptance_criteria, data_dictionary, related_stories)
+    
+    # Build ambiguity-aware section conditionally
+    ambiguity_section = ""
+    if ambiguity_aware:
+        ambiguity_section = _AMBIGUITY_SECTION
+    
+    # Build steps section if steps are detected in acceptance criteria
+    steps_section = ""
+    if has_steps:
+        steps_section = _PROVIDED_STEPS_SECTION_TEMPLATE.format(steps_text=steps_text_escaped)
+
+    else:
+        steps_section = _GENERATED_STEPS_SECTION_TEMPLATE.format(case_type=case_type)
+
+    prompt = _CASES_PROMPT_TEMPLATE.format(
+        case_type=case_type,
+        story_context=story_context,
+        steps_section=steps_section,
+        ambiguity_section=ambiguity_section,
+        specific_guidelines=specific_guidelines
+    )
+    # Stream the response so each test case reaches the client as soon as it is complete
+    response_parts = []
+    response_chunks = call_ai_provider(ai_provider, prompt, images or None, stream=True)
+    streamed_count = 0
+    for test_case in _iter_json_array_items(response_chunks, response_parts):
+        streamed_count += 1
+        yield test_case
+    if streamed_count:
+        log.debug("Streamed %s %s test cases", streamed_count, case_type)
+        return
+    
+    # Nothing usable was streamed (empty array, prose, truncated output):
+    # run the buffered clean-up and recovery path on the full response
+    response_text = ''.join(response_parts)
+    yield from _parse_cases_response(
+        response_text, ai_provider, case_type, story_title, story_description, acceptance_criteria, images
+    )
+
+def _parse_cases_response(response_text, ai_provider, case_type, story_title, story_description, acceptance_criteria, images=None):
+    """Clean a full AI response into a list of test cases
+    
+    Strips markdown fences, recovers truncated arrays and retries an empty Negative
+    result with a fallback prompt. Returns [] when nothing usable was produced.
+    """
+    provider_name = "Gemini" if ai_provider != 'claude' else "Claude"
+    log.debug("Raw %s response for %s (length: %s):\n%.500s...\n--- End Response Preview ---\n", provider_name, case_type, len(response_text), response_text)
+    
+    if not response_text or len(response_text.strip()) == 0:
+        log.error("Empty response from %s for %s", provider_name, case_type)
+        return []
+    
+    # Clean the response to get a clean JSON array string
+    # Remove markdown code blocks
+    clean_json_text = response_text.strip()
+    
+    # Remove markdown code block markers
+    clean_json_text = _strip_code_fence(clean_json_text)
+    
+    # Well-behaved responses are only the array, so parse as-is before searching for one
+    try:
+        test_parse = orjson.loads(clean_json_text)
+    except json.JSONDecodeError:
+        test_parse = None
+    
+    # Validate JSON before returning
+    try:
+        if not isinstance(test_parse, list):
+            # Try to find JSON array in the response (after a preamble, inside an object, ...)
+            json_array = _extract_json_array(clean_json_text)
+            if json_array:
+                clean_json_text = json_array
+                log.debug("Extracted JSON array from %s response (length: %s)", provider_name, len(clean_json_text))
             else:
-                print(f"DEBUG: Successfully parsed {len(test_parse)} test cases from {provider_name} for {case_type}")
-        except json.JSONDecodeError as json_err:
-            print(f"ERROR: Invalid JSON from {provider_name} for {case_type}: {json_err}")
-            print(f"DEBUG: Attempted to parse: {clean_json_text[:500]}...")
-            return "[]"
-        
-        return clean_json_text
-    except Exception as e:
-        import traceback
-        print(f"ERROR generating {case_type} cases: {e}")
-        traceback.print_exc()
-        return "[]"
+                log.warning("No JSON array found in %s response. Full response:\n%.1000s", provider_name, clean_json_text)
+                # Try to parse as-is anyway
+            test_parse = orjson.loads(clean_json_text)
+        if not isinstance(test_parse, list):
+            log.error("%s response is not a JSON array. Type: %s", provider_name, type(test_parse))
+            return []
+        if len(test_parse) == 0:
+            log.warning("%s returned empty array for %s", provider_name, case_type)
+            log.debug("Full response was: %.1000s", clean_json_text)
+            # For negative test cases, try to generate fallback cases if empty
+            if case_type == "Negative":
+                log.warning("Empty negative test cases detected. Attempting fallback generation...")
+                # Create a more explicit prompt for negative cases
+                fallback_prompt = _NEGATIVE_FALLBACK_PROMPT_TEMPLATE.format(
+                    story_title=story_title,
+                    story_description=story_description,
+                    acceptance_criteria=acceptance_criteria
+                )
+                try:
+                    fallback_response = call_ai_provider(
+                        ai_provider,
+                        fallback_prompt,
+                        images if images and len(images) > 0 else None
+                    )
+                    # Clean and parse fallback response
+                    fallback_clean = _strip_code_fence(fallback_response.strip())
+                    
+                    try:
+                        fallback_parse = orjson.loads(fallback_clean)
+                    except json.JSONDecodeError:
+                        fallback_parse = None
+                    if not isinstance(fallback_parse, list):
+                        json_array = _extract_json_array(fallback_clean)
+                        if json_array:
+                            fallback_clean = json_array
+                        fallback_parse = orjson.loads(fallback_clean)
+                    if isinstance(fallback_parse, list) and len(fallback_parse) > 0:
+                        log.info("SUCCESS: Fallback generated %s negative test cases", len(fallback_parse))
+                        return fallback_parse
+                    else:
+                        log.warning("Fallback also returned empty array")
+                except Exception as fallback_err:
+                    log.error("Fallback generation failed: %s", fallback_err)
+        else:
+            log.debug("Successfully parsed %s test cases from %s for %s", len(test_parse), provider_name, case_type)
+    except json.JSONDecodeError as json_err:
+        log.error("Invalid JSON from %s for %s: %s", provider_name, case_type, json_err)
+        log.debug("Attempted to parse: %.500s...", clean_json_text)
+        return []
+    
+    return test_parse
+
+def _sse_frame(payload):
+    """Encode a payload as a UTF-8 Server-Sent Events ``data:`` frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# Closing frames of the test case stream, encoded once
+_SSE_DONE_OK = _sse_frame({"type": "done", "message": "All test cases generated."})
+_SSE_DONE_FAIL = _sse_frame({"type": "done", "message": "Generation failed."})
+
+
+def _gzip_event_stream(frames):
+    """Gzip a stream of SSE frames, flushing after each one so the client still gets it straight away"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for frame in frames:
+        yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
 
 @app.route('/generate_test_cases', methods=['POST', 'GET'])
 def generate_test_cases_stream():
     """Generate test cases with streaming support - supports both GET (legacy) and POST (for large payloads)"""
-    print("DEBUG: /generate_test_cases endpoint called.")
+    log.debug("/generate_test_cases endpoint called.")
     
     # Get Authorization header for Azure DevOps token (if provided)
     auth_header = request.headers.get('Authorization', '')
@@ -1204,7 +1826,7 @@ def generate_test_cases_stream():
     # Support both GET (legacy) and POST (for large payloads with images)
     if request.method == 'POST':
         try:
-            data = request.json or {}
+            data = _read_json_body() or {}
             if not data:
                 return Response("Payload missing.", status=400)
         except Exception as e:
@@ -1226,47 +1848,51 @@ def generate_test_cases_stream():
         acceptance_criteria = data.get('acceptance_criteria')
         data_dictionary = data.get('data_dictionary', '')
         related_stories = data.get('related_stories', [])
-        ai_provider = data.get('ai_provider', 'gemini')  # Default to Gemini
+        ai_provider = data.get('ai_provider') or 'gemini'  # Default to Gemini (also when sent as null)
         
         if not all([story_title, acceptance_criteria]):
             return Response("Story Title and Acceptance Criteria are required.", status=400)
         
         # Extract images and text from HTML fields
-        desc_images, desc_text = extract_images_from_html(story_description)
-        ac_images, ac_text = extract_images_from_html(acceptance_criteria)
-        dict_images, dict_text = extract_images_from_html(data_dictionary)
+        # One cache for the whole request so repeated screenshots are decoded and sent once
+        image_cache = {}
+        extract_images = partial(extract_images_from_html_cached, image_cache=image_cache)
+        (desc_images, desc_text), (ac_images, ac_text), (dict_images, dict_text) = _HTML_EXTRACT_EXECUTOR.map(
+            extract_images, (story_description, acceptance_criteria, data_dictionary)
+        )
         
         # Process related stories to extract images and tables
         related_stories_processed = []
         related_images = []
         if related_stories:
-            print(f"DEBUG: Processing {len(related_stories)} related stories")
+            log.debug("Processing %s related stories", len(related_stories))
             for idx, related_story in enumerate(related_stories):
                 related_desc = related_story.get('description', '')
                 related_ac = related_story.get('acceptance_criteria', '')
                 
-                print(f"DEBUG: Related story {idx+1} - Description length: {len(related_desc)}, AC length: {len(related_ac)}")
-                print(f"DEBUG: Related story {idx+1} - Description preview (first 200 chars): {related_desc[:200] if related_desc else 'EMPTY'}")
-                print(f"DEBUG: Related story {idx+1} - AC preview (first 200 chars): {related_ac[:200] if related_ac else 'EMPTY'}")
+                log.debug("Related story %s - Description length: %s, AC length: %s", idx + 1, len(related_desc), len(related_ac))
+                log.debug("Related story %s - Description preview (first 200 chars): %.200s", idx + 1, related_desc or 'EMPTY')
+                log.debug("Related story %s - AC preview (first 200 chars): %.200s", idx + 1, related_ac or 'EMPTY')
                 
                 # Extract images and text (including tables) from related story HTML
-                rel_desc_images, rel_desc_text = extract_images_from_html(related_desc)
-                rel_ac_images, rel_ac_text = extract_images_from_html(related_ac)
+                (rel_desc_images, rel_desc_text), (rel_ac_images, rel_ac_text) = _HTML_EXTRACT_EXECUTOR.map(
+                    extract_images, (related_desc, related_ac)
+                )
                 
-                print(f"DEBUG: Related story {idx+1} - After extraction - Desc text length: {len(rel_desc_text)}, AC text length: {len(rel_ac_text)}")
-                if '[TABLE' in rel_desc_text or '[TABLE' in rel_ac_text:
-                    print(f"DEBUG: Related story {idx+1} - TABLES DETECTED in extracted text!")
+                log.debug("Related story %s - After extraction - Desc text length: %s, AC text length: %s", idx + 1, len(rel_desc_text), len(rel_ac_text))
+                if log.isEnabledFor(logging.DEBUG) and ('[TABLE' in rel_desc_text or '[TABLE' in rel_ac_text):
+                    log.debug("Related story %s - TABLES DETECTED in extracted text!", idx + 1)
                     # Show table sections for debugging
                     if '[TABLE' in rel_desc_text:
                         table_start = rel_desc_text.find('[TABLE')
                         table_end = rel_desc_text.find('TABLE END]', table_start) + 10
                         if table_end > table_start:
-                            print(f"DEBUG: Related story {idx+1} - Table in description: {rel_desc_text[table_start:min(table_end+50, len(rel_desc_text))]}")
+                            log.debug("Related story %s - Table in description: %s", idx + 1, rel_desc_text[table_start:min(table_end + 50, len(rel_desc_text))])
                     if '[TABLE' in rel_ac_text:
                         table_start = rel_ac_text.find('[TABLE')
                         table_end = rel_ac_text.find('TABLE END]', table_start) + 10
                         if table_end > table_start:
-                            print(f"DEBUG: Related story {idx+1} - Table in AC: {rel_ac_text[table_start:min(table_end+50, len(rel_ac_text))]}")
+                            log.debug("Related story %s - Table in AC: %s", idx + 1, rel_ac_text[table_start:min(table_end + 50, len(rel_ac_text))])
                 
                 # Collect images from related stories
                 related_images.extend(rel_desc_images)
@@ -1280,121 +1906,173 @@ def generate_test_cases_stream():
                 })
         
         # Debug: Check if steps are detected in acceptance criteria (after HTML extraction)
-        has_steps_debug, steps_text_debug = _detect_steps_in_acceptance_criteria(ac_text)
-        print(f"DEBUG: Acceptance criteria text length: {len(ac_text) if ac_text else 0}")
-        print(f"DEBUG: Steps detected in acceptance criteria: {has_steps_debug}")
-        if has_steps_debug:
-            print(f"DEBUG: Detected steps preview: {steps_text_debug[:300]}")
-        else:
-            print(f"DEBUG: No steps detected. AC preview: {ac_text[:300] if ac_text else 'None'}")
+        if log.isEnabledFor(logging.DEBUG):
+            has_steps_debug, steps_text_debug = _detect_steps_in_acceptance_criteria(ac_text)
+            log.debug("Acceptance criteria text length: %s", len(ac_text) if ac_text else 0)
+            log.debug("Steps detected in acceptance criteria: %s", has_steps_debug)
+            if has_steps_debug:
+                log.debug("Detected steps preview: %.300s", steps_text_debug)
+            else:
+                log.debug("No steps detected. AC preview: %.300s", ac_text or 'None')
         
         # Collect all images (main story + related stories)
-        all_images = desc_images + ac_images + dict_images + related_images
-        print(f"DEBUG: Found {len(all_images)} images for test case generation ({len(desc_images + ac_images + dict_images)} from main story, {len(related_images)} from related stories)")
+        main_images = _unique_images(desc_images + ac_images + dict_images)
+        all_images = _unique_images(main_images + related_images)
+        log.debug("Found %s images for test case generation (%s from main story, %s from related stories)", len(all_images), len(main_images), len(all_images) - len(main_images))
+        
+        # Get ambiguity_aware setting from request (default: True for backward compatibility)
+        ambiguity_aware = data.get('ambiguity_aware', True)
+        if isinstance(ambiguity_aware, str):
+            ambiguity_aware = ambiguity_aware.lower() in ('true', '1', 'yes', 'on')
+        
+        # Only spend prompt tokens on ambiguity coverage when the acceptance criteria show signs of it
+        if ambiguity_aware and request.args.get('force_ambiguity') != '1' and not _has_ambiguity_signals(ac_text):
+            log.debug("No ambiguity signals in acceptance criteria; leaving out the ambiguity-aware section")
+            ambiguity_aware = False
+        
+        # Reject stories too large for the provider before sending four requests that can't succeed
+        provider = 'claude' if ai_provider.lower() == 'claude' else 'gemini'
+        estimated_tokens = _estimate_input_tokens(
+            [_CASES_PROMPT_TEMPLATE, _AMBIGUITY_SECTION if ambiguity_aware else '', story_title, desc_text, ac_text, dict_text]
+            + [text for related in related_stories_processed for text in related.values()],
+            len(all_images)
+        )
+        if estimated_tokens > _MAX_INPUT_TOKENS[provider]:
+            log.warning("Rejecting story of about %s tokens (%s limit: %s)", estimated_tokens, provider, _MAX_INPUT_TOKENS[provider])
+            return jsonify({
+                'error': 'Story is too large to generate test cases from',
+                'message': f"The story, data dictionary, related stories and images come to about {estimated_tokens} tokens; "
+                           f"the {provider.capitalize()} limit is {_MAX_INPUT_TOKENS[provider]}. Remove some content or images and try again."
+            }), 413
+        
+        cache_key = _result_cache_key(
+            'test_cases',
+            [ai_provider.lower(), bool(ambiguity_aware), story_title, desc_text, ac_text, dict_text, related_stories_processed],
+            all_images
+        )
+        # (case type, normalized cases) per type from an earlier identical request
+        cached_cases_by_type = _result_cache_get(cache_key)
         
         def generate():
             try:
                 case_types = ["Positive", "Negative", "Edge Case", "Data Flow"]
-                all_test_cases = []
-
-                # Get ambiguity_aware setting from request (default: True for backward compatibility)
-                ambiguity_aware = data.get('ambiguity_aware', True)
-                if isinstance(ambiguity_aware, str):
-                    ambiguity_aware = ambiguity_aware.lower() in ('true', '1', 'yes', 'on')
                 
-                for case_type in case_types:
+                if cached_cases_by_type is not None:
+                    log.debug("Replaying cached test cases for unchanged story")
+                    for case_type, cases in cached_cases_by_type:
+                        yield _sse_frame({
+                            "type": case_type,
+                            "cases": cases,
+                            "progress": f"Generated {len(cases)} {case_type} cases." if cases else f"No {case_type} cases generated."
+                        })
+                    yield _SSE_DONE_OK
+                    return
+                
+                # Only cache a run in which every case type finished with test cases: an empty,
+                # truncated or prose response ends its case type with none, and replaying that
+                # for the cache lifetime would hide a retry from the user
+                cases_by_type = []
+                
+                # Render the shared story block once instead of once per case type
+                story_context = _build_story_context(story_title, desc_text, ac_text, dict_text, related_stories_processed)
+                
+                # The case types are independent, so request them concurrently. Each worker
+                # streams its test cases into a shared queue as (case type, kind, value) and
+                # they are forwarded to the client in arrival order.
+                events = queue.Queue()
+                stop_requested = threading.Event()
+                
+                def run_case_type(case_type):
                     try:
-                        print(f"DEBUG: Calling _generate_cases_for_type for {case_type} with related_stories:", related_stories_processed)
-                        # Generate cases for the current type, including images
-                        json_text_chunk = _generate_cases_for_type(ai_provider, story_title, desc_text, ac_text, dict_text, case_type, related_stories_processed, all_images, ambiguity_aware)
+                        log.debug("Calling _generate_cases_for_type for %s with related_stories: %s", case_type, related_stories_processed)
+                        # Generate cases for the current type, including images, forwarding each
+                        # test case as soon as it has been streamed in full
+                        for test_case in _generate_cases_for_type(
+                            ai_provider, story_title, desc_text, ac_text, dict_text,
+                            case_type, related_stories_processed, all_images, ambiguity_aware,
+                            story_context=story_context
+                        ):
+                            if stop_requested.is_set():
+                                # Client went away
+                                return
+                            events.put((case_type, 'case', _normalize_generated_test_case(test_case)))
+                        events.put((case_type, 'end', None))
+                    except Exception as case_error:
+                        events.put((case_type, 'error', case_error))
+                
+                executor = ThreadPoolExecutor(max_workers=len(case_types))
+                try:
+                    for case_type in case_types:
+                        executor.submit(run_case_type, case_type)
+                    
+                    cases_so_far = {case_type: [] for case_type in case_types}
+                    pending = len(case_types)
+                    while pending:
+                        case_type, kind, value = events.get()
+                        cases = cases_so_far[case_type]
+                        if kind == 'case':
+                            cases.append(value)
+                            yield _sse_frame({
+                                "type": case_type,
+                                "cases": [value],
+                                "progress": f"Generated {len(cases)} {case_type} cases..."
+                            })
+                            continue
                         
-                        # The API might return an empty or invalid string, so we validate it
-                        try:
-                            # Validate if it's proper JSON
-                            parsed_chunk = json.loads(json_text_chunk)
-                            if isinstance(parsed_chunk, list):
-                                if parsed_chunk:
-                                    for _tc in parsed_chunk:
-                                        _normalize_generated_test_case(_tc)
-                                    all_test_cases.extend(parsed_chunk)
-                                    # Stream the current progress back to the client
-                                    progress_data = {
-                                        "type": case_type,
-                                        "cases": parsed_chunk,
-                                        "progress": f"Generated {len(parsed_chunk)} {case_type} cases."
-                                    }
-                                    yield f"data: {json.dumps(progress_data)}\n\n"
-                                else:
-                                    print(f"WARNING: {case_type} returned empty array. Response was: {json_text_chunk[:200]}")
-                                    # Still send progress even if empty
-                                    progress_data = {
-                                        "type": case_type,
-                                        "cases": [],
-                                        "progress": f"No {case_type} cases generated."
-                                    }
-                                    yield f"data: {json.dumps(progress_data)}\n\n"
+                        pending -= 1
+                        if kind == 'end':
+                            cases_by_type.append((case_type, cases))
+                            if cases:
+                                progress = f"Generated {len(cases)} {case_type} cases."
                             else:
-                                print(f"ERROR: Response for {case_type} is not a list. Type: {type(parsed_chunk)}")
-                                error_data = {
-                                    "type": "error",
-                                    "case_type": case_type,
-                                    "error": f"Response for {case_type} is not a JSON array",
-                                    "message": f"Expected list, got {type(parsed_chunk).__name__}"
-                                }
-                                yield f"data: {json.dumps(error_data)}\n\n"
-                        except json.JSONDecodeError as json_err:
-                            print(f"ERROR: Could not decode JSON for {case_type} cases.")
-                            print(f"DEBUG: JSON Error: {json_err}")
-                            print(f"DEBUG: Response text (first 500 chars): {json_text_chunk[:500]}")
-                            # Send error to client
+                                log.warning("%s returned no test cases", case_type)
+                                # Still send progress even if empty
+                                progress = f"No {case_type} cases generated."
+                            yield _sse_frame({"type": case_type, "cases": [], "progress": progress})
+                        else:
+                            log.error("ERROR generating %s cases: %s", case_type, value, exc_info=value)
+                            # Send error to client but continue with other case types
                             error_data = {
                                 "type": "error",
                                 "case_type": case_type,
-                                "error": f"Failed to parse JSON response for {case_type} cases",
-                                "message": str(json_err)
+                                "error": f"Failed to generate {case_type} cases",
+                                "message": str(value)
                             }
-                            yield f"data: {json.dumps(error_data)}\n\n"
-                            continue
-                    except Exception as case_error:
-                        import traceback
-                        print(f"ERROR generating {case_type} cases: {case_error}")
-                        traceback.print_exc()
-                        # Send error to client but continue with other case types
-                        error_data = {
-                            "type": "error",
-                            "case_type": case_type,
-                            "error": f"Failed to generate {case_type} cases",
-                            "message": str(case_error)
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        continue
+                            yield _sse_frame(error_data)
+                finally:
+                    # Don't hold the response open for calls nobody will read
+                    stop_requested.set()
+                    executor.shutdown(wait=False)
                 
-                print("--- Finished generating all test cases. ---")
-                yield "data: {\"type\": \"done\", \"message\": \"All test cases generated.\"}\n\n"
+                if len(cases_by_type) == len(case_types) and all(cases for _, cases in cases_by_type):
+                    _result_cache_put(cache_key, cases_by_type)
+                log.info("--- Finished generating all test cases. ---")
+                yield _SSE_DONE_OK
             except Exception as gen_error:
-                import traceback
-                print(f"CRITICAL ERROR in generate() function: {gen_error}")
-                traceback.print_exc()
+                log.critical("Error in generate() function: %s", gen_error, exc_info=True)
                 # Send final error message
                 error_data = {
                     "type": "error",
                     "error": "Critical error during test case generation",
                     "message": str(gen_error)
                 }
-                yield f"data: {json.dumps(error_data)}\n\n"
-                yield "data: {\"type\": \"done\", \"message\": \"Generation failed.\"}\n\n"
+                yield _sse_frame(error_data)
+                yield _SSE_DONE_FAIL
         
-        response = Response(generate(), mimetype='text/event-stream')
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        # Test case JSON repeats the same keys and phrasing, so it compresses several times over
+        if request.accept_encodings.quality('gzip') > 0:
+            response = Response(_gzip_event_stream(generate()), mimetype='text/event-stream')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(generate(), mimetype='text/event-stream')
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.direct_passthrough = True  # Frames are already UTF-8 bytes
         response.headers['Cache-Control'] = 'no-cache'
         response.headers['X-Accel-Buffering'] = 'no'  # Disable buffering for nginx
         return response
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("Error in generate_test_cases_stream endpoint: %s", e)
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
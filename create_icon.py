@@ -3,31 +3,23 @@ Simple script to create a 128x128 icon for Test Genius extension
 Requires: pip install Pillow
 """
 try:
+    import os
     from PIL import Image, ImageDraw, ImageFont
     
     # Create 128x128 image with Azure blue background
     img = Image.new('RGB', (128, 128), color='#0078D7')
     draw = ImageDraw.Draw(img)
     
-    # Try to use a nice font, fallback to default
-    try:
-        # Try common Windows fonts
-        font_paths = [
-            'C:/Windows/Fonts/arial.ttf',
-            'C:/Windows/Fonts/arialbd.ttf',
-            'C:/Windows/Fonts/calibri.ttf',
-        ]
-        font = None
-        for path in font_paths:
-            try:
-                font = ImageFont.truetype(path, 70)
-                break
-            except:
-                continue
-        if font is None:
-            font = ImageFont.load_default()
-    except:
-        font = ImageFont.load_default()
+    # Use the first common Windows font that exists, fallback to default
+    font_paths = (
+        'C:/Windows/Fonts/arial.ttf',
+        'C:/Windows/Fonts/arialbd.ttf',
+        'C:/Windows/Fonts/calibri.ttf',
+    )
+    font = next(
+        (ImageFont.truetype(path, 70) for path in font_paths if os.path.exists(path)),
+        None
+    ) or ImageFont.load_default()
     
     # Draw "TG" text in white, centered
     text = "TG"
@@ -45,7 +37,6 @@ try:
     draw.text((x, y), text, fill='white', font=font)  # Main text
     
     # Save to extension/images folder
-    import os
     icon_path = os.path.join('extension', 'images', 'icon.png')
     os.makedirs(os.path.dirname(icon_path), exist_ok=True)
     img.save(icon_path)
@@ -179,6 +179,8 @@ class ApiService {
           }
 
           const decoder = new TextDecoder();
+          // A read can end mid-frame; keep the incomplete tail for the next read
+          let buffer = '';
 
           function readStream() {
             reader!
@@ -189,8 +191,9 @@ class ApiService {
                   return;
                 }
 
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n\n');
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n\n');
+                buffer = lines.pop() || '';
 
                 for (const line of lines) {
                   if (line.startsWith('data: ')) {
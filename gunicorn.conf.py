@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration for serving app.py / app_api.py in production
+Usage: gunicorn app:app  (or gunicorn app_api:app)
+"""
+import multiprocessing
+import os
+
+# Azure App Service provides PORT; default matches the Flask dev server
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Threaded workers: each SSE stream from /generate_test_cases waits on the AI
+# provider for most of its lifetime, so a thread per stream is cheap while a
+# sync worker would block the whole process for the duration of the stream.
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", min(multiprocessing.cpu_count() * 2 + 1, 4)))
+# The app splits its AI provider rate limits between the workers
+os.environ["GUNICORN_WORKERS"] = str(workers)
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+
+# Generating all four case types can take several minutes; give in-flight
+# streams time to finish when a worker is restarted.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 600))
+keepalive = 5